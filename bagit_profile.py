@@ -35,13 +35,29 @@ else:
 
 """
 
+import abc
+import binascii
+import copy
+import hashlib
+import heapq
 import json
 import logging
 import mimetypes
+import mmap
+import os
+import re
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
 from fnmatch import fnmatch
 from os import listdir, walk
-from os.path import basename, exists, isdir, isfile, join, relpath, split
+from os.path import basename, exists, getmtime, isdir, isfile, join, relpath, split
 
 if sys.version_info > (3,):
     basestring = str
@@ -50,6 +66,11 @@ else:
     basestring = basestring
     from urllib import urlopen  # pylint: disable=no-name-in-module
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 # Define an exceptin class for use within this module.
 class ProfileValidationError(Exception):
     # TODO: or just 'pass' instead of __init__ and __str__
@@ -61,6 +82,13 @@ class ProfileValidationError(Exception):
         return repr(self.value)
 
 
+class ValidationTimeout(Exception):
+    """
+    Raised inside a validation that has run past its deadline; see
+    validate_bag_path.
+    """
+
+
 class ProfileValidationReport(object):  # pylint: disable=useless-object-inheritance
     def __init__(self):
         self.errors = []
@@ -69,6 +97,15 @@ class ProfileValidationReport(object):  # pylint: disable=useless-object-inherit
     def is_valid(self):
         return not self.errors
 
+    def to_dict(self):
+        return {"is_valid": self.is_valid, "errors": ["%s" % e.value for e in self.errors]}
+
+    @classmethod
+    def from_dict(cls, data):
+        report = cls()
+        report.errors = [ProfileValidationError(e) for e in data["errors"]]
+        return report
+
     def __str__(self):
         if self.is_valid:
             return "VALID"
@@ -80,7 +117,9 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
 
     _baginfo_profile_id_tag = "BagIt-Profile-Identifier"
 
-    def __init__(self, url, profile=None, ignore_baginfo_tag_case=False):
+    def __init__(self, url, profile=None, ignore_baginfo_tag_case=False, tag_fixity=False,
+                 payload_completeness=False, resolver=None, metadata_cache=None, compact=False,
+                 result_cache=None, rules=None, fail_fast=False, fetch_entries=False, fetch_workers=8):
         self.url = url
         if profile is None:
             profile = self.get_profile()
@@ -89,11 +128,41 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
                 profile = profile
             else:
                 profile = json.loads(profile)
+        if profile.get(PROFILE_EXTENDS_KEY):
+            # Merge in the profiles this one extends, found by 'resolver'
+            # (by default, retrieved from their URLs).
+            # resolve_profile() caches what it returns, and the defaults set
+            # by validate_bagit_profile() must not end up in that cache.
+            profile = dict(resolve_profile(profile, resolver or fetch_profile))
         self.validate_bagit_profile(profile)
         # Report of the errors in the last run of validate
         self.report = None
-        self.profile = profile
+        # With 'compact', keep the profile as an immutable compact_profile().
+        self.profile = compact_profile(profile) if compact else profile
         self.ignore_baginfo_tag_case = ignore_baginfo_tag_case
+        # Also check the digests in the tag manifests when validating.
+        self.tag_fixity = tag_fixity
+        # Also check that the payload manifests list exactly the payload files.
+        self.payload_completeness = payload_completeness
+        # Also check the entries of fetch.txt, with up to 'fetch_workers' URLs
+        # checked at a time.
+        self.fetch_entries = fetch_entries
+        self.fetch_workers = fetch_workers
+        # MetadataCache through which the bag's tag directories are listed, if any.
+        self.metadata_cache = metadata_cache
+        self._listing = None
+        # ResultCache consulted and filled by validate, if any.
+        self.result_cache = result_cache
+        # The Rules (or names of registered rules) validate runs, if not all
+        # the registered ones.
+        if rules is not None:
+            unknown = [rule for rule in rules if isinstance(rule, basestring) and rule not in _rule_registry]
+            if unknown:
+                raise ValueError("No rule is registered as %s" % ", ".join(unknown))
+            rules = [_rule_registry[rule] if isinstance(rule, basestring) else rule for rule in rules]
+        self.rules = rules
+        # Stop validating a bag at its first error.
+        self.fail_fast = fail_fast
 
     def _fail(self, msg):
         logging.error(msg)
@@ -102,6 +171,29 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
     def _warn(self, msg):
         logging.error(msg)
 
+    def _tag_listing(self, bag):
+        # The TagListing of a BagFacts, or of a bag when there is a metadata cache.
+        if isinstance(bag, BagFacts):
+            return bag.listing
+        if self.metadata_cache is None:
+            return None
+        if self._listing is None or self._listing.bag_dir != bag.path:
+            self._listing = TagListing(bag.path, self.metadata_cache)
+        return self._listing
+
+    def _exists(self, bag, name):
+        # Whether 'name', relative to the bag, exists.
+        listing = self._tag_listing(bag)
+        if listing is None:
+            return exists(join(bag.path, name))
+        return listing.exists(name)
+
+    def _find_tag_files(self, bag):
+        listing = self._tag_listing(bag)
+        if listing is None:
+            return find_tag_files(bag.path)
+        return listing.tag_files()
+
     def get_profile(self):
         try:
             f = urlopen(self.url)
@@ -117,49 +209,101 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
 
         return profile
 
-    # Call all the validate functions other than validate_bagit_profile(),
-    # which we've already called. 'Serialization' and 'Accept-Serialization'
-    #  are validated in validate_serialization().
-    def validate(self, bag):
-        self.report = ProfileValidationReport()
-        for (fn, msg, min_version) in [
-            (self.validate_bag_info, "Error in bag-info.txt", None),
-            (self.validate_manifests_required, "Required manifests not found", None),
-            (
-                self.validate_tag_manifests_required,
-                "Required tag manifests not found",
-                None,
-            ),
-            (self.validate_payload_manifests_allowed, "Disallowed payload manifests present", (1, 3, 0)),
-            (self.validate_tag_manifests_allowed, "Disallowed tag manifests present", (1, 3, 0)),
-            (self.validate_tag_files_required, "Required tag files not found", None),
-            (
-                self.validate_allow_fetch,
-                "fetch.txt is present but is not allowed",
-                None,
-            ),
-            (
-                self.validate_accept_bagit_version,
-                "Required BagIt version not found",
-                None,
-            ),
-            (self.validate_tag_files_allowed, "Tag files not allowed", (1, 2, 0)),
-        ]:
+    # Run all the rules (see register_rule), which call the validate functions
+    # other than validate_bagit_profile(), which we've already called.
+    # 'Serialization' and 'Accept-Serialization' are validated in
+    # validate_serialization().
+    def _rules(self):
+        # The Rules validate runs, in the order their errors are reported.
+        rules = registered_rules() if self.rules is None else self.rules
+        return [rule for rule in rules if rule.applies is None or rule.applies(self)]
+
+    def _run_rules(self, facts, rules):
+        # Run 'rules' on the BagFacts 'facts', cheapest first, and return
+        # rule name -> ProfileValidationError, or None if it passed, in the
+        # order of 'rules'. With fail_fast, rules after the first error are
+        # left out.
+        pending = []
+        for rule in rules:
+            if rule.min_version and self.profile_version_info < rule.min_version:
+                logging.info(
+                    "Skipping %s introduced in version %s (version validated: %s)",
+                    rule.name,
+                    rule.min_version,
+                    self.profile_version_info,
+                )
+                continue
+            pending.append(rule)
+        outcomes = OrderedDict((rule.name, None) for rule in pending)
+
+        def cost(rule):
+            return rule.cost + sum(_fact_registry[name][1] for name in rule.needs if not facts.fetched(name))
+
+        while pending:
+            rule = min(pending, key=cost)
+            pending.remove(rule)
+            _check_deadline()
             try:
-                if min_version and self.profile_version_info < min_version:
-                    logging.info(
-                        "Skipping %s introduced in version %s (version validated: %s)",
-                        fn,
-                        min_version,
-                        self.profile_version_info,
-                    )
-                    continue
-                fn(bag)
+                with _timing(rule.name):
+                    rule.check(self, facts)
             except ProfileValidationError as e:
-                #  self._warn("%s: %s" % (msg, e))
-                self.report.errors.append(e)
+                #  self._warn("%s: %s" % (rule.description, e))
+                outcomes[rule.name] = e
+                if self.fail_fast:
+                    for skipped in pending:
+                        del outcomes[skipped.name]
+                    break
+        return outcomes
+
+    def validate(self, bag):
+        self._listing = None
+        cache_key = self._result_cache_key(bag)
+        if cache_key is not None:
+            report = self.result_cache.get(*cache_key)
+            if report is not None:
+                self.report = report
+                return report.is_valid
+        facts = bag if isinstance(bag, BagFacts) else BagFacts(bag, self.metadata_cache)
+        if (facts.described or not facts.storage.local) and (self.tag_fixity or self.payload_completeness or
+                                                             self.fetch_entries):
+            raise ValueError("%s: Tag fixity, payload completeness and fetch.txt entries can only be checked in "
+                             "bags on local disk" % facts)
+        self.report = ProfileValidationReport()
+        # Rule name -> error message, or None if it passed.
+        outcomes = OrderedDict()
+        for name, error in self._run_rules(facts, self._rules()).items():
+            outcomes[name] = None if error is None else error.value
+            if error is not None:
+                self.report.errors.append(error)
+        if cache_key is not None and bag_fingerprint(bag.path) == cache_key[2]:
+            # Only cache the report if the bag did not change while validated.
+            # With facts, the rest of them are stored too, so that later
+            # profile changes can be re-checked against them.
+            self.result_cache.put(cache_key[0], cache_key[1], cache_key[2], self.report, checks=outcomes,
+                                  facts=facts if self.result_cache.facts else None)
         return self.report.is_valid
 
+    def _profile_key(self):
+        # Hash of everything about this profile that validate's results depend on.
+        options = [self.url, profile_hash(self.profile), self.ignore_baginfo_tag_case, self.tag_fixity,
+                   self.fail_fast, [rule.name for rule in self._rules()]]
+        return hashlib.sha256(json.dumps(options).encode("utf-8")).hexdigest()
+
+    def _result_cache_key(self, bag):
+        # (profile key, bag path, fingerprint) under which the report for
+        # 'bag' is cached, or None when it is not to be cached. The payload
+        # is not fingerprinted, so rules reading it disable the cache. Of
+        # BagFacts, only those about to be read from a bag on local disk are
+        # cached.
+        if self.result_cache is None:
+            return None
+        if isinstance(bag, BagFacts) and (bag.described or not bag.storage.local or bag.values):
+            return None
+        if any(rule.reads_payload for rule in self._rules()):
+            return None
+        path = os.path.abspath(bag.path)
+        return self._profile_key(), path, bag_fingerprint(path)
+
     def validate_bagit_profile(self, profile):
         """
         Set default values for unspecified tags and validate the profile itself.
@@ -230,15 +374,25 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
     def validate_bag_info(self, bag):
         # First, check to see if bag-info.txt exists.
         path_to_baginfotxt = join(bag.path, "bag-info.txt")
-        if not exists(path_to_baginfotxt):
+        if isinstance(bag, BagFacts):
+            present = bag.fact("bag_info") is not None
+        else:
+            present = self._exists(bag, "bag-info.txt")
+        if not present:
             self._fail("%s: bag-info.txt is not present." % bag)
         # Then check for the required 'BagIt-Profile-Identifier' tag and ensure it has the same value
-        # as self.url.
+        # as self.url. Only the tags the profile refers to are read from bag-info.txt.
+        wanted = set(self.normalize_tag(tag) for tag in self.profile["Bag-Info"])
+        wanted.add(self.normalize_tag(self._baginfo_profile_id_tag))
+        if isinstance(bag, BagFacts):
+            bag_info = bag.tags(wanted, ignore_case=self.ignore_baginfo_tag_case)
+        else:
+            bag_info = parse_tag_file(path_to_baginfotxt, tags=wanted,
+                                      ignore_case=self.ignore_baginfo_tag_case,
+                                      encoding=getattr(bag, "encoding", "utf-8"))
         if self.ignore_baginfo_tag_case:
-            bag_info = {self.normalize_tag(k): v for k, v in bag.info.items()}
             ignore_tag_case_help = ""
         else:
-            bag_info = bag.info
             ignore_tag_case_help = " Set 'ignore_baginfo_tag_case' to True if you wish to ignore tag case."
 
         profile_id_tag = self.normalize_tag(self._baginfo_profile_id_tag)
@@ -266,7 +420,10 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
                     )
             # If the tag is in bag-info.txt, check to see if the value is constrained.
             if "values" in config and normalized_tag in bag_info:
-                if bag_info[normalized_tag] not in config["values"]:
+                # A repeated tag's values come as a list, which is never allowed
+                # (nor hashable, for the 'values' sets of compact profiles).
+                value = bag_info[normalized_tag]
+                if isinstance(value, list) or value not in config["values"]:
                     self._fail(
                         "%s: Required tag '%s' is present in bag-info.txt but does not have an allowed value ('%s')."
                         % (bag, tag, bag_info[normalized_tag])
@@ -289,8 +446,7 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
     # the manifest file is not present.
     def validate_manifests_required(self, bag):
         for manifest_type in self.profile["Manifests-Required"]:
-            path_to_manifest = join(bag.path, "manifest-" + manifest_type + ".txt")
-            if not exists(path_to_manifest):
+            if not self._exists(bag, "manifest-" + manifest_type + ".txt"):
                 self._fail(
                     "%s: Required manifest type '%s' is not present in Bag."
                     % (bag, manifest_type)
@@ -304,10 +460,7 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
         if "Tag-Manifests-Required" not in self.profile:
             return True
         for tag_manifest_type in self.profile["Tag-Manifests-Required"]:
-            path_to_tag_manifest = join(
-                bag.path, "tagmanifest-" + tag_manifest_type + ".txt"
-            )
-            if not exists(path_to_tag_manifest):
+            if not self._exists(bag, "tagmanifest-" + tag_manifest_type + ".txt"):
                 self._fail(
                     "%s: Required tag manifest type '%s' is not present in Bag."
                     % (bag, tag_manifest_type)
@@ -379,7 +532,7 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
             )
 
         # For each tag file in the bag base directory, ensure it is also in 'Tag-Files-Allowed'.
-        for tag_file in find_tag_files(bag.path):
+        for tag_file in self._find_tag_files(bag):
             tag_file = relpath(tag_file, bag.path)
             if not fnmatch_any(tag_file, allowed):
                 self._fail(
@@ -395,26 +548,155 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
             return True
         for tag_file in self.profile["Tag-Files-Required"]:
             path_to_tag_file = join(bag.path, tag_file)
-            if not exists(path_to_tag_file):
+            if not self._exists(bag, tag_file):
                 self._fail(
                     "%s: Required tag file '%s' is not present in Bag."
                     % (bag, path_to_tag_file)
                 )
         return True
 
+    def validate_tag_fixity(self, bag):
+        """
+        Check every tag manifest's digests against the tag files, and that the
+        tag manifests cover every tag file in the bag. Payload files are never
+        read.
+        """
+        tag_files = set(relpath(f, bag.path) for f in find_tag_files(bag.path))
+        tag_files.update(
+            name for name in listdir(bag.path)
+            if name in ("bagit.txt", "bag-info.txt", "fetch.txt") or fnmatch(name, "manifest-*.txt")
+        )
+        problems = []
+        # Each tag manifest's entries, as problems or (expected digest,
+        # entry, path) to check, and then the files it misses; the files
+        # listed in tag manifests of several algorithms are read only once.
+        checks = []
+        algorithms = {}
+        encoding = getattr(bag, "encoding", "utf-8")
+        for manifest in sorted(listdir(bag.path)):
+            if not fnmatch(manifest, "tagmanifest-*.txt"):
+                continue
+            algorithm = next(self.manifest_algorithms([manifest]))
+            try:
+                hashlib.new(algorithm)
+            except ValueError:
+                checks.append("%s: unsupported algorithm '%s'" % (manifest, algorithm))
+                continue
+            covered = set()
+            for expected, entry in iter_manifest(join(bag.path, manifest), encoding):
+                covered.add(entry)
+                parts = os.path.normpath(entry).split(os.sep)
+                if os.path.isabs(entry) or parts[0] in ("..", "data"):
+                    checks.append("%s: '%s' is not a tag file" % (manifest, entry))
+                    continue
+                path = join(bag.path, *parts)
+                if not isfile(path):
+                    checks.append("%s: '%s' is not present" % (manifest, entry))
+                else:
+                    checks.append((manifest, algorithm, expected.lower(), entry, path))
+                    algorithms.setdefault(path, set()).add(algorithm)
+            for tag_file in sorted(tag_files - covered):
+                checks.append("%s: '%s' is not listed" % (manifest, tag_file))
+        digests = {}
+        for check in checks:
+            if not isinstance(check, tuple):
+                problems.append(check)
+                continue
+            manifest, algorithm, expected, entry, path = check
+            if path not in digests:
+                digests[path] = _file_digests(path, algorithms[path])
+            if digests[path][algorithm] != expected:
+                problems.append("%s: '%s' does not match its digest" % (manifest, entry))
+        if problems:
+            self._fail("%s: %s" % (bag, _summarize(problems)))
+        return True
+
+    def validate_payload_completeness(self, bag):
+        """
+        Check that each payload manifest lists exactly the files under data/,
+        without computing any digests. Manifest paths are sorted externally and
+        merged against a sorted walk of data/, so memory use does not grow with
+        the number of payload files.
+        """
+        manifests = sorted(n for n in listdir(bag.path) if fnmatch(n, "manifest-*.txt"))
+        encoding = getattr(bag, "encoding", "utf-8")
+        streams = [iter_sorted_payload(bag.path)]
+        for manifest in manifests:
+            streams.append(external_sort(entry for _, entry in iter_manifest(join(bag.path, manifest), encoding)))
+        problems = []
+        total = 0
+        for index, entry, present in _compare_sorted(streams):
+            total += 1
+            if len(problems) >= _MAX_REPORTED_PROBLEMS:
+                continue
+            if index == 0:
+                problems.append("'%s' is not listed in any payload manifest" % entry)
+            elif present:
+                problems.append("'%s' is not listed in %s" % (entry, manifests[index - 1]))
+            else:
+                problems.append("'%s' is listed in %s but not present" % (entry, manifests[index - 1]))
+        if problems:
+            self._fail("%s: %s" % (bag, _summarize(problems, total)))
+        return True
+
+    def validate_fetch(self, bag):
+        """
+        Check the entries of the bag's fetch.txt, if it has one the profile
+        allows: that each is well-formed, that its path is listed in every
+        payload manifest, and that its URL can be reached (see check_urls).
+        Both kinds of problem are reported together. fetch.txt and the
+        manifests are read a line at a time and the paths sorted externally,
+        so memory use does not grow with their size.
+        """
+        if self.profile["Allow-Fetch.txt"] is False or not self._exists(bag, "fetch.txt"):
+            return True
+        path = join(bag.path, "fetch.txt")
+        manifests = sorted(n for n in listdir(bag.path) if fnmatch(n, "manifest-*.txt"))
+        encoding = getattr(bag, "encoding", "utf-8")
+        streams = [external_sort(entry for _, _, _, entry in iter_fetch(path, encoding))]
+        for manifest in manifests:
+            streams.append(external_sort(entry for _, entry in iter_manifest(join(bag.path, manifest), encoding)))
+        problems = []
+        total = 0
+        for index, entry, present in _compare_sorted(streams):
+            if not present:
+                # Listed in a manifest but not fetched, which is as it should be.
+                continue
+            total += 1
+            if len(problems) >= _MAX_REPORTED_PROBLEMS:
+                continue
+            if index == 0:
+                problems.append("'%s' in fetch.txt is not listed in any payload manifest" % entry)
+            else:
+                problems.append("'%s' in fetch.txt is not listed in %s" % (entry, manifests[index - 1]))
+        urls = (url for _, url, _, _ in iter_fetch(path, encoding))
+        for url, problem in check_urls(urls, workers=self.fetch_workers):
+            if problem is not None:
+                total += 1
+                if len(problems) < _MAX_REPORTED_PROBLEMS:
+                    problems.append("'%s' in fetch.txt cannot be reached: %s" % (url, problem))
+        if problems:
+            self._fail("%s: %s" % (bag, _summarize(problems, total)))
+        return True
+
     # Check to see if this constraint is False, and if it is, then check to see
     # if the fetch.txt file exists. If it does, throw an exception.
     def validate_allow_fetch(self, bag):
         if self.profile["Allow-Fetch.txt"] is False:
-            path_to_fetchtxt = join(bag.path, "fetch.txt")
-            if exists(path_to_fetchtxt):
+            if self._exists(bag, "fetch.txt"):
                 self._fail("%s: Fetch.txt is present but is not allowed." % bag)
         return True
 
     # Check the Bag's version, and if it's not in the list of allowed versions,
     # throw an exception.
     def validate_accept_bagit_version(self, bag):
-        actual = bag.tags["BagIt-Version"]
+        if isinstance(bag, BagFacts):
+            version = bag.fact("bagit_version")
+            if "error" in version:
+                raise ProfileValidationError(version["error"])
+            actual = version["version"]
+        else:
+            actual = parse_tag_file(join(bag.path, "bagit.txt"), tags=["BagIt-Version"]).get("BagIt-Version")
         allowed = self.profile["Accept-BagIt-Version"]
         if actual not in allowed:
             self._fail(
@@ -449,17 +731,584 @@ class Profile(object):  # pylint: disable=useless-object-inheritance
             or self.profile["Serialization"] == "optional"
             and isfile(path_to_bag)
         ):
-            _, bag_file = split(path_to_bag)
-            mtype = mimetypes.guess_type(bag_file)
-            if mtype[0] not in self.profile["Accept-Serialization"]:
+            accepted = self.profile["Accept-Serialization"]
+            mtypes = sniff_serialization(path_to_bag)
+            if not mtypes:
+                # Not a format we recognise by content, so trust the file name
+                # unless it claims to be one we do recognise.
+                _, bag_file = split(path_to_bag)
+                mtype = mimetypes.guess_type(bag_file)[0]
+                mtypes = () if mtype in _SNIFFED_SERIALIZATIONS else (mtype,)
+            if not any(mtype in accepted for mtype in mtypes):
                 self._fail(
-                    "%s: Bag serialization is forbidden but Bag appears is a file."
-                    % path_to_bag
+                    "%s: Bag serialization format %s is not in Accept-Serialization: %s"
+                    % (path_to_bag, mtypes[0] if mtypes else "(unknown)", accepted)
                 )
         # If we have passed the serialization tests, return True.
         return True
 
 
+class CompactMapping(Mapping):
+    """
+    Immutable, ordered mapping used by compact_profile(). Keys and values
+    are held in two tuples, so it takes far less memory than a dict; lookups
+    scan the keys, which suits the few keys of a profile's mappings.
+    """
+
+    # For _compact_pool. On Python 2, Mapping already has a __weakref__ slot.
+    __slots__ = ("_keys", "_values") + (() if hasattr(Mapping, "__weakref__") else ("__weakref__",))
+
+    def __init__(self, keys, values):
+        self._keys = keys
+        self._values = values
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __hash__(self):
+        return hash((self._keys, self._values))
+
+    def __repr__(self):
+        return "CompactMapping(%r)" % (list(self.items()),)
+
+
+# Canonical instances of the mappings and sets built by compact_profile(),
+# so that equal parts of different profiles are shared. Entries go once no
+# profile uses them. Tuples cannot be weakly referenced, so they are only
+# shared as part of a shared mapping; strings are interned instead.
+_compact_pool = weakref.WeakValueDictionary()
+
+
+def _pool_key(value):
+    # Part of the pool key of a container holding 'value': pooled values by
+    # id (the container keeps them alive, so the id is not reused while the
+    # key is in the pool), strings as they are, and others by content, with
+    # the type to tell True from 1.
+    if isinstance(value, (CompactMapping, frozenset)):
+        return id(value)
+    if isinstance(value, basestring):  # pylint: disable=undefined-variable
+        return value
+    if isinstance(value, tuple):
+        return ("tuple",) + tuple(_pool_key(v) for v in value)
+    return (type(value), value)
+
+
+def _compact(value, is_values=False):
+    # Return the canonical compact form of a JSON value.
+    if isinstance(value, Mapping):
+        keys = tuple(_compact(k) for k in value)
+        values = tuple(_compact(v, is_values=k == "values") for k, v in value.items())
+        key = ("map",) + tuple(_pool_key(v) for v in keys + values)
+        return _compact_pool.setdefault(key, CompactMapping(keys, values))
+    if isinstance(value, (list, tuple, frozenset)):
+        items = tuple(_compact(v) for v in value)
+        if is_values:
+            # Only ever tested for membership.
+            try:
+                items = frozenset(items)
+                return _compact_pool.setdefault(("set", frozenset(_pool_key(v) for v in items)), items)
+            except TypeError:
+                pass
+        return items
+    if isinstance(value, str) and hasattr(sys, "intern"):
+        value = sys.intern(value)
+    return value
+
+
+def compact_profile(profile):
+    """
+    Return a read-only copy of the profile dict ``profile`` that takes
+    little memory, for processes that keep many profiles loaded: mappings
+    become CompactMappings, lists become tuples, the 'values' lists of
+    'Bag-Info' become frozensets, and strings, 'values' sets and mappings
+    equal to ones of other compacted profiles still in use are shared.
+    """
+    return _compact(profile)
+
+
+# Top-level profile key naming the profiles (by identifier or URL) that a
+# profile extends. This is a local extension to the BagIt Profiles spec.
+PROFILE_EXTENDS_KEY = "BagIt-Profile-Extends"
+
+# Lists of requirements, which a derived profile adds to. Other keys given by
+# a derived profile replace those of the profiles it extends.
+_MERGED_LIST_KEYS = ("Manifests-Required", "Tag-Manifests-Required", "Tag-Files-Required")
+
+# Lists of what a bag may hold, an absent list allowing anything. Those of
+# the profiles extended are combined, and a derived profile can only narrow
+# the result.
+_ALLOWED_LIST_KEYS = ("Manifests-Allowed", "Tag-Manifests-Allowed", "Tag-Files-Allowed")
+
+_MERGED_CACHE_SIZE = 1024
+_merged_profiles = OrderedDict()
+
+
+def fetch_profile(url):
+    """
+    Retrieve the profile at ``url`` and return it as a dict.
+    """
+    try:
+        profile = urlopen(url).read()
+        if sys.version_info > (3,):
+            profile = profile.decode("utf-8")
+        return json.loads(profile)
+    except Exception as e:  # pylint: disable=broad-except
+        raise ProfileValidationError("Cannot retrieve profile from %s: %s" % (url, e))
+
+
+def _canonical(value, is_values=False):
+    # Plain JSON form of a profile (dict or compact_profile()), with the
+    # order of 'values' lists made irrelevant.
+    if isinstance(value, Mapping):
+        return dict((k, _canonical(v, is_values=k == "values")) for k, v in value.items())
+    if isinstance(value, (list, tuple, frozenset)):
+        items = [_canonical(v) for v in value]
+        if is_values or isinstance(value, frozenset):
+            items.sort(key=lambda v: json.dumps(v, sort_keys=True))
+        return items
+    return value
+
+
+def profile_hash(profile):
+    """
+    Return a hash of the content of the profile ``profile``, a dict or a
+    compact_profile(). Profiles differing only in the order of 'values'
+    lists hash alike.
+    """
+    canonical = json.dumps(_canonical(profile), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def merge_profiles(base, derived, siblings=False):
+    """
+    Return a new profile dict applying ``derived`` on top of ``base``:
+    'Bag-Info' tags and 'BagIt-Profile-Info' are merged key by key, the
+    required manifest and tag file lists are combined, and any other key of
+    ``derived`` replaces that of ``base``. Values not overridden are shared
+    with ``base``, not copied.
+
+    The allowed manifest and tag file lists of ``derived`` keep only the
+    entries ``base`` allows too. With ``siblings``, for combining two
+    profiles extended by the same one, they are instead joined, and dropped
+    where either profile allows anything.
+    """
+    merged = dict(base)
+    for key, value in derived.items():
+        if key == PROFILE_EXTENDS_KEY:
+            continue
+        if key in _ALLOWED_LIST_KEYS:
+            if key not in merged:
+                if not siblings:
+                    merged[key] = value
+            elif siblings:
+                merged[key] = merged[key] + [v for v in value if v not in merged[key]]
+            else:
+                merged[key] = [v for v in value if fnmatch_any(v, merged[key])]
+        elif key not in merged:
+            merged[key] = value
+        elif key == "Bag-Info":
+            bag_info = dict(merged[key])
+            for tag, config in value.items():
+                if tag in bag_info:
+                    tag_config = dict(bag_info[tag])
+                    tag_config.update(config)
+                    config = tag_config
+                bag_info[tag] = config
+            merged[key] = bag_info
+        elif key == "BagIt-Profile-Info":
+            info = dict(merged[key])
+            info.update(value)
+            merged[key] = info
+        elif key in _MERGED_LIST_KEYS:
+            merged[key] = merged[key] + [v for v in value if v not in merged[key]]
+        else:
+            merged[key] = value
+    if siblings:
+        for key in _ALLOWED_LIST_KEYS:
+            if key not in derived:
+                merged.pop(key, None)
+    return merged
+
+
+def resolve_profile(profile, resolver):
+    """
+    Return ``profile`` with the profiles it extends (listed under
+    'BagIt-Profile-Extends', themselves possibly extending others) merged in,
+    parents left to right and ``profile`` last. ``resolver`` maps a reference
+    to a profile dict. A manifest or tag file is allowed if any parent allows
+    it and ``profile`` does too (see merge_profiles()).
+
+    Merged results are cached by the content hashes of the whole ancestry, so
+    profiles sharing ancestors share the merged structures, and loading an
+    unchanged profile again costs only the hashing.
+    """
+    def ancestry(document, seen):
+        references = document.get(PROFILE_EXTENDS_KEY) or []
+        if isinstance(references, basestring):  # pylint: disable=undefined-variable
+            references = [references]
+        parents = []
+        for reference in references:
+            if reference in seen:
+                raise ProfileValidationError(
+                    "Profile <%s> extends itself through %s" % (reference, " -> ".join(seen))
+                )
+            parents.append(ancestry(resolver(reference), seen + (reference,)))
+        key = (profile_hash(document), tuple(parent[0] for parent in parents))
+        return key, document, parents
+
+    def merge(node):
+        key, document, parents = node
+        if key in _merged_profiles:
+            return _merged_profiles[key]
+        merged = merge(parents[0]) if parents else {}
+        for parent in parents[1:]:
+            merged = merge_profiles(merged, merge(parent), siblings=True)
+        merged = merge_profiles(merged, document)
+        _merged_profiles[key] = merged
+        if len(_merged_profiles) > _MERGED_CACHE_SIZE:
+            _merged_profiles.popitem(last=False)
+        return merged
+
+    identifier = profile.get("BagIt-Profile-Info", {}).get("BagIt-Profile-Identifier", "(profile)")
+    return merge(ancestry(profile, (identifier,)))
+
+
+class ProfileCatalog(object):  # pylint: disable=useless-object-inheritance
+    """
+    A local directory of BagIt profile JSON files, indexed by their
+    'BagIt-Profile-Identifier'.
+
+    The index is built once and written to ``index_path`` (by default a hidden
+    file inside the directory), and the directory's mtime next to it. It is
+    reloaded as long as that mtime and the mtimes and sizes of the profile
+    files are unchanged; otherwise only new or modified profile files are
+    re-parsed. An identifier that is not in the index is looked for again
+    the same way before it is reported missing.
+    Profiles are only read from disk when they are first looked up, so no
+    network access is ever needed.
+    """
+
+    index_name = ".bagit-profile-index.json"
+    index_version = 2
+
+    def __init__(self, directory, index_path=None, ignore_baginfo_tag_case=False, **profile_kwargs):
+        self.directory = directory
+        self.index_path = index_path or join(directory, self.index_name)
+        self.ignore_baginfo_tag_case = ignore_baginfo_tag_case
+        # Passed on to each Profile.
+        self.profile_kwargs = profile_kwargs
+        self._profiles = {}
+        self._documents = {}
+        # Held while the index, profiles or documents are filled in, so that
+        # the catalog can be shared by threads.
+        self._lock = threading.RLock()
+        self._index = self._load_index()
+        if self._index is None:
+            self.rebuild()
+
+    def __contains__(self, identifier):
+        return identifier in self._index["identifiers"]
+
+    def __len__(self):
+        return len(self._index["identifiers"])
+
+    def identifiers(self):
+        return list(self._index["identifiers"])
+
+    def _load_index(self):
+        if not isfile(self.index_path):
+            return None
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except ValueError as e:
+            logging.warning("Ignoring unreadable profile index %s: %s", self.index_path, e)
+            return None
+        if index.get("version") != self.index_version or self._stale(index):
+            # Profiles were added, removed, renamed or edited: refresh,
+            # reusing the entries of files that have not changed.
+            self.rebuild(previous=index)
+            return self._index
+        return index
+
+    def _stale(self, index):
+        # Whether the directory or a catalogued file changed since 'index'
+        # was written. Editing a file in place leaves the directory's mtime
+        # alone, so each file is checked too.
+        if self._read_directory_mtime() != [index.get("generation"), getmtime(self.directory)]:
+            return True
+        for filename, entry in index["files"].items():
+            try:
+                st = os.stat(join(self.directory, filename))
+            except OSError:
+                return True
+            if entry[:2] != [st.st_mtime, st.st_size]:
+                return True
+        return False
+
+    def rebuild(self, previous=None):
+        """
+        (Re)build the index. Files whose mtime and size match ``previous`` are
+        not parsed again.
+        """
+        with self._lock:
+            previous_files = previous["files"] if previous else {}
+            files = {}
+            identifiers = {}
+            for filename in sorted(listdir(self.directory)):
+                if not filename.endswith(".json") or filename == basename(self.index_path):
+                    continue
+                path = join(self.directory, filename)
+                st = os.stat(path)
+                entry = previous_files.get(filename)
+                if entry is None or entry[:2] != [st.st_mtime, st.st_size]:
+                    identifier = self._read_identifier(path)
+                    if identifier is None:
+                        continue
+                    entry = [st.st_mtime, st.st_size, identifier]
+                files[filename] = entry
+                identifier = entry[2]
+                if identifier in identifiers:
+                    logging.warning(
+                        "Profile identifier %s is declared by both %s and %s; using %s",
+                        identifier, identifiers[identifier], filename, identifiers[identifier],
+                    )
+                    continue
+                identifiers[identifier] = filename
+            self._index = {
+                "version": self.index_version,
+                # Ties the index to the directory mtime recorded with it.
+                "generation": binascii.hexlify(os.urandom(8)).decode("ascii"),
+                "files": files,
+                "identifiers": identifiers,
+            }
+            self._profiles = {}
+            self._documents = {}
+            self._write_index()
+            return self._index
+
+    @staticmethod
+    def _read_identifier(path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)["BagIt-Profile-Info"]["BagIt-Profile-Identifier"]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning("Skipping %s: not a BagIt profile (%s)", path, e)
+            return None
+
+    def _read_directory_mtime(self):
+        # [index generation, directory mtime] as recorded by _write_index.
+        try:
+            with open(self.index_path + ".mtime", "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_index(self):
+        # The index is replaced atomically, which changes the directory's
+        # mtime. So that mtime is recorded afterwards, in a small file that
+        # is rewritten in place, leaving the directory's mtime alone. A
+        # reader that finds it half-written, or recorded with another index,
+        # only rebuilds the index.
+        directory = os.path.dirname(self.index_path) or "."
+        mtime_path = self.index_path + ".mtime"
+        try:
+            if not isfile(mtime_path):
+                open(mtime_path, "w").close()
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".bagit-profile-index")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._index, f)
+            getattr(os, "replace", os.rename)(tmp_path, self.index_path)
+            with open(mtime_path, "w") as f:
+                json.dump([self._index["generation"], getmtime(self.directory)], f)
+        except (IOError, OSError) as e:
+            logging.warning("Cannot write profile index %s: %s", self.index_path, e)
+
+    def get(self, identifier):
+        """
+        Return the Profile whose 'BagIt-Profile-Identifier' is ``identifier``.
+        """
+        with self._lock:
+            if identifier in self._profiles:
+                return self._profiles[identifier]
+            # Profile fills in defaults, so give it a copy of the document.
+            profile = Profile(
+                identifier, profile=dict(self.load(identifier)), ignore_baginfo_tag_case=self.ignore_baginfo_tag_case,
+                resolver=self.load, **self.profile_kwargs
+            )
+            self._profiles[identifier] = profile
+            if self.profile_kwargs.get("compact"):
+                # Keep only the compact profiles; documents are re-read if needed.
+                self._documents.clear()
+            return profile
+
+    def load(self, identifier):
+        """
+        Return the JSON document of the profile whose 'BagIt-Profile-Identifier'
+        is ``identifier``, as a dict. Used to resolve the profiles that
+        catalogued profiles extend.
+        """
+        with self._lock:
+            if identifier in self._documents:
+                return self._documents[identifier]
+            filename = self._index["identifiers"].get(identifier)
+            if filename is None and self._stale(self._index):
+                self.rebuild(previous=self._index)
+                filename = self._index["identifiers"].get(identifier)
+            if filename is None:
+                raise ProfileValidationError(
+                    "No profile with identifier <%s> in catalog %s" % (identifier, self.directory)
+                )
+            path = join(self.directory, filename)
+            try:
+                with open(path, "r") as f:
+                    profile = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                raise ProfileValidationError("Cannot read profile %s: %s" % (path, e))
+            if profile.get("BagIt-Profile-Info", {}).get("BagIt-Profile-Identifier") != identifier:
+                # Edited in place since the index was built.
+                self.rebuild(previous=self._index)
+                return self.load(identifier)
+            self._documents[identifier] = profile
+            return profile
+
+    def profile_for_bag(self, bag):
+        """
+        Return the Profile named by the bag's 'BagIt-Profile-Identifier' tag.
+        """
+        tag = Profile._baginfo_profile_id_tag  # pylint: disable=protected-access
+        key = tag.lower() if self.ignore_baginfo_tag_case else tag
+        path = join(bag.path, "bag-info.txt")
+        value = None
+        if isinstance(bag, BagFacts):
+            value = bag.tags([key], ignore_case=self.ignore_baginfo_tag_case).get(key)
+        elif isfile(path):
+            value = parse_tag_file(path, tags=[key], ignore_case=self.ignore_baginfo_tag_case,
+                                   encoding=getattr(bag, "encoding", "utf-8")).get(key)
+        if value is None:
+            raise ProfileValidationError("%s: Required '%s' tag is not in bag-info.txt." % (bag, tag))
+        if isinstance(value, list):
+            raise ProfileValidationError(
+                "%s: '%s' occurs %s times in bag-info.txt." % (bag, tag, len(value))
+            )
+        return self.get(value)
+
+
+# Leading bytes of the serialization formats recognised by content:
+# (offset, magic number, MIME type).
+_SERIALIZATION_MAGIC = [
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"PK\x05\x06", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"BZh", "application/x-bzip2"),
+    (0, b"\xfd7zXZ\x00", "application/x-xz"),
+    (0, b"\x28\xb5\x2f\xfd", "application/zstd"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (257, b"ustar", "application/x-tar"),
+]
+
+# Other MIME types in use for the same formats in 'Accept-Serialization'.
+_SERIALIZATION_ALIASES = {
+    "application/zip": ("application/x-zip", "application/x-zip-compressed"),
+    "application/gzip": ("application/x-gzip", "application/tar+gzip", "application/x-gtar"),
+    "application/x-bzip2": ("application/x-bzip",),
+    "application/x-xz": ("application/xz",),
+    "application/zstd": ("application/x-zstd",),
+    "application/x-tar": ("application/tar",),
+}
+
+_SNIFFED_SERIALIZATIONS = set(m for _, _, m in _SERIALIZATION_MAGIC)
+for _aliases in _SERIALIZATION_ALIASES.values():
+    _SNIFFED_SERIALIZATIONS.update(_aliases)
+
+_SNIFF_SIZE = 512
+_SNIFF_CACHE_SIZE = 10000
+_sniff_cache = OrderedDict()
+
+
+def _sniff_header(head):
+    for offset, magic, mtype in _SERIALIZATION_MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return mtype
+    return None
+
+
+def _sniff_compressed_tar(head, mtype):
+    # A tar header inside a gzip or xz stream can be seen after decompressing
+    # just the bytes already read. (bzip2 and zstd need far more input.)
+    try:
+        if mtype == "application/gzip":
+            inner = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, 262)
+        elif mtype == "application/x-xz":
+            import lzma
+
+            inner = lzma.LZMADecompressor().decompress(head, 262)
+        else:
+            return False
+    except Exception:  # pylint: disable=broad-except
+        return False
+    return inner[257:262] == b"ustar"
+
+
+def sniff_serialization(path):
+    """
+    Return the MIME types of the serialized bag at ``path`` from its first few
+    hundred bytes, most specific first, or an empty tuple if the format is not
+    recognised. Results are cached by path, mtime and size, keeping the most
+    recently used.
+    """
+    try:
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size)
+        cached = _sniff_cache.pop(path, None)
+        if cached is not None and cached[0] == key:
+            _sniff_cache[path] = cached
+            return cached[1]
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Missing, or removed since it was listed.
+        return ()
+    try:
+        head = os.read(fd, _SNIFF_SIZE)
+        _count("bytes_read", len(head))
+    finally:
+        os.close(fd)
+    mtype = _sniff_header(head)
+    if mtype is None:
+        mtypes = ()
+    else:
+        mtypes = (mtype,) + _SERIALIZATION_ALIASES.get(mtype, ())
+        # For compatibility with names like .tar.gz, which mimetypes reports
+        # as 'application/x-tar'.
+        if _sniff_compressed_tar(head, mtype):
+            mtypes += ("application/x-tar",)
+
+    _sniff_cache[path] = (key, mtypes)
+    if len(_sniff_cache) > _SNIFF_CACHE_SIZE:
+        _sniff_cache.popitem(last=False)
+    return mtypes
+
+
+def sniff_serializations(paths):
+    """
+    Sniff the serialization format of many files. Returns a dict mapping each
+    path to the result of ``sniff_serialization``.
+    """
+    return dict((path, sniff_serialization(path)) for path in paths)
+
+
 # Return true if any of the pattern fnmatches a file path
 def fnmatch_any(f, pats):
     for pat in pats:
@@ -471,6 +1320,7 @@ def fnmatch_any(f, pats):
 # Find tag files
 def find_tag_files(bag_dir):
     for root, _, basenames in walk(bag_dir):
+        _check_deadline()
         reldir = relpath(root, bag_dir)
         for basename in basenames:
             if fnmatch(reldir, "data*") or (
@@ -492,116 +1342,3325 @@ def find_tag_files(bag_dir):
                 yield fpath
 
 
-def _configure_logging(args):
-    import time
+# Kinds of the entries of a directory listing kept in a MetadataCache.
+_ENTRY_FILE, _ENTRY_DIR, _ENTRY_LINKED_DIR, _ENTRY_OTHER, _ENTRY_BROKEN = "f", "d", "l", "o", "x"
 
-    log_format = "%(asctime)s - %(levelname)s - %(message)s"
-    if args.quiet:
-        args.loglevel = "ERROR"
-    level = logging.getLevelName(args.loglevel)
-    if args.no_logfile:
-        logging.basicConfig(level=level, format=log_format)
-    else:
-        if args.logdir:
-            filename = join(
-                args.log + "/logs", "BagitProfile_" + time.strftime("%y_%m_%d") + ".log"
-            )
+
+def _list_directory(directory):
+    entries = {}
+    for name in listdir(directory):
+        path = join(directory, name)
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            entries[name] = _ENTRY_BROKEN
+            continue
+        if stat.S_ISDIR(mode):
+            entries[name] = _ENTRY_LINKED_DIR if os.path.islink(path) else _ENTRY_DIR
+        elif stat.S_ISREG(mode):
+            entries[name] = _ENTRY_FILE
         else:
-            filename = "BagitProfile%s.log" % time.strftime("%y_%m_%d")
-        logging.basicConfig(filename=filename, level=level, format=log_format)
+            entries[name] = _ENTRY_OTHER
+    return entries
 
 
-def _main():
-    # Command-line version.
-    import bagit
-    from argparse import ArgumentParser
-    from pkg_resources import get_distribution
+class MetadataCache(object):  # pylint: disable=useless-object-inheritance
+    """
+    Persistent cache of directory listings, kept in a SQLite database at
+    ``path`` (best placed on fast local storage), for validating bags on
+    filesystems where each listdir() or stat() is slow.
 
-    parser = ArgumentParser(description="Validate BagIt bags against BagIt profiles")
+    A listing is reused as long as the directory's mtime is unchanged, which
+    costs one stat() instead of a listdir() and a stat() per entry. At most
+    ``max_entries`` listings are kept; the least recently used go first.
+    Directories changed less than ``racy_seconds`` ago are not cached, since
+    a further change within the same mtime tick would go unnoticed.
+    """
 
-    parser.add_argument(
-        "--version",
-        action="version",
-        version="%(prog)s, v" + get_distribution("bagit_profile").version,
-    )
-    parser.add_argument(
-        "--quiet",
-        action="store_true",
-        help="Suppress all output except errors. Default: %(default)s",
-    )
-    parser.add_argument(
-        "-i", "--ignore-baginfo-tag-case",
-        dest="ignore_baginfo_tag_case",
-        action="store_true",
-        help="Ignore capitalization for Bag-Info tag names. Default: %(default)s",
-    )
-    parser.add_argument(
-        "--log", dest="logdir", help="Log directory. Default: %(default)s"
-    )
-    parser.add_argument(
-        "--no-logfile",
-        action="store_true",
-        help="Do not log to a log file. Default: %(default)s",
-    )
-    parser.add_argument(
-        "--loglevel",
-        default="INFO",
-        choices=("DEBUG", "INFO", "ERROR"),
-        help="Log level. Default: %(default)s",
-    )
-    parser.add_argument(
-        "--file", help="Load profile from FILE, not by URL. Default: %(default)s."
-    )
-    parser.add_argument(
-        "--report",
-        action="store_true",
-        help="Print validation report. Default: %(default)s",
-    )
-    parser.add_argument(
-        "--skip",
-        action="append",
-        default=[],
-        help="Skip validation steps. Default: %(default)s",
-        choices=("serialization", "profile"),
-    )
-    parser.add_argument("profile_url", nargs=1)
-    parser.add_argument("bagit_path", nargs=1)
+    def __init__(self, path, max_entries=100000, racy_seconds=2.0, timeout=60):
+        import sqlite3
 
-    args = parser.parse_args()
+        self.path = path
+        self.max_entries = max_entries
+        self.racy_seconds = racy_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS listings (
+                directory TEXT PRIMARY KEY,
+                mtime INTEGER NOT NULL,
+                entries TEXT NOT NULL,
+                used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS listings_used ON listings (used);
+            """
+        )
+        self._size = self._db.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
 
-    profile_url = args.profile_url[0]
-    bagit_path = args.bagit_path[0]
+    def __len__(self):
+        return self._size
 
-    _configure_logging(args)
+    def listdir(self, directory):
+        """
+        Return a dict mapping the names in ``directory`` to their kind: "f"
+        for a file, "d" for a directory, "l" for a symbolic link to a
+        directory, "o" for anything else and "x" for a broken link.
+        """
+        directory = os.path.abspath(directory)
+        st = os.stat(directory)
+        mtime = getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1e9)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT mtime, entries FROM listings WHERE directory = ?", (directory,)
+            ).fetchone()
+            if row is not None and row[0] == mtime:
+                self.hits += 1
+                self._db.execute("UPDATE listings SET used = ? WHERE directory = ?", (now, directory))
+                return json.loads(row[1])
+            self.misses += 1
+        entries = _list_directory(directory)
+        with self._lock:
+            if now - st.st_mtime >= self.racy_seconds:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO listings (directory, mtime, entries, used) VALUES (?, ?, ?, ?)",
+                    (directory, mtime, json.dumps(entries), now),
+                )
+                if row is None:
+                    self._size += 1
+                    if self._size > self.max_entries:
+                        self._evict()
+            elif row is not None:
+                self._db.execute("DELETE FROM listings WHERE directory = ?", (directory,))
+                self._size -= 1
+        return entries
 
-    # Instantiate a profile, supplying its URI.
-    if args.file:
-        with open(args.file, "r") as local_file:
-            profile = Profile(profile_url, profile=local_file.read(),
-                              ignore_baginfo_tag_case=args.ignore_baginfo_tag_case)
-    else:
-        profile = Profile(profile_url, ignore_baginfo_tag_case=args.ignore_baginfo_tag_case)
+    def _evict(self):
+        # Drop a tenth more than needed, so that eviction is not run on
+        # every insertion once the cache is full.
+        excess = self._size - self.max_entries + self.max_entries // 10
+        self._db.execute(
+            "DELETE FROM listings WHERE directory IN "
+            "(SELECT directory FROM listings ORDER BY used LIMIT ?)",
+            (excess,),
+        )
+        self._size = self._db.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
 
-    # Instantiate an existing Bag.
-    bag = bagit.Bag(bagit_path)  # pylint: disable=no-member
+    def close(self):
+        self._db.close()
 
-    # Validate 'Serialization' and 'Accept-Serialization', then perform general validation.
-    if "serialization" not in args.skip:
-        if profile.validate_serialization(bagit_path):
-            print(u"✓ Serialization validates")
-        else:
-            print(u"✗ Serialization does not validate")
-            sys.exit(1)
 
-    # Validate the rest of the profile.
-    if "profile" not in args.skip:
-        if profile.validate(bag):
-            print(u"✓ Validates against %s" % profile_url)
-        else:
-            print(u"✗ Does not validate against %s" % profile_url)
-            if args.report:
-                print(profile.report)
-            sys.exit(2)
+class TagListing(object):  # pylint: disable=useless-object-inheritance
+    """
+    The entries of a bag outside its payload (the directories find_tag_files
+    looks at), listed once, through a MetadataCache if one is given.
+    ``directories`` (relative directory -> name -> kind, as in
+    MetadataCache.listdir) restores a listing taken before, and
+    ``fallback(path)`` answers exists() for paths outside it.
+    """
+
+    def __init__(self, bag_dir, cache=None, directories=None, fallback=None):
+        self.bag_dir = bag_dir
+        self.fallback = fallback or exists
+        self.directories = directories if directories is not None else {}
+        pending = ["."] if directories is None else []
+        listdir_kinds = cache.listdir if cache is not None else _list_directory
+        while pending:
+            reldir = pending.pop()
+            _check_deadline()
+            try:
+                entries = listdir_kinds(bag_dir if reldir == "." else join(bag_dir, reldir))
+            except OSError:
+                # As walk() does, skip directories that cannot be listed.
+                entries = {}
+            self.directories[reldir] = entries
+            for name, kind in entries.items():
+                child = name if reldir == "." else join(reldir, name)
+                if kind == _ENTRY_DIR and not fnmatch(child, "data*"):
+                    pending.append(child)
+
+    def exists(self, name):
+        """Whether ``name``, relative to the bag, exists."""
+        path = os.path.normpath(name)
+        if path == ".":
+            return True
+        reldir, base = split(path)
+        entries = self.directories.get(reldir or ".")
+        if entries is None or os.path.isabs(path) or path.split(os.sep)[0] == "..":
+            # Outside the listed directories.
+            return self.fallback(join(self.bag_dir, name))
+        kind = entries.get(base)
+        if kind is None or kind == _ENTRY_BROKEN:
+            return False
+        return kind in (_ENTRY_DIR, _ENTRY_LINKED_DIR) or not name.endswith("/")
+
+    def tag_files(self):
+        """Yield the same paths as find_tag_files."""
+        for reldir, entries in sorted(self.directories.items()):
+            if fnmatch(reldir, "data*"):
+                continue
+            for name, kind in sorted(entries.items()):
+                if kind != _ENTRY_FILE:
+                    continue
+                if reldir == "." and fnmatch_any(name, ["manifest-*.txt", "bag-info.txt", "tagmanifest-*.txt",
+                                                         "bagit.txt", "fetch.txt"]):
+                    continue
+                yield join(self.bag_dir, name) if reldir == "." else join(self.bag_dir, reldir, name)
+
+
+class BagStorage(object):  # pylint: disable=useless-object-inheritance
+    """
+    Where BagFacts read bags from. A bag is given by the path of its
+    directory, and its files by paths joined to that; what a path means is
+    up to the storage. ``local`` says whether the paths are on the local
+    filesystem, which the checks reading every tag or payload file need.
+    """
+
+    local = False
+
+    def tag_directories(self, bag_path, cache=None):
+        """
+        Return the entries of the bag at ``bag_path`` outside its payload,
+        as TagListing.directories: relative directory -> name -> kind.
+        """
+        raise NotImplementedError
+
+    def read_tag_pairs(self, path, tags=None, ignore_case=False, encoding="utf-8"):
+        """
+        Return the (tag, value) pairs of the tag file at ``path``, as
+        parse_tag_file reads them, or None if there is no such file.
+        """
+        raise NotImplementedError
+
+    def exists(self, path):
+        """Whether there is a file or directory at ``path``."""
+        raise NotImplementedError
+
+    def url(self, bag_path):
+        """How to name the bag at ``bag_path`` in reports."""
+        return bag_path
+
+
+class LocalStorage(BagStorage):
+    """Bags in directories on the local filesystem."""
+
+    local = True
+
+    def tag_directories(self, bag_path, cache=None):
+        return TagListing(bag_path, cache).directories
+
+    def read_tag_pairs(self, path, tags=None, ignore_case=False, encoding="utf-8"):
+        if not exists(path):
+            return None
+        return _read_tag_pairs(path, tags, ignore_case, encoding)
+
+    def exists(self, path):
+        return exists(path)
+
+
+class ObjectStorage(BagStorage):
+    """
+    Bags in the bucket ``bucket`` of an S3-compatible object store at
+    ``endpoint`` (such as "https://s3.us-east-1.amazonaws.com" or
+    "http://localhost:9000"), addressed path-style. The path of a bag is its
+    key prefix. Requests are signed with AWS Signature Version 4 when
+    ``access_key`` and ``secret_key`` are given.
+
+    The tag listing of a bag comes from one ListObjectsV2 listing of its
+    prefix, ``page_size`` keys per request, which skips over the keys under
+    data/. Only bagit.txt and bag-info.txt are read, with ranged GETs of
+    ``read_size`` bytes.
+    """
+
+    def __init__(self, endpoint, bucket, access_key=None, secret_key=None, region="us-east-1", page_size=1000,
+                 read_size=65536, timeout=60):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.page_size = page_size
+        self.read_size = read_size
+        self.timeout = timeout
+
+    @staticmethod
+    def _key(path):
+        return path.replace(os.sep, "/").strip("/")
+
+    def url(self, bag_path):
+        return "s3://%s/%s" % (self.bucket, self._key(bag_path))
+
+    def _request(self, method, key="", query=None, headers=None):
+        # Return the (status, headers, body) of a request for 'key', or of
+        # one for the bucket if 'key' is empty.
+        import hmac
+
+        try:
+            from urllib.error import HTTPError
+            from urllib.parse import quote
+            from urllib.request import Request
+            from urllib.request import urlopen as open_url
+        except ImportError:
+            from urllib import quote  # pylint: disable=no-name-in-module
+            from urllib2 import HTTPError, Request  # pylint: disable=import-error
+            from urllib2 import urlopen as open_url  # pylint: disable=import-error
+
+        path = quote("/%s/%s" % (self.bucket, key) if key else "/%s" % self.bucket, safe="/~")
+        query_string = "&".join(
+            "%s=%s" % (quote(k, safe="~"), quote(v.encode("utf-8"), safe="~")) for k, v in sorted((query or {}).items())
+        )
+        headers = dict(headers or {})
+        if self.access_key and self.secret_key:
+            now = time.gmtime()
+            amz_date = time.strftime("%Y%m%dT%H%M%SZ", now)
+            scope = "%s/%s/s3/aws4_request" % (amz_date[:8], self.region)
+            payload_hash = hashlib.sha256(b"").hexdigest()
+            signed = {
+                "host": self.endpoint.split("://", 1)[-1],
+                "x-amz-content-sha256": payload_hash,
+                "x-amz-date": amz_date,
+            }
+            signed_headers = ";".join(sorted(signed))
+            canonical = "\n".join([
+                method, path, query_string,
+                "".join("%s:%s\n" % (name, signed[name]) for name in sorted(signed)),
+                signed_headers, payload_hash,
+            ])
+            string_to_sign = "\n".join([
+                "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode("utf-8")).hexdigest(),
+            ])
+            key_bytes = ("AWS4" + self.secret_key).encode("utf-8")
+            for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+                key_bytes = hmac.new(key_bytes, part.encode("utf-8"), hashlib.sha256).digest()
+            signature = hmac.new(key_bytes, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+            headers["x-amz-content-sha256"] = payload_hash
+            headers["x-amz-date"] = amz_date
+            headers["Authorization"] = "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s" % (
+                self.access_key, scope, signed_headers, signature)
+        url = self.endpoint + path + ("?" + query_string if query_string else "")
+        request = Request(url, headers=headers)
+        request.get_method = lambda: method
+        _count("object_requests")
+        try:
+            response = open_url(request, timeout=self.timeout)
+        except HTTPError as e:
+            return e.code, e.headers, e.read()
+        try:
+            return response.getcode(), response.info(), response.read()
+        finally:
+            response.close()
+
+    def _list(self, prefix, start_after=None, token=None, max_keys=None):
+        # Return the keys of one ListObjectsV2 page and the token of the next, if any.
+        from xml.etree import ElementTree
+
+        query = {"list-type": "2", "prefix": prefix, "max-keys": str(max_keys or self.page_size)}
+        if token is not None:
+            query["continuation-token"] = token
+        elif start_after is not None:
+            query["start-after"] = start_after
+        status, _, body = self._request("GET", query=query)
+        if status != 200:
+            raise IOError("Cannot list %s: HTTP %s" % (self.url(prefix), status))
+        keys, truncated, next_token = [], False, None
+        for element in ElementTree.fromstring(body).iter():
+            tag = element.tag.split("}")[-1]
+            if tag == "Key":
+                keys.append(element.text)
+            elif tag == "IsTruncated":
+                truncated = element.text == "true"
+            elif tag == "NextContinuationToken":
+                next_token = element.text
+        return keys, next_token if truncated else None
+
+    def tag_directories(self, bag_path, cache=None):
+        prefix = self._key(bag_path) + "/"
+        directories = {".": {}}
+        token = start_after = None
+        while True:
+            _check_deadline()
+            keys, token = self._list(prefix, start_after, token)
+            skip_payload = False
+            for key in keys:
+                parts = key[len(prefix):].split("/")
+                if len(parts) > 1 and fnmatch(parts[0], "data*"):
+                    # As TagListing does, list payload directories but not their contents.
+                    directories["."][parts[0]] = _ENTRY_DIR
+                    if parts[0] == "data" and start_after is None:
+                        skip_payload = True
+                        break
+                    continue
+                reldir = "."
+                for part in parts[:-1]:
+                    directories[reldir][part] = _ENTRY_DIR
+                    reldir = part if reldir == "." else join(reldir, part)
+                    directories.setdefault(reldir, {})
+                if parts[-1]:
+                    directories[reldir][parts[-1]] = _ENTRY_FILE
+            if skip_payload:
+                # Carry on after the last key under data/: no valid UTF-8 key
+                # sorts after this one.
+                start_after, token = prefix + u"data/\U0010ffff", None
+                continue
+            if token is None:
+                return directories
+
+    def read(self, path):
+        """Return the content of the object at ``path``, or None if there is none."""
+        key = self._key(path)
+        chunks = []
+        offset = 0
+        while True:
+            _check_deadline()
+            status, headers, body = self._request(
+                "GET", key, headers={"Range": "bytes=%d-%d" % (offset, offset + self.read_size - 1)})
+            if status == 404:
+                return None
+            if status == 416:
+                # An empty object, or one ending at a chunk boundary.
+                break
+            if status not in (200, 206):
+                raise IOError("Cannot read %s: HTTP %s" % (self.url(path), status))
+            chunks.append(body)
+            offset += len(body)
+            if status == 200:
+                break
+            total = (headers.get("Content-Range") or "").rpartition("/")[2]
+            if not total.isdigit() or offset >= int(total) or not body:
+                break
+        return b"".join(chunks)
+
+    def read_tag_pairs(self, path, tags=None, ignore_case=False, encoding="utf-8"):
+        data = self.read(path)
+        if data is None:
+            return None
+        return _parse_tag_pairs(data, self.url(path), tags, ignore_case, encoding)
+
+    def exists(self, path):
+        key = self._key(path)
+        if self._request("HEAD", key)[0] == 200:
+            return True
+        # A "directory" exists if any key is under it.
+        return bool(self._list(key + "/", max_keys=1)[0])
+
+
+class _ArchiveStream(object):  # pylint: disable=useless-object-inheritance
+    # Reader of the tar stream inside an archive, from a restart point
+    # [compressed offset, uncompressed offset]. Each gzip member or xz stream
+    # starts afresh, so the starts of those met are noted in 'restarts'.
+
+    def __init__(self, f, compression, restart):
+        self.f = f
+        self.compression = compression
+        self.position = restart[1]
+        self.restarts = [list(restart)]
+        self._offset = restart[0]
+        self._buffer = b""
+        self._decompressor = None
+        self._done = False
+        f.seek(restart[0])
+
+    def _new_decompressor(self):
+        if self.compression == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        import lzma
+
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+    @staticmethod
+    def _ended(decompressor):
+        # Python 2's zlib has no 'eof'; data read past the end of a member is
+        # left in unused_data there, which is when the next one is needed.
+        eof = getattr(decompressor, "eof", None)
+        return bool(decompressor.unused_data) if eof is None else eof
+
+    def _fill(self, wanted):
+        while len(self._buffer) < wanted and not self._done:
+            _check_deadline()
+            if self.compression is None:
+                chunk = self.f.read(max(wanted - len(self._buffer), 65536))
+                self._done = not chunk
+                self._buffer += chunk
+                continue
+            pending = b""
+            if self._decompressor is not None and self._ended(self._decompressor):
+                # The next member or stream begins after the end of this one.
+                pending = self._decompressor.unused_data
+                self._decompressor = None
+                self.restarts.append([self._offset - len(pending), self.position + len(self._buffer)])
+            if not pending:
+                pending = self.f.read(65536)
+                self._offset += len(pending)
+                if not pending:
+                    self._done = True
+                    continue
+            if self._decompressor is None:
+                if not pending.strip(b"\0"):
+                    # Padding after the last member.
+                    self.restarts.pop()
+                    continue
+                self._decompressor = self._new_decompressor()
+            data = self._decompressor.decompress(pending)
+            _count("bytes_decompressed", len(data))
+            self._buffer += data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self._done:
+                self._fill(len(self._buffer) + (1 << 20))
+            size = len(self._buffer)
+        else:
+            self._fill(size)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.position += len(data)
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, 1 << 20))
+            if not data:
+                break
+            size -= len(data)
+
+
+class ArchiveStorage(BagStorage):
+    """
+    A bag serialized as a tar archive, plain or compressed with gzip or xz,
+    at ``archive_path``. The bag's path in it is ``bag_path``.
+
+    The first time the archive is read it is read through once, and a small
+    sidecar index is written to ``index_path`` (by default, next to the
+    archive): the offsets of all the members outside the payload, and the
+    points decompression can restart from, which are the start of each
+    gzip member or xz stream. The index holds while the archive's size and
+    mtime are unchanged. Later reads then seek to the restart point before
+    each tag member, and decompress no further than its end. Archives made
+    of a single gzip member or xz stream can only be restarted from the
+    start (Python's zlib and lzma cannot resume within one), so split the
+    tag files into their own member when writing an archive to have them
+    read quickly.
+    """
+
+    def __init__(self, archive_path, index_path=None):
+        self.archive_path = archive_path
+        self.index_path = index_path or archive_path + ".bagit-index"
+        self._index = None
+
+    def url(self, bag_path):
+        return self.archive_path
+
+    @property
+    def bag_path(self):
+        """The path of the bag within the archive."""
+        return self.index()["bag"]
+
+    def index(self):
+        """Return the archive's index, reading or building it if need be."""
+        if self._index is None:
+            st = os.stat(self.archive_path)
+            key = [st.st_size, getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1e9)]
+            try:
+                with open(self.index_path, "r") as f:
+                    index = json.load(f)
+                if index.get("key") != key:
+                    index = None
+            except (IOError, OSError, ValueError):
+                index = None
+            if index is None:
+                index = self._build_index(key)
+            self._index = index
+        return self._index
+
+    def _build_index(self, key):
+        import tarfile
+
+        with open(self.archive_path, "rb") as f:
+            head = f.read(_SNIFF_SIZE)
+            mtype = _sniff_header(head)
+            compression = {"application/gzip": "gzip", "application/x-xz": "xz"}.get(mtype)
+            if compression is None and mtype != "application/x-tar":
+                raise ProfileValidationError("%s: Not a tar archive, or one compressed with gzip or xz."
+                                             % self.archive_path)
+            stream = _ArchiveStream(f, compression, [0, 0])
+            members = {}
+            payload_dirs = set()
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                for member in tar:
+                    name = os.path.normpath(member.name).lstrip(os.sep)
+                    members[name] = [member.offset_data, member.size, _ENTRY_DIR if member.isdir() else _ENTRY_FILE]
+        # The bag is the archive's one top-level directory, if it has one.
+        tops = set(name.split(os.sep)[0] for name in members)
+        bag = tops.pop() if len(tops) == 1 and any(os.sep in name for name in members) else "."
+        kept = {}
+        for name, entry in members.items():
+            rel = name if bag == "." else os.path.relpath(name, bag)
+            first = rel.split(os.sep)[0]
+            if fnmatch(first, "data*") and rel != first:
+                # Keep payload directories, but not their contents.
+                payload_dirs.add(first)
+                continue
+            kept[name] = entry
+        for first in payload_dirs:
+            kept.setdefault(first if bag == "." else join(bag, first), [0, 0, _ENTRY_DIR])
+        index = {
+            "key": key,
+            "compression": compression,
+            "bag": bag,
+            "restarts": stream.restarts,
+            "members": kept,
+        }
+        directory = os.path.dirname(self.index_path) or "."
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".bagit-profile-archive-index")
+            with os.fdopen(fd, "w") as out:
+                json.dump(index, out)
+            getattr(os, "replace", os.rename)(tmp_path, self.index_path)
+        except (IOError, OSError) as e:
+            logging.warning("Cannot write archive index %s: %s", self.index_path, e)
+        return index
+
+    def _member(self, path):
+        return self.index()["members"].get(os.path.normpath(path).lstrip(os.sep))
+
+    def tag_directories(self, bag_path, cache=None):
+        bag = os.path.normpath(bag_path)
+        directories = {".": {}}
+        for name, entry in self.index()["members"].items():
+            rel = name if bag == "." else os.path.relpath(name, bag)
+            if rel == "." or rel.startswith(os.pardir):
+                continue
+            parts = rel.split(os.sep)
+            reldir = "."
+            for part in parts[:-1]:
+                directories[reldir][part] = _ENTRY_DIR
+                reldir = part if reldir == "." else join(reldir, part)
+                directories.setdefault(reldir, {})
+            directories[reldir][parts[-1]] = entry[2]
+            if entry[2] == _ENTRY_DIR and not fnmatch(parts[0], "data*"):
+                directories.setdefault(rel, {})
+        return directories
+
+    def read(self, path):
+        """Return the content of the member at ``path``, or None if there is none."""
+        entry = self._member(path)
+        if entry is None or entry[2] != _ENTRY_FILE:
+            return None
+        index = self.index()
+        offset, size = entry[0], entry[1]
+        restart = max((r for r in index["restarts"] if r[1] <= offset), key=lambda r: r[1])
+        with open(self.archive_path, "rb") as f:
+            if index["compression"] is None:
+                f.seek(offset)
+                return f.read(size)
+            stream = _ArchiveStream(f, index["compression"], restart)
+            stream.skip(offset - restart[1])
+            return stream.read(size)
+
+    def read_tag_pairs(self, path, tags=None, ignore_case=False, encoding="utf-8"):
+        data = self.read(path)
+        if data is None:
+            return None
+        return _parse_tag_pairs(data, "%s:%s" % (self.archive_path, path), tags, ignore_case, encoding)
+
+    def exists(self, path):
+        return self._member(path) is not None
+
+
+class Rule(object):  # pylint: disable=useless-object-inheritance
+    """
+    A check run by Profile.validate. ``check(profile, facts)`` raises
+    ProfileValidationError if the bag described by the BagFacts ``facts``
+    breaks the rule.
+
+    ``needs`` names the facts the rule reads (see register_fact), and
+    ``cost`` estimates its own run time relative to the other rules, not
+    counting the facts: Profile.validate runs the rule that is cheapest,
+    with the facts it still has to fetch, first. ``min_version`` is the
+    BagIt-Profile-Version that introduced the rule, if any, and
+    ``applies(profile)``, if given, says whether the rule applies to a
+    Profile at all. ``profile_keys`` are the profile keys the outcome of
+    the rule depends on ("url" standing for the Profile's URL), which
+    profile_diff() goes by; None means any. Rules that read the payload
+    must say so with ``reads_payload``, as a ResultCache only notices
+    changes to the tag files.
+    """
+
+    def __init__(self, name, check, needs=(), cost=1.0, description=None, min_version=None, applies=None,
+                 profile_keys=None, reads_payload=False):
+        self.name = name
+        self.check = check
+        self.needs = tuple(needs)
+        self.cost = cost
+        self.description = description or name
+        self.min_version = min_version
+        self.applies = applies
+        self.profile_keys = None if profile_keys is None else tuple(profile_keys)
+        self.reads_payload = reads_payload
+
+    def __repr__(self):
+        return "Rule(%r)" % self.name
+
+
+# Fact name -> (fetch, cost), and rule name -> Rule, in registration order.
+_fact_registry = OrderedDict()
+_rule_registry = OrderedDict()
+
+
+def register_fact(name, fetch, cost=1.0):
+    """
+    Make ``fetch(facts)`` the way fact ``name`` of a bag is found, where
+    ``facts`` is the bag's BagFacts (with its ``path``, and its ``bag`` if
+    there is one). ``cost`` estimates the time it takes, relative to the
+    other facts and rules. Each fact is fetched at most once per bag.
+    """
+    _fact_registry[name] = (fetch, cost)
+
+
+def register_rule(rule):
+    """
+    Add the Rule ``rule`` to those Profile.validate runs by default,
+    replacing any rule of the same name, and return it. Errors are
+    reported in the order rules are registered.
+    """
+    for name in rule.needs:
+        if name not in _fact_registry:
+            raise ValueError("Rule %s needs unknown fact %s" % (rule.name, name))
+    _rule_registry[rule.name] = rule
+    return rule
+
+
+def unregister_fact(name):
+    """Remove fact ``name`` from the registry."""
+    needed = [rule.name for rule in _rule_registry.values() if name in rule.needs]
+    if needed:
+        raise ValueError("Fact %s is needed by rules %s" % (name, ", ".join(needed)))
+    del _fact_registry[name]
+
+
+def unregister_rule(name):
+    """Remove the rule called ``name`` from the registry."""
+    del _rule_registry[name]
+
+
+def registered_rules():
+    """Return the registered Rules, in the order they were registered."""
+    return list(_rule_registry.values())
+
+
+class BagFacts(object):  # pylint: disable=useless-object-inheritance
+    """
+    The facts about a bag that rules check (see register_fact), each
+    fetched when a rule first needs it and then kept. They are fetched from
+    ``bag``, a bagit Bag, or else from the bag at ``path`` in ``storage``
+    (a BagStorage; by default, the local filesystem), listing its
+    directories through the MetadataCache ``cache`` if given.
+
+    ``values`` (fact name -> value) supplies facts fetched before, as
+    from_dict() does: a bag's stored facts can be validated against any
+    profile without reading the bag again, apart from tag fixity, payload
+    completeness and facts not stored. Pass them to Profile.validate, or to
+    a check method, in place of the Bag. describe() gives the facts of a
+    bag that has not been written yet.
+    """
+
+    def __init__(self, bag=None, cache=None, path=None, name=None, encoding=None, values=None, storage=None):
+        self.bag = bag
+        self.path = path if bag is None else bag.path
+        self.storage = storage if storage is not None else LocalStorage()
+        if name is None:
+            name = str(bag) if bag is not None else self.storage.url(self.path)
+        self.name = name
+        self.encoding = encoding or getattr(bag, "encoding", None) or "utf-8"
+        self.cache = cache
+        self.values = dict(values or {})
+        self._listing = None
+        # Whether the bag exists only as a description (see describe()).
+        self.described = False
+
+    @classmethod
+    def describe(cls, path, bag_info, bagit_version="1.0", manifests=("sha256",), tag_manifests=(),
+                 tag_files=(), fetch=False, encoding="utf-8"):
+        """
+        Return the facts of a bag to be written at ``path``, so that it can
+        be validated before anything is written: validating them never
+        touches the disk.
+
+        ``bag_info`` holds the bag-info.txt tags, as a dict of tag -> value
+        (or list of values, for a repeated tag) or as (tag, value) pairs; None
+        means there is no bag-info.txt. ``manifests`` and ``tag_manifests``
+        are the algorithms of the payload and tag manifests, ``tag_files``
+        the paths, relative to the bag, of tag files other than bagit.txt,
+        bag-info.txt, fetch.txt and the manifests, and ``fetch`` whether
+        there is a fetch.txt. Tag fixity and payload completeness cannot be
+        checked without the files.
+        """
+        if isinstance(bag_info, Mapping):
+            pairs = []
+            for tag, value in bag_info.items():
+                for v in value if isinstance(value, (list, tuple)) else [value]:
+                    pairs.append((tag, v))
+        else:
+            pairs = None if bag_info is None else [(tag, value) for tag, value in bag_info]
+        directories = {".": {"bagit.txt": _ENTRY_FILE, "data": _ENTRY_DIR}}
+        names = ["manifest-%s.txt" % alg for alg in manifests]
+        names.extend("tagmanifest-%s.txt" % alg for alg in tag_manifests)
+        names.extend(tag_files)
+        if pairs is not None:
+            names.append("bag-info.txt")
+        if fetch:
+            names.append("fetch.txt")
+        for name in names:
+            reldir = "."
+            parts = os.path.normpath(name).split(os.sep)
+            for part in parts[:-1]:
+                directories[reldir][part] = _ENTRY_DIR
+                reldir = part if reldir == "." else join(reldir, part)
+                directories.setdefault(reldir, {})
+            directories[reldir][parts[-1]] = _ENTRY_FILE
+        facts = cls(path=path, encoding=encoding, values={
+            "manifests": {"payload": list(manifests), "tag": list(tag_manifests)},
+            "bag_info": None if pairs is None else {"pairs": pairs},
+            "bagit_version": {"version": bagit_version},
+            "tag_listing": directories,
+        })
+        facts.described = True
+        return facts
+
+    @classmethod
+    def from_bag(cls, bag, cache=None):
+        """Gather all the built-in facts of ``bag``, a bagit Bag."""
+        facts = cls(bag, cache)
+        for name in _BUILTIN_FACTS:
+            facts.fact(name)
+        return facts
+
+    def fact(self, name):
+        """Return fact ``name`` of the bag, fetching it the first time."""
+        try:
+            return self.values[name]
+        except KeyError:
+            pass
+        if self.described:
+            raise ValueError("%s: fact %s is not in the bag's description" % (self, name))
+        fetch = _fact_registry[name][0]
+        with _timing("fact " + name):
+            value = self.values[name] = fetch(self)
+        return value
+
+    def fetched(self, name):
+        """Whether fact ``name`` has been fetched."""
+        return name in self.values
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def listing(self):
+        if self._listing is None:
+            # A described bag has nothing outside its description.
+            fallback = (lambda path: False) if self.described else self.storage.exists
+            self._listing = TagListing(self.path, directories=self.fact("tag_listing"), fallback=fallback)
+        return self._listing
+
+    def manifest_files(self):
+        return [join(self.path, "manifest-%s.txt" % alg) for alg in self.fact("manifests")["payload"]]
+
+    def tagmanifest_files(self):
+        return [join(self.path, "tagmanifest-%s.txt" % alg) for alg in self.fact("manifests")["tag"]]
+
+    def tags(self, tags, ignore_case=False):
+        """Return bag-info.txt's ``tags`` as parse_tag_file would."""
+        bag_info = self.fact("bag_info") or {"pairs": []}
+        if "error" in bag_info:
+            raise ProfileValidationError(bag_info["error"])
+        if ignore_case:
+            wanted = set(t.lower() for t in tags)
+            pairs = [(n.encode(self.encoding).lower().decode(self.encoding), v) for n, v in bag_info["pairs"]]
+        else:
+            wanted = set(tags)
+            pairs = bag_info["pairs"]
+        return _tag_dict((n, v) for n, v in pairs if n in wanted)
+
+    def to_dict(self):
+        """Return the bag's built-in facts, fetching any not yet fetched, for from_dict()."""
+        for name in _BUILTIN_FACTS:
+            self.fact(name)
+        return {
+            "path": self.path,
+            "name": self.name,
+            "encoding": self.encoding,
+            "values": dict((name, self.values[name]) for name in _BUILTIN_FACTS),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(path=data["path"], name=data["name"], encoding=data["encoding"], values=data["values"])
+
+
+def _fetch_bag_info(facts):
+    # bag-info.txt as (tag, value) pairs, or None if there is none.
+    try:
+        pairs = facts.storage.read_tag_pairs(join(facts.path, "bag-info.txt"), encoding=facts.encoding)
+    except ProfileValidationError as e:
+        return {"error": e.value}
+    return None if pairs is None else {"pairs": pairs}
+
+
+def _fetch_bagit_version(facts):
+    try:
+        pairs = facts.storage.read_tag_pairs(join(facts.path, "bagit.txt"), tags=["BagIt-Version"])
+    except ProfileValidationError as e:
+        return {"error": e.value}
+    return {"version": _tag_dict(pairs or []).get("BagIt-Version")}
+
+
+def _fetch_manifests(facts):
+    # Algorithms of the payload and tag manifests; a Bag has found them already.
+    if facts.bag is not None:
+        payload, tag = facts.bag.manifest_files(), facts.bag.tagmanifest_files()
+    else:
+        root = facts.fact("tag_listing")["."]
+        names = sorted(name for name, kind in root.items() if kind == _ENTRY_FILE)
+        payload = [n for n in names if fnmatch(n, "manifest-*.txt")]
+        tag = [n for n in names if fnmatch(n, "tagmanifest-*.txt")]
+    return {
+        "payload": list(Profile.manifest_algorithms(payload)),
+        "tag": list(Profile.manifest_algorithms(tag)),
+    }
+
+
+def _fetch_tag_listing(facts):
+    return facts.storage.tag_directories(facts.path, facts.cache)
+
+
+register_fact("manifests", _fetch_manifests, cost=0.1)
+register_fact("bag_info", _fetch_bag_info, cost=1.0)
+register_fact("bagit_version", _fetch_bagit_version, cost=1.0)
+register_fact("tag_listing", _fetch_tag_listing, cost=2.0)
+
+# The facts BagFacts.to_dict() stores.
+_BUILTIN_FACTS = ("manifests", "bag_info", "bagit_version", "tag_listing")
+
+
+def _method_rule(name, needs, cost, description, min_version=None, applies=None, profile_keys=None,
+                 reads_payload=False):
+    # A Rule running the Profile method 'name', looked up on each Profile so
+    # that subclasses can override it. Overrides are passed the bagit Bag
+    # being validated, when there is one, as they were before rules.
+    base = getattr(Profile, name)
+    base = getattr(base, "__func__", base)
+
+    def check(profile, facts):
+        method = getattr(profile, name)
+        if facts.bag is not None and getattr(method, "__func__", method) is not base:
+            return method(facts.bag)
+        return method(facts)
+
+    return Rule(name, check, needs=needs, cost=cost, description=description, min_version=min_version,
+                applies=applies, profile_keys=profile_keys, reads_payload=reads_payload)
+
+
+for _rule in (
+    _method_rule("validate_bag_info", ("bag_info",), 1.0, "Error in bag-info.txt",
+                 profile_keys=("Bag-Info", "url")),
+    _method_rule("validate_manifests_required", ("tag_listing",), 0.1, "Required manifests not found",
+                 profile_keys=("Manifests-Required",)),
+    _method_rule("validate_tag_manifests_required", ("tag_listing",), 0.1, "Required tag manifests not found",
+                 profile_keys=("Tag-Manifests-Required",)),
+    _method_rule("validate_payload_manifests_allowed", ("manifests",), 0.1, "Disallowed payload manifests present",
+                 min_version=(1, 3, 0), profile_keys=("Manifests-Required", "Manifests-Allowed")),
+    _method_rule("validate_tag_manifests_allowed", ("manifests",), 0.1, "Disallowed tag manifests present",
+                 min_version=(1, 3, 0), profile_keys=("Tag-Manifests-Required", "Tag-Manifests-Allowed")),
+    _method_rule("validate_tag_files_required", ("tag_listing",), 0.1, "Required tag files not found",
+                 profile_keys=("Tag-Files-Required",)),
+    _method_rule("validate_allow_fetch", ("tag_listing",), 0.1, "fetch.txt is present but is not allowed",
+                 profile_keys=("Allow-Fetch.txt",)),
+    _method_rule("validate_accept_bagit_version", ("bagit_version",), 0.1, "Required BagIt version not found",
+                 profile_keys=("Accept-BagIt-Version",)),
+    _method_rule("validate_tag_files_allowed", ("tag_listing",), 0.5, "Tag files not allowed",
+                 min_version=(1, 2, 0), profile_keys=("Tag-Files-Required", "Tag-Files-Allowed")),
+    # These read the tag files, or the whole payload, themselves.
+    _method_rule("validate_tag_fixity", (), 50.0, "Tag manifest fixity check failed",
+                 applies=lambda profile: profile.tag_fixity, profile_keys=()),
+    _method_rule("validate_payload_completeness", (), 100.0, "Payload manifests incomplete",
+                 applies=lambda profile: profile.payload_completeness, profile_keys=(), reads_payload=True),
+    # Whether the URLs can be reached changes with no change to the bag, so
+    # this too is never cached.
+    _method_rule("validate_fetch", ("tag_listing",), 200.0, "fetch.txt entries are not valid",
+                 applies=lambda profile: profile.fetch_entries, profile_keys=("Allow-Fetch.txt",),
+                 reads_payload=True),
+):
+    register_rule(_rule)
+del _rule
+
+
+# Tag files at most this large are hashed by bag_fingerprint(); larger ones
+# (payload manifests of big bags, mostly) are fingerprinted by their stat alone.
+_FINGERPRINT_CONTENT_SIZE = 64 * 1024
+
+
+def bag_fingerprint(path, content_size=_FINGERPRINT_CONTENT_SIZE):
+    """
+    Return a fingerprint of the tag-level files of the bag at ``path``
+    (bagit.txt, bag-info.txt, fetch.txt, the manifests, tag manifests and
+    other tag files), which changes whenever any of them does.
+
+    It is a hash of the name, size, mtime, ctime and inode of every file
+    outside the payload directory, and of the content of those of at most
+    ``content_size`` bytes, so that edits leaving the size and timestamps
+    alone are caught too. Each directory is listed with one scandir() call
+    and the payload directory is never entered, so the cost does not grow
+    with the payload.
+    """
+    digest = hashlib.sha256()
+    pending = [""]
+    while pending:
+        reldir = pending.pop()
+        directory = join(path, reldir) if reldir else path
+        for name, is_dir, st in _stat_directory(directory):
+            if is_dir:
+                if not fnmatch(reldir + name, "data*"):
+                    pending.append(reldir + name + "/")
+                continue
+            entry = [
+                reldir + name,
+                st.st_size,
+                getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1e9),
+                getattr(st, "st_ctime_ns", None) or int(st.st_ctime * 1e9),
+                st.st_ino,
+            ]
+            if stat.S_ISREG(st.st_mode) and st.st_size <= content_size:
+                with open(join(directory, name), "rb") as f:
+                    entry.append(hashlib.sha256(f.read(content_size + 1)).hexdigest())
+            digest.update(json.dumps(entry).encode("ascii") + b"\n")
+    return digest.hexdigest()
+
+
+def _stat_directory(directory):
+    # List directory as sorted (name, is a directory (not a link to one),
+    # lstat result or None for directories) triples. With scandir the kind
+    # of each entry comes with the listing, so directories cost no stat().
+    if hasattr(os, "scandir"):
+        entries = []
+        for e in os.scandir(directory):
+            is_dir = e.is_dir(follow_symlinks=False)
+            entries.append((e.name, is_dir, None if is_dir else e.stat(follow_symlinks=False)))
+        return sorted(entries, key=lambda e: e[0])
+    entries = []
+    for name in sorted(listdir(directory)):
+        st = os.lstat(join(directory, name))
+        is_dir = stat.S_ISDIR(st.st_mode)
+        entries.append((name, is_dir, None if is_dir else st))
+    return entries
+
+
+class ResultCache(object):  # pylint: disable=useless-object-inheritance
+    """
+    Validation reports shared by every process using the SQLite database at
+    ``path``. One report is kept per profile and bag, and is only returned
+    while the files of the bag outside its payload are unchanged.
+
+    With ``facts``, the BagFacts of each bag validated and the outcome of
+    each check are stored too, so that revalidate() can re-check the bags
+    against a new revision of a profile without reading them.
+    """
+
+    def __init__(self, path, timeout=60, facts=False):
+        import sqlite3
+
+        self.path = path
+        self.facts = facts
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                profile TEXT NOT NULL,
+                path TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                report TEXT NOT NULL,
+                validated REAL NOT NULL,
+                PRIMARY KEY (profile, path)
+            );
+            CREATE TABLE IF NOT EXISTS facts (
+                path TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                facts TEXT NOT NULL
+            );
+            """
+        )
+
+    def get(self, profile_key, path, fingerprint):
+        """
+        Return the ProfileValidationReport cached for ``path`` with
+        ``fingerprint``, or None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT report FROM results WHERE profile = ? AND path = ? AND fingerprint = ?",
+                (profile_key, path, fingerprint),
+            ).fetchone()
+        if row is None:
+            return None
+        return ProfileValidationReport.from_dict(json.loads(row[0]))
+
+    def put(self, profile_key, path, fingerprint, report, checks=None, facts=None):
+        """
+        Store ``report`` for ``path`` with ``fingerprint``, along with the
+        outcome of each check (a dict of check name -> error message or
+        None) and the bag's BagFacts, if given.
+        """
+        data = report.to_dict()
+        if checks is not None:
+            data["checks"] = list(checks.items())
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (profile, path, fingerprint, report, validated) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (profile_key, path, fingerprint, json.dumps(data), time.time()),
+                )
+                if facts is not None:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO facts (path, fingerprint, facts) VALUES (?, ?, ?)",
+                        (path, fingerprint, json.dumps(facts.to_dict())),
+                    )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def entries(self, profile_key):
+        """
+        Yield ``(path, fingerprint, checks)`` for each bag with a report for
+        ``profile_key``, ``checks`` being the stored check outcomes or None.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path, fingerprint, report FROM results WHERE profile = ? ORDER BY path", (profile_key,)
+            ).fetchall()
+        for path, fingerprint, data in rows:
+            checks = json.loads(data).get("checks")
+            yield path, fingerprint, OrderedDict(checks) if checks is not None else None
+
+    def bag_facts(self, path, fingerprint):
+        """Return the BagFacts stored for ``path`` with ``fingerprint``, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT facts FROM facts WHERE path = ? AND fingerprint = ?", (path, fingerprint)
+            ).fetchone()
+        return None if row is None else BagFacts.from_dict(json.loads(row[0]))
+
+    def close(self):
+        self._db.close()
+
+
+# Profile keys validate_serialization depends on.
+_SERIALIZATION_KEYS = ("Serialization", "Accept-Serialization")
+
+
+def profile_diff(old, new):
+    """
+    Return the set of names of the rules of Profile.validate (see
+    register_rule), and of validate_serialization, whose outcome for some
+    bag may differ between the Profiles ``old`` and ``new``.
+    """
+    # pylint: disable=protected-access
+    old_rules = dict((rule.name, rule) for rule in old._rules())
+    new_rules = dict((rule.name, rule) for rule in new._rules())
+    checks = set(old_rules) | set(new_rules)
+    checks.add("validate_serialization")
+    options = ("ignore_baginfo_tag_case", "profile_version_info", "fail_fast")
+    if any(getattr(old, option) != getattr(new, option) for option in options):
+        # Changes what every rule does, or which rules run.
+        return checks
+    # Rules run for only one of the profiles.
+    affected = set(old_rules) ^ set(new_rules)
+    changed = set()
+    if old.url != new.url:
+        changed.add("url")
+    before, after = _canonical(old.profile), _canonical(new.profile)
+    for key in set(before) | set(after):
+        if before.get(key) != after.get(key):
+            changed.add(key)
+    if changed & set(_SERIALIZATION_KEYS):
+        affected.add("validate_serialization")
+    for name, rule in new_rules.items():
+        if changed and (rule.profile_keys is None or changed & set(rule.profile_keys)):
+            affected.add(name)
+    return affected
+
+
+def revalidate(old, new, cache, verify=False):
+    """
+    Yield ``(path, report)`` for every bag with a report for the Profile
+    ``old`` in the ResultCache ``cache``, checked against the Profile
+    ``new``, and store the reports for ``new``.
+
+    Only the rules profile_diff() finds affected are run again, against
+    the BagFacts stored for each bag, so the bags are not read (unless a
+    rule needs a fact that is not stored); the other outcomes are carried
+    over. Bags without stored facts are validated in full, as are, with
+    ``verify``, bags whose tag files have changed since (which costs a
+    directory walk per bag to find out). Serialization is not cached, so
+    it is not checked either.
+    """
+    # pylint: disable=protected-access
+    affected = profile_diff(old, new)
+    new_key = new._profile_key()
+    full = copy.copy(new)
+    full.result_cache = cache
+    for path, fingerprint, checks in list(cache.entries(old._profile_key())):
+        facts = cache.bag_facts(path, fingerprint) if checks is not None else None
+        if facts is not None and verify:
+            try:
+                current = bag_fingerprint(path)
+            except OSError:
+                current = None
+            if current != fingerprint:
+                facts = None
+        if facts is None:
+            yield path, validate_bag_path(full, path, skip=("serialization",))
+            continue
+        rules = new._rules()
+        rerun = new._run_rules(facts, [rule for rule in rules if rule.name in affected or rule.name not in checks])
+        report = ProfileValidationReport()
+        outcomes = OrderedDict()
+        for rule in rules:
+            if rule.name in rerun:
+                error = rerun[rule.name]
+                outcomes[rule.name] = None if error is None else error.value
+            elif rule.name in checks and rule.name not in affected:
+                outcomes[rule.name] = checks[rule.name]
+            else:
+                # Skipped for the profile version, or after an error with fail_fast.
+                continue
+            if outcomes[rule.name] is not None:
+                report.errors.append(ProfileValidationError(outcomes[rule.name]))
+        cache.put(new_key, path, fingerprint, report, checks=outcomes)
+        yield path, report
+
+
+# Per-thread time (from time.time()) past which validation is abandoned.
+_deadlines = threading.local()
+
+
+def _check_deadline():
+    until = getattr(_deadlines, "until", None)
+    if until is not None and time.time() > until:
+        raise ValidationTimeout()
+
+
+def _timeout_error(path, deadline):
+    return ProfileValidationError("%s: Validation did not finish within %s seconds." % (path, deadline))
+
+
+def _tag_file_encoding(path):
+    # The Tag-File-Character-Encoding declared in the bagit.txt of the bag
+    # directory at 'path', or None.
+    return parse_tag_file(join(path, "bagit.txt"), tags=["Tag-File-Character-Encoding"]).get(
+        "Tag-File-Character-Encoding"
+    )
+
+
+def _local_bag(path, profile):
+    # The BagFacts of the bag directory at 'path', listed through the
+    # metadata cache of 'profile' (a Profile or ProfileCatalog). Unlike a
+    # bagit Bag, they only read the parts of the tag files that the checks
+    # need.
+    if not isfile(join(path, "bagit.txt")):
+        raise ProfileValidationError("%s: Expected bagit.txt does not exist." % path)
+    encoding = _tag_file_encoding(path)
+    if isinstance(profile, ProfileCatalog):
+        cache = profile.profile_kwargs.get("metadata_cache")
+    else:
+        cache = profile.metadata_cache
+    return BagFacts(path=path, cache=cache, encoding=encoding)
+
+
+def validate_bag_path(profile, path, skip=(), deadline=None, storage=None):
+    """
+    Validate the bag at ``path`` and return its ProfileValidationReport.
+
+    ``profile`` is a Profile, or a ProfileCatalog to use the profile named by
+    the bag. ``skip`` may contain "serialization" and/or "profile", as on the
+    command line. The profile is copied, so one Profile may be shared by
+    several threads.
+
+    With ``deadline``, validation stops at the next opportunity after that
+    many seconds, and the bag is reported as not validated in time.
+
+    A bag directory is not loaded with bagit, which would read all its tag
+    files in full; only what the checks need is read, through its BagFacts.
+
+    With ``storage``, a BagStorage other than the local filesystem,
+    ``path`` is the path of a bag in it, which is validated through its
+    BagFacts. Bags in such storage are never serialized, so serialization
+    is not checked.
+
+    A bag serialized as a tar archive (plain, or compressed with gzip or
+    xz) is checked against the profile too, reading its tag files through
+    an ArchiveStorage. Tag fixity, payload completeness and fetch.txt
+    entries are only checked in bags on local disk.
+    """
+    report = ProfileValidationReport()
+    if deadline is not None:
+        _deadlines.until = time.time() + deadline
+    try:
+        if storage is not None and not storage.local:
+            bag = BagFacts(path=path, storage=storage)
+            if not bag.fact("tag_listing")["."]:
+                raise ProfileValidationError("%s: Bag does not exist." % bag)
+            skip = tuple(skip) + ("serialization",)
+        elif not exists(path):
+            raise ProfileValidationError("%s: Bag does not exist." % path)
+        elif isdir(path):
+            bag = _local_bag(path, profile)
+        elif "profile" not in skip and "application/x-tar" in sniff_serialization(path):
+            # A serialized bag: its tag files are read from the archive.
+            archive = ArchiveStorage(path)
+            bag = BagFacts(path=archive.bag_path, storage=archive, name=path)
+        else:
+            bag = None
+        if isinstance(profile, ProfileCatalog):
+            if bag is None:
+                raise ProfileValidationError(
+                    "%s: Cannot pick a profile for a serialized bag from a catalog." % path
+                )
+            profile = profile.profile_for_bag(bag)
+        profile = copy.copy(profile)
+        if isinstance(bag, BagFacts) and not bag.storage.local and (profile.tag_fixity or
+                                                                   profile.payload_completeness or
+                                                                   profile.fetch_entries):
+            logging.info("%s: Not checking tag fixity, payload completeness or fetch.txt entries of a bag not on "
+                         "local disk", path)
+            profile.tag_fixity = profile.payload_completeness = profile.fetch_entries = False
+        if "serialization" not in skip:
+            with _timing("validate_serialization"):
+                profile.validate_serialization(path)
+        if "profile" not in skip and bag is not None:
+            profile.validate(bag)
+            report.errors.extend(profile.report.errors)
+    except ProfileValidationError as e:
+        report.errors.append(e)
+    except ValidationTimeout:
+        report.errors.append(_timeout_error(path, deadline))
+    except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Cannot validate %s", path)
+        report.errors.append(ProfileValidationError("%s: %s" % (path, e)))
+    finally:
+        _deadlines.until = None
+    return report
+
+
+# Rough cost of validating a bag, and of each entry in its tag directories, in
+# seconds, for estimate_cost().
+_BASE_COST = 0.01
+_TAG_ENTRY_COST = 0.001
+
+
+def estimate_cost(path, history=None):
+    """
+    Estimate how long validating the bag at ``path`` takes, in seconds: its
+    time in ``history`` (a dict of path -> seconds, as returned by
+    CheckpointJournal.timings) if there, or else a guess from the number of
+    entries in its tag directories. Serialized bags are only sniffed, and so
+    are cheap whatever their size.
+    """
+    if history and path in history:
+        return history[path]
+    if not isdir(path):
+        return _BASE_COST
+    entries = 0
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        try:
+            listing = _scan_directory(directory)
+        except OSError:
+            continue
+        entries += len(listing)
+        for name, is_dir, _ in listing:
+            if is_dir and not (directory == path and fnmatch(name, "data*")):
+                pending.append(join(directory, name))
+    return _BASE_COST + _TAG_ENTRY_COST * entries
+
+
+class CheckpointJournal(object):  # pylint: disable=useless-object-inheritance
+    """
+    Append-only journal of the bags a batch run has finished and their
+    verdicts, one JSON line per bag, so that an interrupted run can resume.
+
+    With ``resume``, the existing journal at ``path`` is read first and
+    appended to; a line cut short by a crash is ignored. Otherwise the journal
+    is started afresh. Lines are flushed as they are written and synced to
+    disk every ``sync_every`` bags.
+    """
+
+    def __init__(self, path, resume=False, sync_every=100):
+        self.path = path
+        self.sync_every = sync_every
+        # Path -> None if valid, else the list of error messages.
+        self.completed = {}
+        complete_length = 0
+        if resume and isfile(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    complete_length += len(line)
+                    try:
+                        entry = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        continue
+                    self.completed[entry["path"]] = entry["errors"] or None
+        self._file = open(path, "a" if resume else "w")
+        if resume and self._file.tell() > complete_length:
+            # Drop the line cut short by a crash.
+            self._file.truncate(complete_length)
+        self._unsynced = 0
+
+    def __contains__(self, path):
+        return path in self.completed
+
+    def report(self, path):
+        report = ProfileValidationReport()
+        report.errors = [ProfileValidationError(e) for e in self.completed[path] or []]
+        return report
+
+    @staticmethod
+    def timings(path):
+        """
+        Return a dict of the seconds each bag recorded in the journal at
+        ``path`` took to validate, for use as estimate_cost's ``history``.
+        """
+        timings = {}
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    continue
+                if entry.get("seconds") is not None:
+                    timings[entry["path"]] = entry["seconds"]
+        return timings
+
+    def record(self, path, report, seconds=None):
+        entry = {"path": path, "errors": report.to_dict()["errors"]}
+        if seconds is not None:
+            entry["seconds"] = round(seconds, 3)
+        errors = entry["errors"]
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        self.completed[path] = errors or None
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+def validate_bags(profile, bag_paths, workers=4, skip=(), checkpoint=None, longest_first=False,
+                  history=None, deadline=None, lookahead=None, storage=None):
+    """
+    Validate every bag in the iterable ``bag_paths`` with a pool of ``workers``
+    threads, yielding ``(path, report)`` pairs as each bag finishes.
+
+    ``bag_paths`` is consumed lazily and at most ``lookahead`` bags (by
+    default ``2 * workers``, or ``8 * workers`` with ``longest_first``) wait
+    at once, so it may be an endless generator such as ``BagWatcher.bags()``.
+    Workers take the next bag from one shared queue as they finish, so none
+    sits idle while bags wait. With ``longest_first``, the waiting bag with
+    the highest estimate_cost() (given ``history``) is started first, so that
+    the slowest bags do not start last and hold up the end of the run.
+
+    With ``deadline``, a bag still being validated after that many seconds
+    is reported as failed: see validate_bag_path. A worker stuck past the
+    deadline (in a hung filesystem call, say) is abandoned after a grace
+    period of up to 5 more seconds; its bag is reported and a new worker
+    takes its place.
+
+    If a CheckpointJournal is given as ``checkpoint``, each result is recorded
+    in it, and bags it already holds are not validated again: their recorded
+    reports are yielded instead. ``storage`` is passed on to
+    validate_bag_path.
+    """
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue  # pylint: disable=import-error
+
+    if lookahead is None:
+        lookahead = (8 if longest_first else 2) * workers
+    grace = None if deadline is None else min(5.0, deadline)
+    results = queue.Queue()
+    finished = object()
+    failure = []
+    lock = threading.Condition()
+    # Heap of (priority, sequence number, path) of the bags waiting.
+    waiting = []
+    # Worker -> (path, start time) of the bags being validated.
+    running = {}
+    abandoned = set()
+    state = {"feeding": True, "workers": 0}
+
+    def feed():
+        try:
+            for number, path in enumerate(bag_paths):
+                if checkpoint is not None and path in checkpoint:
+                    results.put((path, checkpoint.report(path), True, None))
+                    continue
+                priority = -estimate_cost(path, history) if longest_first else 0
+                with lock:
+                    while len(waiting) >= lookahead:
+                        lock.wait()
+                    heapq.heappush(waiting, (priority, number, path))
+                    lock.notify_all()
+        except Exception as e:  # pylint: disable=broad-except
+            failure.append(e)
+        finally:
+            with lock:
+                state["feeding"] = False
+                lock.notify_all()
+
+    def work(worker):
+        while True:
+            with lock:
+                while not waiting and state["feeding"]:
+                    lock.wait()
+                if not waiting:
+                    state["workers"] -= 1
+                    if not state["workers"]:
+                        results.put(finished)
+                    return
+                _, _, path = heapq.heappop(waiting)
+                lock.notify_all()
+                started = time.time()
+                running[worker] = (path, started)
+            report = validate_bag_path(profile, path, skip, deadline=deadline, storage=storage)
+            with lock:
+                if worker in abandoned:
+                    # Already reported, and replaced.
+                    return
+                del running[worker]
+            results.put((path, report, False, time.time() - started))
+
+    def start_worker():
+        worker = object()
+        state["workers"] += 1
+        thread = threading.Thread(target=_in_profiler(work), args=(worker,))
+        thread.daemon = True
+        thread.start()
+
+    with lock:
+        for _ in range(workers):
+            start_worker()
+    feeder = threading.Thread(target=_in_profiler(feed))
+    feeder.daemon = True
+    feeder.start()
+    while True:
+        try:
+            item = results.get(timeout=grace)
+        except queue.Empty:
+            overdue = []
+            with lock:
+                now = time.time()
+                for worker, (path, started) in list(running.items()):
+                    if now - started > deadline + grace:
+                        logging.warning("Abandoning validation of %s after %.0f seconds", path, now - started)
+                        abandoned.add(worker)
+                        del running[worker]
+                        state["workers"] -= 1
+                        start_worker()
+                        overdue.append((path, now - started))
+            for path, seconds in overdue:
+                report = ProfileValidationReport()
+                report.errors.append(_timeout_error(path, deadline))
+                if checkpoint is not None:
+                    checkpoint.record(path, report, seconds)
+                yield path, report
+            continue
+        if item is finished:
+            break
+        path, report, resumed, seconds = item
+        if checkpoint is not None and not resumed:
+            checkpoint.record(path, report, seconds)
+        yield path, report
+    if failure:
+        raise failure[0]
+
+
+def _scan_directory(path):
+    # List path as (name, is a directory (not a link to one), is a file) triples.
+    if hasattr(os, "scandir"):
+        return [(e.name, e.is_dir(follow_symlinks=False), e.is_file()) for e in os.scandir(path)]
+    return [
+        (name, isdir(join(path, name)) and not os.path.islink(join(path, name)), isfile(join(path, name)))
+        for name in listdir(path)
+    ]
+
+
+def discover_bags(root, workers=8):
+    """
+    Yield the path of every bag (directory holding a bagit.txt file) at or
+    under ``root``, in no particular order, as soon as each is found.
+
+    Directories are listed by a pool of ``workers`` threads. The directory
+    of a bag is not descended into, so payloads are never walked and the
+    work grows with the number of bags and of the directories holding them
+    rather than with the number of files. Symbolic links to directories are
+    not followed. Unreadable directories are logged and skipped.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue  # pylint: disable=import-error
+
+    found = queue.Queue()
+    finished = object()
+    lock = threading.Lock()
+    pending = [0]
+    stopped = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(path):
+        with lock:
+            pending[0] += 1
+        executor.submit(profiled_scan, path)
+
+    def scan(path):
+        try:
+            if stopped.is_set():
+                return
+            with _timing("discover_bags"):
+                entries = _scan_directory(path)
+            _count("scandir")
+            if any(name == "bagit.txt" and is_file for name, _, is_file in entries):
+                found.put(path)
+                return
+            for name, is_dir, _ in entries:
+                if is_dir:
+                    submit(join(path, name))
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("Cannot list %s: %s", path, e)
+        finally:
+            with lock:
+                pending[0] -= 1
+                done = pending[0] == 0
+            if done:
+                found.put(finished)
+
+    profiled_scan = _in_profiler(scan)
+    submit(root)
+    try:
+        while True:
+            path = found.get()
+            if path is finished:
+                break
+            yield path
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
+
+
+# Base of abstract classes, on Python 2 and 3 alike.
+_ABC = abc.ABCMeta("_ABC", (object,), {"__slots__": ()})
+
+
+class WorkQueue(_ABC):
+    """
+    Interface of the queues used to share validation work between processes
+    and nodes. Bags are queued in shards; a worker leases a shard, validates
+    its bags and stores their reports. A shard whose lease expires (because
+    its worker crashed) is handed out again, up to a maximum number of
+    attempts.
+    """
+
+    @abc.abstractmethod
+    def put(self, shards):
+        """Queue each shard, a list of bag paths."""
+
+    @abc.abstractmethod
+    def claim(self, worker_id, lease_seconds):
+        """Lease the next shard, returning ``(shard_id, paths)`` or None."""
+
+    @abc.abstractmethod
+    def renew(self, shard_id, worker_id, lease_seconds):
+        """Extend the lease on a shard that is still being worked on."""
+
+    @abc.abstractmethod
+    def complete(self, shard_id, worker_id, results):
+        """
+        Store the ``(path, report)`` results of a shard and mark it done, if
+        ``worker_id`` still holds an unexpired lease on it. Returns whether
+        the results were stored.
+        """
+
+    @abc.abstractmethod
+    def fail(self, shard_id, worker_id, error):
+        """Give a shard back after an error, to be retried or marked failed."""
+
+    @abc.abstractmethod
+    def unfinished(self):
+        """Return the number of shards not yet done or failed."""
+
+    @abc.abstractmethod
+    def results(self):
+        """Yield ``(path, report)`` for every bag queued, in path order."""
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """
+    A WorkQueue kept in a SQLite database, so that no external service is
+    needed. The database must be on a filesystem with working POSIX locks
+    shared by all workers.
+    """
+
+    def __init__(self, path, max_attempts=3, timeout=60):
+        import sqlite3
+
+        self.path = path
+        self.max_attempts = max_attempts
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY,
+                paths TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS shards_state ON shards (state, id);
+            CREATE TABLE IF NOT EXISTS results (
+                path TEXT PRIMARY KEY,
+                shard INTEGER NOT NULL,
+                report TEXT NOT NULL
+            );
+            """
+        )
+
+    def _transaction(self, fn):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn()
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return result
+
+    def put(self, shards):
+        def insert():
+            for shard in shards:
+                self._db.execute("INSERT INTO shards (paths) VALUES (?)", (json.dumps(list(shard)),))
+        self._transaction(insert)
+
+    def claim(self, worker_id, lease_seconds):
+        def claim_next():
+            now = time.time()
+            self._db.execute(
+                "UPDATE shards SET state = 'failed', error = 'lease expired ' || attempts || ' times' "
+                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            row = self._db.execute(
+                "SELECT id, paths FROM shards WHERE state = 'pending' "
+                "OR (state = 'leased' AND lease_expires < ?) ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE shards SET state = 'leased', worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now + lease_seconds, row[0]),
+            )
+            return row[0], json.loads(row[1])
+        return self._transaction(claim_next)
+
+    def renew(self, shard_id, worker_id, lease_seconds):
+        self._db.execute(
+            "UPDATE shards SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + lease_seconds, shard_id, worker_id),
+        )
+
+    def complete(self, shard_id, worker_id, results):
+        def store():
+            if not self._db.execute(
+                "UPDATE shards SET state = 'done', error = NULL "
+                "WHERE id = ? AND worker = ? AND state = 'leased' AND lease_expires >= ?",
+                (shard_id, worker_id, time.time()),
+            ).rowcount:
+                return False
+            for path, report in results:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (path, shard, report) VALUES (?, ?, ?)",
+                    (path, shard_id, json.dumps(report.to_dict())),
+                )
+            return True
+        return self._transaction(store)
+
+    def fail(self, shard_id, worker_id, error):
+        self._db.execute(
+            "UPDATE shards SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (self.max_attempts, "%s" % error, shard_id, worker_id),
+        )
+
+    def unfinished(self):
+        return self._db.execute(
+            "SELECT COUNT(*) FROM shards WHERE state IN ('pending', 'leased')"
+        ).fetchone()[0]
+
+    def results(self):
+        failed = {}
+        for paths, attempts, error in self._db.execute(
+            "SELECT paths, attempts, error FROM shards WHERE state = 'failed'"
+        ):
+            for path in json.loads(paths):
+                failed[path] = "%s: Not validated after %d attempts: %s" % (path, attempts, error)
+        for path, report in self._db.execute("SELECT path, report FROM results ORDER BY path"):
+            failed.pop(path, None)
+            yield path, ProfileValidationReport.from_dict(json.loads(report))
+        for path in sorted(failed):
+            report = ProfileValidationReport()
+            report.errors.append(ProfileValidationError(failed[path]))
+            yield path, report
+
+    def close(self):
+        self._db.close()
+
+
+def enqueue_bags(queue, bag_paths, shard_size=100):
+    """
+    Split ``bag_paths`` into shards of ``shard_size`` bags and put them on
+    ``queue``. Returns the number of shards queued.
+    """
+    shards = []
+    shard = []
+    for path in bag_paths:
+        shard.append(path)
+        if len(shard) == shard_size:
+            shards.append(shard)
+            shard = []
+    if shard:
+        shards.append(shard)
+    queue.put(shards)
+    return len(shards)
+
+
+def run_worker(queue, profile, worker_id=None, lease_seconds=300, workers=1, skip=(),
+               wait=False, poll_interval=5.0, **batch_kwargs):
+    """
+    Validate shards from ``queue`` until none are left to claim, storing each
+    shard's reports on the queue. With ``wait``, keep polling until every
+    shard is done or failed, to pick up shards abandoned by crashed workers.
+    Other keyword arguments (such as ``deadline``) are passed to
+    validate_bags. Returns the number of shards completed.
+    """
+    if worker_id is None:
+        import socket
+
+        worker_id = "%s:%d" % (socket.gethostname(), os.getpid())
+    completed = 0
+    while True:
+        claimed = queue.claim(worker_id, lease_seconds)
+        if claimed is None:
+            if wait and queue.unfinished():
+                time.sleep(poll_interval)
+                continue
+            return completed
+        shard_id, paths = claimed
+        results = []
+        try:
+            for result in validate_bags(profile, paths, workers=workers, skip=skip, **batch_kwargs):
+                results.append(result)
+                queue.renew(shard_id, worker_id, lease_seconds)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.exception("Shard %s failed", shard_id)
+            queue.fail(shard_id, worker_id, e)
+            continue
+        if queue.complete(shard_id, worker_id, results):
+            completed += 1
+        else:
+            logging.warning("Lease on shard %s expired before it was completed; its results were dropped", shard_id)
+
+
+class _Inotify(object):  # pylint: disable=useless-object-inheritance
+    """
+    Minimal ctypes binding of the Linux inotify API.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    _IN_CLOEXEC = 0o2000000
+    _event = struct.Struct("iIII")
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._get_errno = ctypes.get_errno
+        self.fd = libc.inotify_init1(self._IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self._get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, path.encode(sys.getfilesystemencoding()), mask)
+        if wd < 0:
+            raise OSError(self._get_errno(), "inotify_add_watch failed", path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """
+        Return the ``(wd, mask, name)`` events available within ``timeout`` seconds.
+        """
+        import select
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        buf = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = self._event.unpack_from(buf, offset)
+            offset += self._event.size
+            name = buf[offset:offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding())
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class BagWatcher(object):  # pylint: disable=useless-object-inheritance
+    """
+    Watch ``directory`` for bags (its immediate subdirectories) and yield each
+    one once it is complete.
+
+    A bag is complete when it contains bagit.txt and either a
+    tagmanifest-*.txt file or no changes have been seen in it for ``idle``
+    seconds, and in both cases nothing has changed in it for ``settle``
+    seconds. Only the watched directory and the top level of pending bags are
+    observed: with inotify where available, otherwise by polling every
+    ``poll_interval`` seconds.
+    """
+
+    def __init__(self, directory, settle=2.0, idle=60.0, poll_interval=1.0,
+                 use_inotify=None, include_existing=True):
+        self.directory = directory
+        self.settle = settle
+        self.idle = idle
+        self.poll_interval = poll_interval
+        self.include_existing = include_existing
+        self._inotify = None
+        if use_inotify is not False:
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError) as e:
+                if use_inotify:
+                    raise
+                logging.info("inotify unavailable, polling %s instead: %s", directory, e)
+        # Pending bag path -> [time of last change, last seen mtime, inotify wd]
+        self._pending = {}
+        self._done = set()
+        self._watches = {}
+        self._root_wd = None
+
+    def _bag_mask(self):
+        return (_Inotify.IN_CREATE | _Inotify.IN_CLOSE_WRITE | _Inotify.IN_MOVED_TO
+                | _Inotify.IN_MOVED_FROM | _Inotify.IN_DELETE | _Inotify.IN_MODIFY)
+
+    def _add(self, path, now):
+        if path in self._pending or path in self._done or not isdir(path):
+            return
+        wd = None
+        if self._inotify is not None:
+            try:
+                wd = self._inotify.add_watch(path, self._bag_mask())
+                self._watches[wd] = path
+            except OSError:
+                return
+        self._pending[path] = [now, self._mtime(path), wd]
+
+    def _remove(self, path):
+        self._done.discard(path)
+        entry = self._pending.pop(path, None)
+        if entry is not None and entry[2] is not None:
+            self._watches.pop(entry[2], None)
+            self._inotify.rm_watch(entry[2])
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return getmtime(path)
+        except OSError:
+            return None
+
+    def _scan(self, now):
+        present = set(join(self.directory, name) for name in listdir(self.directory))
+        for path in present:
+            self._add(path, now)
+        for path in list(self._pending) + list(self._done):
+            if path not in present:
+                self._remove(path)
+        if self._inotify is None:
+            for path, entry in self._pending.items():
+                mtime = self._mtime(path)
+                if mtime != entry[1]:
+                    entry[0], entry[1] = now, mtime
+
+    def _handle_events(self, timeout):
+        now = time.time()
+        for wd, mask, name in self._inotify.read(timeout):
+            if wd == -1:
+                # The event queue overflowed.
+                self._scan(now)
+                continue
+            if mask & _Inotify.IN_IGNORED:
+                continue
+            if wd == self._root_wd:
+                path = join(self.directory, name)
+                if mask & (_Inotify.IN_DELETE | _Inotify.IN_MOVED_FROM):
+                    self._remove(path)
+                elif mask & _Inotify.IN_ISDIR:
+                    self._add(path, now)
+            elif wd in self._watches:
+                self._pending[self._watches[wd]][0] = now
+
+    def _ready(self, now):
+        ready = []
+        for path, entry in self._pending.items():
+            quiet = now - entry[0]
+            if quiet < self.settle:
+                continue
+            try:
+                names = listdir(path)
+            except OSError:
+                continue
+            if "bagit.txt" not in names:
+                continue
+            if quiet >= self.idle or any(fnmatch(n, "tagmanifest-*.txt") for n in names):
+                ready.append(path)
+        for path in sorted(ready):
+            entry = self._pending.pop(path)
+            if entry[2] is not None:
+                self._watches.pop(entry[2], None)
+                self._inotify.rm_watch(entry[2])
+            self._done.add(path)
+        return sorted(ready)
+
+    def bags(self, timeout=None):
+        """
+        Yield the paths of complete bags as they appear. Runs until ``timeout``
+        seconds have passed, or forever if it is None.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        if self._inotify is not None:
+            self._root_wd = self._inotify.add_watch(
+                self.directory,
+                _Inotify.IN_CREATE | _Inotify.IN_MOVED_TO | _Inotify.IN_MOVED_FROM | _Inotify.IN_DELETE,
+            )
+        if not self.include_existing:
+            self._done.update(join(self.directory, name) for name in listdir(self.directory))
+        self._scan(time.time())
+        try:
+            while deadline is None or time.time() < deadline:
+                for path in self._ready(time.time()):
+                    yield path
+                wait = self.poll_interval
+                if self._pending:
+                    wait = min(wait, self.settle)
+                if deadline is not None:
+                    wait = max(0, min(wait, deadline - time.time()))
+                if self._inotify is not None:
+                    self._handle_events(wait)
+                else:
+                    time.sleep(wait)
+                    self._scan(time.time())
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+
+
+# Percent-encoded characters in manifest paths (RFC 8493, section 2.1.3).
+_MANIFEST_PATH_ESCAPES = re.compile(r"%(0[AaDd]|25)")
+
+# Number of individual problems included in a single error message.
+_MAX_REPORTED_PROBLEMS = 20
+
+
+# Number of items sorted in memory at once by external_sort.
+_EXTERNAL_SORT_CHUNK = 100000
+
+
+def _summarize(problems, total=None):
+    total = len(problems) if total is None else total
+    shown = "; ".join(problems[:_MAX_REPORTED_PROBLEMS])
+    if total > _MAX_REPORTED_PROBLEMS:
+        shown += "; and %d more" % (total - _MAX_REPORTED_PROBLEMS)
+    return shown
+
+
+def _decode_line(line, path, number, encoding):
+    # Line 'number' of the tag file at 'path', decoded from 'encoding'.
+    try:
+        return line.decode(encoding).rstrip("\r\n")
+    except UnicodeDecodeError as e:
+        raise ProfileValidationError("%s, line %d: not valid %s (%s)" % (path, number, encoding, e.reason))
+
+
+def iter_manifest(path, encoding="utf-8"):
+    """
+    Yield ``(digest, path)`` for each entry of the manifest at ``path``, one
+    line at a time. Entry paths are decoded from ``encoding`` (the bag's
+    Tag-File-Character-Encoding) and use '/' separators. Raises
+    ProfileValidationError at the first line that cannot be decoded.
+    """
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, 1):
+            _count("bytes_read", len(line))
+            if not number % 4096:
+                _check_deadline()
+            line = _decode_line(line, path, number, encoding)
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                continue
+            entry = _MANIFEST_PATH_ESCAPES.sub(lambda m: chr(int(m.group(1), 16)), parts[1].lstrip("*"))
+            yield parts[0], entry
+
+
+def iter_fetch(path, encoding="utf-8"):
+    """
+    Yield ``(line number, url, length, path)`` for each entry of the
+    fetch.txt at ``path``, one line at a time. ``length`` is None if given
+    as "-". Entry paths are decoded as in manifests. Raises
+    ProfileValidationError at the first malformed line.
+    """
+    try:
+        from urllib.parse import urlsplit
+    except ImportError:
+        from urlparse import urlsplit  # pylint: disable=import-error
+
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, 1):
+            _count("bytes_read", len(line))
+            if not number % 4096:
+                _check_deadline()
+            line = _decode_line(line, path, number, encoding)
+            if not line.strip():
+                continue
+            parts = line.split(None, 2)
+            problem = None
+            if len(parts) != 3:
+                problem = "expected 'URL LENGTH FILENAME'"
+            else:
+                url, length, entry = parts
+                entry = _MANIFEST_PATH_ESCAPES.sub(lambda m: chr(int(m.group(1), 16)), entry)
+                split_url = urlsplit(url)
+                if not (split_url.scheme and split_url.netloc):
+                    problem = "'%s' is not an absolute URL" % url
+                elif length != "-" and not length.isdigit():
+                    problem = "length '%s' is neither a number nor '-'" % length
+                elif not entry.startswith("data/") or ".." in entry.split("/"):
+                    problem = "'%s' is not a path under data/" % entry
+            if problem is not None:
+                raise ProfileValidationError("%s, line %d: %s" % (path, number, problem))
+            yield number, url, None if length == "-" else int(length), entry
+
+
+# Seconds to wait for a server when checking fetch.txt URLs.
+_FETCH_TIMEOUT = 30
+
+
+def check_urls(urls, workers=8, timeout=_FETCH_TIMEOUT):
+    """
+    Check that each URL of the iterable ``urls`` answers a HEAD request (or,
+    if the server does not allow HEAD, a one-byte GET) with a status below
+    400. Yields ``(url, problem)`` for each URL, ``problem`` being None if
+    it was reachable, in the order given. At most ``workers`` requests are
+    made at a time, each worker keeping one connection open per server,
+    and ``urls`` is consumed as requests complete.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    try:
+        from http.client import HTTPConnection, HTTPSConnection
+        from urllib.parse import urlsplit
+        from urllib.request import Request
+        from urllib.request import urlopen as open_url
+    except ImportError:
+        from httplib import HTTPConnection, HTTPSConnection  # pylint: disable=import-error
+        from urllib2 import Request  # pylint: disable=import-error
+        from urllib2 import urlopen as open_url  # pylint: disable=import-error
+        from urlparse import urlsplit  # pylint: disable=import-error
+
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def request(connection, method, target, headers):
+        connection.request(method, target, headers=headers)
+        response = connection.getresponse()
+        if method == "HEAD":
+            response.read()
+        return response
+
+    def check(url):
+        split_url = urlsplit(url)
+        if split_url.scheme not in ("http", "https"):
+            try:
+                open_url(Request(url), timeout=timeout).close()
+                return None
+            except Exception as e:  # pylint: disable=broad-except
+                return str(e)
+        connections = getattr(local, "connections", None)
+        if connections is None:
+            connections = local.connections = {}
+        key = (split_url.scheme, split_url.netloc)
+        target = (split_url.path or "/") + ("?" + split_url.query if split_url.query else "")
+        for attempt in range(2):
+            connection = connections.get(key)
+            if connection is None:
+                cls = HTTPSConnection if split_url.scheme == "https" else HTTPConnection
+                connection = connections[key] = cls(split_url.netloc, timeout=timeout)
+                with lock:
+                    opened.append(connection)
+            try:
+                response = request(connection, "HEAD", target, {})
+                if response.status in (405, 501):
+                    response = request(connection, "GET", target, {"Range": "bytes=0-0"})
+                    # Whatever the body, do not read it: start afresh next time.
+                    connection.close()
+                    del connections[key]
+                _count("fetch_requests")
+                return None if response.status < 400 else "HTTP %d" % response.status
+            except Exception as e:  # pylint: disable=broad-except
+                # A kept-alive connection may have been closed by the server.
+                connection.close()
+                del connections[key]
+                if attempt:
+                    return str(e) or e.__class__.__name__
+        return None
+
+    profiled_check = _in_profiler(check)
+    pending = []
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for url in urls:
+            pending.append((url, executor.submit(profiled_check, url)))
+            while len(pending) >= 4 * workers:
+                url, future = pending.pop(0)
+                yield url, future.result()
+        for url, future in pending:
+            yield url, future.result()
+    finally:
+        executor.shutdown(wait=True)
+        for connection in opened:
+            connection.close()
+
+
+def parse_tag_file(path, tags=None, ignore_case=False, encoding="utf-8"):
+    """
+    Parse a tag file such as bag-info.txt or bagit.txt into a dict like
+    bagit's ``Bag.info``: each tag maps to its value, or to the list of its
+    values if it is repeated. Folded (continuation) lines are joined as bagit
+    does.
+
+    The file is memory-mapped. If ``tags`` is given, only those tags are
+    decoded and returned; the values of other tags are skipped without being
+    copied. With ``ignore_case``, tag names are matched and returned in lower
+    case.
+    """
+    return _tag_dict(_read_tag_pairs(path, tags, ignore_case, encoding))
+
+
+def _read_tag_pairs(path, tags=None, ignore_case=False, encoding="utf-8"):
+    # The (tag, value) pairs of the tag file at path, in order; see parse_tag_file.
+    if os.path.getsize(path) == 0:
+        return []
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _parse_tag_pairs(mm, path, tags, ignore_case, encoding)
+        finally:
+            mm.close()
+
+
+def _parse_tag_pairs(mm, path, tags=None, ignore_case=False, encoding="utf-8"):
+    # The (tag, value) pairs of a tag file read into 'mm' (an mmap or bytes).
+    wanted = None
+    if tags is not None:
+        wanted = set((t.lower() if ignore_case else t).encode("utf-8") for t in tags)
+    values = []
+    size = len(mm)
+    pos = 3 if mm[:3] == b"\xef\xbb\xbf" else 0
+    current = None
+    while pos < size:
+        end = mm.find(b"\n", pos)
+        if end == -1:
+            end = size
+        stop = end - 1 if end > pos and mm[end - 1:end] == b"\r" else end
+        if stop > pos:
+            if mm[pos:pos + 1] in (b" ", b"\t"):
+                # A folded line continues the previous tag's value,
+                # which bagit keeps verbatim.
+                if current is not None:
+                    line = mm[pos:end + 1]
+                    if line.strip():
+                        current[1].append(line)
+            else:
+                colon = mm.find(b":", pos, stop)
+                if colon == -1:
+                    line = mm[pos:stop]
+                    if line.strip():
+                        raise ProfileValidationError(
+                            "%s contains invalid tag: %s" % (path, line.strip().decode(encoding, "replace"))
+                        )
+                else:
+                    name = mm[pos:colon].strip()
+                    if ignore_case:
+                        name = name.lower()
+                    if wanted is None or name in wanted:
+                        current = (name, [mm[colon + 1:stop].rstrip()])
+                        values.append(current)
+                    else:
+                        current = None
+        pos = end + 1
+
+    pairs = []
+    for name, pieces in values:
+        raw = b"".join(pieces)
+        _count("bytes_read", len(name) + len(raw))
+        pairs.append((name.decode(encoding), raw.decode(encoding).strip()))
+    return pairs
+
+
+def _tag_dict(pairs):
+    # Map each tag to its value, or the list of its values if repeated.
+    result = {}
+    for name, value in pairs:
+        if name not in result:
+            result[name] = value
+        elif isinstance(result[name], list):
+            result[name].append(value)
+        else:
+            result[name] = [result[name], value]
+    return result
+
+
+class BagInfoConformance(object):  # pylint: disable=useless-object-inheritance
+    """
+    The result of bulk_validate_bag_info. ``paths`` lists the bags in order,
+    ``failures`` maps ``(tag, rule)`` pairs, rule being "required", "values"
+    or "repeatable", to the sorted indexes of the bags that break the rule,
+    and ``unreadable`` holds the indexes of bags without a readable
+    bag-info.txt.
+    """
+
+    def __init__(self, paths, failures, unreadable):
+        self.paths = paths
+        self.failures = failures
+        self.unreadable = unreadable
+
+    def conforms(self):
+        """Return a list with one boolean per bag."""
+        result = [True] * len(self.paths)
+        for index in self.unreadable:
+            result[index] = False
+        for indexes in self.failures.values():
+            for index in indexes:
+                result[index] = False
+        return result
+
+    def rows(self):
+        """Yield ``(path, conforms, [(tag, rule), ...])`` for each bag."""
+        broken = [[] for _ in self.paths]
+        for (tag, rule), indexes in sorted(self.failures.items()):
+            for index in indexes:
+                broken[index].append((tag, rule))
+        unreadable = set(self.unreadable)
+        for index, path in enumerate(self.paths):
+            if index in unreadable:
+                yield path, False, [("bag-info.txt", "unreadable")]
+            else:
+                yield path, not broken[index], broken[index]
+
+
+def bulk_validate_bag_info(profile, bag_paths, use_numpy=None):
+    """
+    Check the 'Bag-Info' rules of ``profile`` (and its
+    'BagIt-Profile-Identifier') for many bags at once, returning a
+    BagInfoConformance table with the same verdicts validate_bag_info would
+    give each bag.
+
+    Only the tags the profile refers to are read from each bag-info.txt.
+    They are loaded into columns: an occurrence count and a value code per
+    bag, codes indexing each tag's vocabulary of distinct values. Each rule is
+    then checked once per tag over the whole column, with NumPy if it is
+    available (or ``use_numpy`` is True) and in pure Python otherwise.
+    """
+    from array import array
+
+    if use_numpy is not False:
+        try:
+            import numpy
+        except ImportError:
+            if use_numpy:
+                raise
+            numpy = None
+    else:
+        numpy = None
+
+    paths = list(bag_paths)
+    rules = dict(profile.profile["Bag-Info"])
+    id_tag = profile._baginfo_profile_id_tag  # pylint: disable=protected-access
+    rules[id_tag] = dict(rules.get(id_tag, {}), required=True, values=[profile.url])
+    keys = dict((tag, profile.normalize_tag(tag)) for tag in rules)
+
+    # Columns: occurrences of each tag per bag (capped), and the code of its
+    # value: -1 if absent, -2 if repeated.
+    counts = dict((key, array("H", [0]) * len(paths)) for key in keys.values())
+    codes = dict((key, array("i", [-1]) * len(paths)) for key in keys.values())
+    vocabularies = dict((key, {}) for key in keys.values())
+    unreadable = []
+    for index, path in enumerate(paths):
+        try:
+            info = parse_tag_file(join(path, "bag-info.txt"), tags=list(keys.values()),
+                                  ignore_case=profile.ignore_baginfo_tag_case,
+                                  encoding=_tag_file_encoding(path) or "utf-8")
+        except (IOError, OSError, LookupError, UnicodeDecodeError, ProfileValidationError):
+            unreadable.append(index)
+            continue
+        for key, value in info.items():
+            if isinstance(value, list):
+                counts[key][index] = min(len(value), 0xFFFF)
+                codes[key][index] = -2
+            else:
+                counts[key][index] = 1
+                vocabulary = vocabularies[key]
+                codes[key][index] = vocabulary.setdefault(value, len(vocabulary))
+
+    failures = {}
+    skip = set(unreadable)
+    for tag, config in rules.items():
+        key = keys[tag]
+        vocabulary = vocabularies[key]
+        allowed = None
+        if "values" in config:
+            allowed = bytearray(len(vocabulary) or 1)
+            for value, code in vocabulary.items():
+                if value in config["values"]:
+                    allowed[code] = 1
+        checks = []
+        if numpy is not None:
+            count = numpy.frombuffer(counts[key], dtype=numpy.uint16)
+            code = numpy.frombuffer(codes[key], dtype=numpy.int32)
+            if config.get("required") is True:
+                checks.append(("required", count == 0))
+            if allowed is not None:
+                is_allowed = numpy.frombuffer(bytes(allowed), dtype=numpy.uint8)[numpy.maximum(code, 0)]
+                checks.append(("values", (code == -2) | ((code >= 0) & (is_allowed == 0))))
+            if config.get("repeatable") is False:
+                checks.append(("repeatable", count > 1))
+            checks = [(rule, [int(i) for i in numpy.nonzero(mask)[0]]) for rule, mask in checks]
+        else:
+            count = counts[key]
+            code = codes[key]
+            if config.get("required") is True:
+                checks.append(("required", [i for i, c in enumerate(count) if c == 0]))
+            if allowed is not None:
+                checks.append(("values", [i for i, c in enumerate(code) if c == -2 or (c >= 0 and not allowed[c])]))
+            if config.get("repeatable") is False:
+                checks.append(("repeatable", [i for i, c in enumerate(count) if c > 1]))
+        for rule, indexes in checks:
+            indexes = [i for i in indexes if i not in skip]
+            if indexes:
+                failures[(tag, rule)] = indexes
+    return BagInfoConformance(paths, failures, unreadable)
+
+
+def external_sort(items, chunk_size=None):
+    """
+    Yield the strings of ``items`` in sorted order, holding at most
+    ``chunk_size`` of them in memory. Larger inputs are sorted in runs which
+    are spilled to temporary files and merged.
+    """
+    chunk_size = chunk_size or _EXTERNAL_SORT_CHUNK
+    runs = []
+    chunk = []
+    try:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                chunk.sort()
+                run = tempfile.TemporaryFile(mode="w+")
+                # One JSON string per line, as items may contain newlines.
+                run.writelines(json.dumps(i) + "\n" for i in chunk)
+                run.seek(0)
+                runs.append(run)
+                chunk = []
+        chunk.sort()
+        for item in heapq.merge(chunk, *[(json.loads(line) for line in run) for run in runs]):
+            yield item
+    finally:
+        for run in runs:
+            run.close()
+
+
+def iter_sorted_payload(bag_dir):
+    """
+    Yield the paths of the files under ``bag_dir``/data, relative to
+    ``bag_dir`` with '/' separators, in sorted order. Only one directory
+    listing is held in memory at a time per level.
+    """
+    def walk_sorted(path, rel):
+        _check_deadline()
+        entries = []
+        if hasattr(os, "scandir"):
+            # Avoids a stat() per entry on most filesystems.
+            listing = [(e.name, e.is_dir(), e.is_symlink()) for e in os.scandir(path)]
+        else:
+            listing = [(n, isdir(join(path, n)), os.path.islink(join(path, n))) for n in listdir(path)]
+        for name, is_dir, is_link in listing:
+            full = join(path, name)
+            if is_dir:
+                if not is_link:
+                    # Sort directories by "name/" so that their contents
+                    # come out in the same order as sorting the full paths.
+                    entries.append((name + "/", full, rel + name + "/", True))
+            else:
+                entries.append((name, full, rel + name, False))
+        entries.sort()
+        for _, full, entry, is_dir in entries:
+            if is_dir:
+                for item in walk_sorted(full, entry):
+                    yield item
+            else:
+                yield entry
+
+    if isdir(join(bag_dir, "data")):
+        for item in walk_sorted(join(bag_dir, "data"), "data/"):
+            yield item
+
+
+def _compare_sorted(streams):
+    """
+    Merge-compare sorted iterables, the first being the actual payload and the
+    rest the manifests. Yields ``(index, item, present)`` for each stream that
+    lacks an item found in another: for the payload stream (index 0) when no
+    manifest lists an existing file, and for a manifest when it omits an
+    existing file (present is True) or lists a missing one (present is False).
+    """
+    end = object()
+
+    def advance(i, previous):
+        for item in streams[i]:
+            if item != previous:
+                return item
+        return end
+
+    heads = [advance(i, end) for i in range(len(streams))]
+    while True:
+        remaining = [h for h in heads if h is not end]
+        if not remaining:
+            return
+        current = min(remaining)
+        having = set(i for i, h in enumerate(heads) if h is not end and h == current)
+        if 0 in having:
+            if len(having) == 1 and len(streams) > 1:
+                yield 0, current, True
+            else:
+                for i in range(1, len(streams)):
+                    if i not in having:
+                        yield i, current, True
+        else:
+            for i in sorted(having):
+                yield i, current, False
+        for i in having:
+            heads[i] = advance(i, current)
+
+
+def file_digest(path, algorithm, chunk_size=1 << 20):
+    return _file_digests(path, [algorithm], chunk_size)[algorithm]
+
+
+def _file_digests(path, algorithms, chunk_size=1 << 20):
+    # The digests of the file at path for each of 'algorithms', reading it once.
+    hashes = dict((algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            _count("bytes_read", len(chunk))
+            _check_deadline()
+            for h in hashes.values():
+                h.update(chunk)
+    return dict((algorithm, h.hexdigest()) for algorithm, h in hashes.items())
+
+
+# The ValidationProfiler recording in each thread, if any.
+_profilers = threading.local()
+
+
+def _active_profiler():
+    return getattr(_profilers, "current", None)
+
+
+def _in_profiler(fn):
+    # Wrap fn to run under the calling thread's ValidationProfiler (if any)
+    # in whichever thread it is called, for work handed to other threads.
+    profiler = _active_profiler()
+    if profiler is None:
+        return fn
+
+    def profiled(*args, **kwargs):
+        previous = _active_profiler()
+        _profilers.current = profiler
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _profilers.current = previous
+    return profiled
+
+
+def _counted(name, fn):
+    # Wrap the filesystem call fn to be counted as 'name' by the active profiler.
+    def counted(*args, **kwargs):
+        profiler = _active_profiler()
+        if profiler is not None:
+            profiler.count(name)
+        return fn(*args, **kwargs)
+    return counted
+
+
+def _counted_walk(fn):
+    def walk_counted(*args, **kwargs):
+        for root, dirs, files in fn(*args, **kwargs):
+            _count("walk_entries", len(dirs) + len(files))
+            yield root, dirs, files
+    return walk_counted
+
+
+exists = _counted("exists", exists)
+isfile = _counted("isfile", isfile)
+isdir = _counted("isdir", isdir)
+listdir = _counted("listdir", listdir)
+walk = _counted_walk(walk)
+
+
+class _NoTiming(object):  # pylint: disable=useless-object-inheritance
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_TIMING = _NoTiming()
+
+
+def _timing(name):
+    # Time a step of validation under ``name`` if a ValidationProfiler is recording.
+    profiler = _active_profiler()
+    return _NO_TIMING if profiler is None else profiler.timing(name)
+
+
+def _count(name, n=1):
+    profiler = _active_profiler()
+    if profiler is not None:
+        profiler.count(name, n)
+
+
+_thread_time = getattr(time, "thread_time", None) or getattr(time, "process_time", None) or time.clock
+
+
+class _Timing(object):  # pylint: disable=useless-object-inheritance
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.wall = self.cpu = None
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = _thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_time(self.name, time.time() - self.wall, _thread_time() - self.cpu)
+        return False
+
+
+class ValidationProfiler(object):  # pylint: disable=useless-object-inheritance
+    """
+    Context manager recording where validation time goes while it is active:
+
+    - wall and CPU time of each check run by Profile.validate, and of
+      validate_serialization when called through validate_bag_path;
+    - the number of exists, isfile, isdir and listdir calls made by this
+      module, and the number of entries returned by walk;
+    - the number of bytes this module reads from tag files and manifests.
+      Reads made by bagit itself, as when a bagit Bag is loaded, are not
+      counted.
+
+    Only the validation run by the thread that entered it is recorded,
+    including the work validate_bags, discover_bags and check_urls hand to
+    their own threads, so profilers in different threads do not mix.
+
+    If ``pstats_path`` is given, the calling thread is also run under cProfile
+    and the statistics dumped there. If ``collapsed_path`` is given, the stacks
+    of all threads are sampled every ``sample_interval`` seconds and written in
+    the collapsed format used by flamegraph tools.
+    """
+
+    _fs_calls = ("exists", "isfile", "isdir", "listdir")
+
+    def __init__(self, pstats_path=None, collapsed_path=None, sample_interval=0.005):
+        self.pstats_path = pstats_path
+        self.collapsed_path = collapsed_path
+        self.sample_interval = sample_interval
+        # Check name -> [calls, wall seconds, CPU seconds]
+        self.checks = {}
+        self.counters = {}
+        self.stacks = {}
+        self._lock = threading.Lock()
+        self._cprofile = None
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+
+    def timing(self, name):
+        return _Timing(self, name)
+
+    def add_time(self, name, wall, cpu):
+        with self._lock:
+            entry = self.checks.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def __enter__(self):
+        if _active_profiler() is not None:
+            raise RuntimeError("A ValidationProfiler is already active in this thread")
+        _profilers.current = self
+        if self.collapsed_path:
+            self._sampler = threading.Thread(target=self._sample)
+            self._sampler.daemon = True
+            self._sampler.start()
+        if self.pstats_path:
+            import cProfile
+
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.pstats_path)
+        if self._sampler is not None:
+            self._stop_sampling.set()
+            self._sampler.join()
+            self.write_collapsed(self.collapsed_path)
+        _profilers.current = None
+        return False
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        while not self._stop_sampling.wait(self.sample_interval):
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s" % (basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for stack, samples in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, samples))
+
+    def summary(self):
+        lines = ["%-40s %8s %10s %10s" % ("check", "calls", "wall s", "cpu s")]
+        for name, (calls, wall, cpu) in sorted(self.checks.items(), key=lambda i: -i[1][1]):
+            lines.append("%-40s %8d %10.4f %10.4f" % (name, calls, wall, cpu))
+        lines.append(
+            "filesystem calls: %s"
+            % " ".join("%s=%d" % (n, self.counters.get(n, 0)) for n in self._fs_calls + ("walk_entries",))
+        )
+        lines.append("bytes read: %d" % self.counters.get("bytes_read", 0))
+        return "\n".join(lines) + "\n"
+
+
+def _configure_logging(args):
+    log_format = "%(asctime)s - %(levelname)s - %(message)s"
+    if args.quiet:
+        args.loglevel = "ERROR"
+    level = logging.getLevelName(args.loglevel)
+    if args.no_logfile:
+        logging.basicConfig(level=level, format=log_format)
+    else:
+        if args.logdir:
+            filename = join(
+                args.log + "/logs", "BagitProfile_" + time.strftime("%y_%m_%d") + ".log"
+            )
+        else:
+            filename = "BagitProfile%s.log" % time.strftime("%y_%m_%d")
+        logging.basicConfig(filename=filename, level=level, format=log_format)
+
+
+def _positional_arguments(parser, args):
+    # Work out which of PROFILE_URL and BAGIT_PATH the mode needs, as either
+    # may be omitted. Returns (profile_url, bagit_path).
+    if args.resume and not args.checkpoint:
+        parser.error("--resume requires --checkpoint")
+    if args.checkpoint and not (args.bags_from or args.discover or args.watch):
+        parser.error("--checkpoint requires --bags-from, --discover or --watch")
+    if args.bags_from and args.discover:
+        parser.error("--bags-from and --discover cannot be combined")
+    if (args.enqueue or args.work or args.collect) and not args.queue:
+        parser.error("--enqueue, --work and --collect require --queue")
+    if args.queue and not (args.enqueue or args.work or args.collect):
+        parser.error("--queue requires one of --enqueue, --work or --collect")
+    if bool(args.s3_endpoint) != bool(args.s3_bucket):
+        parser.error("--s3-endpoint and --s3-bucket must be given together")
+    if args.s3_bucket and (args.discover or args.watch):
+        parser.error("--discover and --watch cannot be used with --s3-bucket")
+    positional = [a for a in (args.profile_url, args.bagit_path) if a is not None]
+    takes_profile = not (args.enqueue or args.collect)
+    if args.revalidate and not args.result_cache:
+        parser.error("--revalidate requires --result-cache")
+    if args.revalidate and args.catalog and not args.profile_url:
+        parser.error("--revalidate requires PROFILE_URL")
+    takes_bag = not (args.watch or args.work or args.collect or args.bags_from or args.discover
+                     or args.revalidate)
+    profile_url = bagit_path = None
+    if takes_profile and (not args.catalog or len(positional) > int(takes_bag)):
+        if not positional:
+            parser.error("the following arguments are required: profile_url")
+        profile_url = positional.pop(0)
+    if takes_bag:
+        if not positional:
+            parser.error("the following arguments are required: bagit_path")
+        bagit_path = positional.pop(0)
+    if positional:
+        parser.error("unrecognized arguments: %s" % " ".join(positional))
+    return profile_url, bagit_path
+
+
+def _read_bag_list(path):
+    # Yield the bag paths listed one per line in the file at path, or on
+    # standard input if path is '-'.
+    f = sys.stdin if path == "-" else open(path, "r")
+    try:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _open_metadata_cache(args):
+    # Open the --metadata-cache, by default under the user's cache directory.
+    # Without one (or with --no-metadata-cache), directories are listed directly.
+    import sqlite3
+
+    if args.no_metadata_cache:
+        return None
+    path = args.metadata_cache
+    if path is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or join(os.path.expanduser("~"), ".cache")
+        path = join(cache_home, "bagit-profile", "metadata.sqlite")
+    try:
+        if not isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        return MetadataCache(path)
+    except (OSError, IOError, sqlite3.Error) as e:
+        logging.warning("Not using the metadata cache %s: %s", path, e)
+        return None
+
+
+def _listed_bags(args):
+    # The bags named by --bags-from or found by --discover, or None.
+    if args.bags_from:
+        return _read_bag_list(args.bags_from)
+    if args.discover:
+        return discover_bags(args.discover, workers=2 * args.workers)
+    return None
+
+
+def _open_storage(args):
+    # The ObjectStorage holding the bags, if any, with credentials from the
+    # environment as for other S3 clients.
+    if not args.s3_bucket:
+        return None
+    return ObjectStorage(
+        args.s3_endpoint, args.s3_bucket,
+        access_key=os.environ.get("AWS_ACCESS_KEY_ID"), secret_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
+        region=os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1",
+    )
+
+
+def _batch_options(args):
+    # Scheduling and storage options for validate_bags.
+    return {
+        "longest_first": args.longest_first,
+        "history": CheckpointJournal.timings(args.history) if args.history else None,
+        "deadline": args.deadline,
+        "storage": _open_storage(args),
+    }
+
+
+def _load_profile(args, profile_url, metadata_cache, result_cache):
+    # Instantiate a profile, supplying its URI. Without a URI, return the
+    # catalog so that the profile is picked for each bag.
+    kwargs = {
+        "ignore_baginfo_tag_case": args.ignore_baginfo_tag_case,
+        "tag_fixity": args.tag_fixity,
+        "payload_completeness": args.payload_completeness,
+        "fetch_entries": args.fetch_entries,
+        "fetch_workers": args.fetch_workers,
+        "fail_fast": args.fail_fast,
+        "metadata_cache": metadata_cache,
+        "result_cache": result_cache,
+    }
+    if args.catalog:
+        catalog = ProfileCatalog(args.catalog, **kwargs)
+        if profile_url is None:
+            return catalog
+        return catalog.get(profile_url)
+    if args.file:
+        with open(args.file, "r") as local_file:
+            return Profile(profile_url, profile=local_file.read(), **kwargs)
+    return Profile(profile_url, **kwargs)
+
+
+def _print_results(results, report):
+    # Print one line per (path, report) result and return the number of invalid bags.
+    invalid = 0
+    for path, result in results:
+        if result.is_valid:
+            print(u"✓ %s" % path)
+        else:
+            invalid += 1
+            print(u"✗ %s" % path)
+            if report:
+                print(result)
+        sys.stdout.flush()
+    return invalid
+
+
+def _validate_cli(args, profile_url, bagit_path):
+    if args.collect:
+        if _print_results(SQLiteWorkQueue(args.queue).results(), args.report):
+            sys.exit(2)
+        return
+    if args.enqueue:
+        bag_paths = _listed_bags(args) or [bagit_path]
+        shards = enqueue_bags(SQLiteWorkQueue(args.queue), bag_paths, shard_size=args.shard_size)
+        print(u"Queued %d shards on %s" % (shards, args.queue))
+        return
+
+    metadata_cache = _open_metadata_cache(args)
+    result_cache = ResultCache(args.result_cache, facts=True) if args.result_cache else None
+    try:
+        try:
+            profile = _load_profile(args, profile_url, metadata_cache, result_cache)
+        except ProfileValidationError as e:
+            print(u"✗ %s" % e.value)
+            sys.exit(1)
+        _validate_with_profile(args, profile, profile_url, bagit_path)
+    finally:
+        for cache in (metadata_cache, result_cache):
+            if cache is not None:
+                cache.close()
+
+
+def _validate_with_profile(args, profile, profile_url, bagit_path):
+    if args.revalidate:
+        with open(args.revalidate, "r") as old_file:
+            old = Profile(profile.url, profile=old_file.read(), ignore_baginfo_tag_case=profile.ignore_baginfo_tag_case,
+                          tag_fixity=profile.tag_fixity, payload_completeness=profile.payload_completeness,
+                          fetch_entries=profile.fetch_entries, fail_fast=profile.fail_fast)
+        if _print_results(revalidate(old, profile, profile.result_cache), args.report):
+            sys.exit(2)
+        return
+
+    if args.work:
+        shards = run_worker(SQLiteWorkQueue(args.queue), profile, workers=args.workers, skip=args.skip,
+                            wait=True, **_batch_options(args))
+        print(u"Completed %d shards from %s" % (shards, args.queue))
+        return
+
+    checkpoint = CheckpointJournal(args.checkpoint, resume=args.resume) if args.checkpoint else None
+    try:
+        if args.watch:
+            watcher = BagWatcher(args.watch, settle=args.settle)
+            try:
+                _print_results(validate_bags(profile, watcher.bags(), workers=args.workers, skip=args.skip,
+                                             checkpoint=checkpoint, **_batch_options(args)),
+                               args.report)
+            except KeyboardInterrupt:
+                pass
+            return
+
+        if args.bags_from or args.discover:
+            results = validate_bags(profile, _listed_bags(args), workers=args.workers,
+                                    skip=args.skip, checkpoint=checkpoint, **_batch_options(args))
+            if _print_results(results, args.report):
+                sys.exit(2)
+            return
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    # The facts of an existing bag, on disk, in object storage or in a tar
+    # archive. Other files can only have their serialization checked.
+    storage = _open_storage(args)
+    bag = None
+    try:
+        if storage is not None:
+            bag = BagFacts(path=bagit_path, storage=storage)
+        elif not exists(bagit_path):
+            raise ProfileValidationError("%s: Bag does not exist." % bagit_path)
+        elif isdir(bagit_path):
+            bag = _local_bag(bagit_path, profile)
+        elif "profile" not in args.skip and "application/x-tar" in sniff_serialization(bagit_path):
+            archive = ArchiveStorage(bagit_path)
+            bag = BagFacts(path=archive.bag_path, storage=archive, name=bagit_path)
+        if isinstance(profile, ProfileCatalog):
+            if bag is None:
+                raise ProfileValidationError(
+                    "%s: Cannot pick a profile for a serialized bag from a catalog." % bagit_path
+                )
+            profile = profile.profile_for_bag(bag)
+            profile_url = profile.url
+    except ProfileValidationError as e:
+        print(u"✗ %s" % e.value)
+        sys.exit(1)
+    except Exception as e:  # pylint: disable=broad-except
+        print(u"✗ %s: Cannot read the bag: %s" % (bagit_path, e))
+        sys.exit(1)
+    if isinstance(bag, BagFacts) and not bag.storage.local and (profile.tag_fixity or profile.payload_completeness or
+                                                               profile.fetch_entries):
+        logging.info("%s: Not checking tag fixity, payload completeness or fetch.txt entries of a bag not on "
+                     "local disk", bagit_path)
+        profile = copy.copy(profile)
+        profile.tag_fixity = profile.payload_completeness = profile.fetch_entries = False
+
+    # Validate 'Serialization' and 'Accept-Serialization', then perform general
+    # validation. Bags in object storage are never serialized.
+    if "serialization" not in args.skip and storage is None:
+        try:
+            with _timing("validate_serialization"):
+                serialization_valid = profile.validate_serialization(bagit_path)
+        except ProfileValidationError as e:
+            print(u"✗ %s" % e.value)
+            serialization_valid = False
+        if serialization_valid:
+            print(u"✓ Serialization validates")
+        else:
+            print(u"✗ Serialization does not validate")
+            sys.exit(1)
+
+    # Validate the rest of the profile.
+    if "profile" not in args.skip:
+        if bag is None:
+            print(u"✗ %s: Only bag directories and tar archives can be checked against the profile." % bagit_path)
+            sys.exit(1)
+        if profile.validate(bag):
+            print(u"✓ Validates against %s" % profile_url)
+        else:
+            print(u"✗ Does not validate against %s" % profile_url)
+            if args.report:
+                print(profile.report)
+            sys.exit(2)
+
+
+def _main():
+    # Command-line version.
+    from argparse import ArgumentParser
+    from pkg_resources import get_distribution
+
+    parser = ArgumentParser(description="Validate BagIt bags against BagIt profiles")
+
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s, v" + get_distribution("bagit_profile").version,
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Suppress all output except errors. Default: %(default)s",
+    )
+    parser.add_argument(
+        "-i", "--ignore-baginfo-tag-case",
+        dest="ignore_baginfo_tag_case",
+        action="store_true",
+        help="Ignore capitalization for Bag-Info tag names. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--tag-fixity",
+        action="store_true",
+        help="Also check tag files against the digests in the tag manifests. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--payload-completeness",
+        action="store_true",
+        help="Also check that the payload manifests list exactly the files in data/. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--fetch-entries",
+        action="store_true",
+        help="Also check that the entries of fetch.txt are well-formed, listed in the payload manifests and "
+        "reachable. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        type=int,
+        default=8,
+        help="URLs in fetch.txt checked at a time with --fetch-entries. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="Stop checking a bag at its first error, running the cheapest checks first. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--profile-run",
+        action="store_true",
+        help="Print the time spent in each check, filesystem calls made and bytes read "
+        "to standard error. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--profile-pstats",
+        metavar="FILE",
+        help="Like --profile-run, and also write cProfile statistics to FILE. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--profile-collapsed",
+        metavar="FILE",
+        help="Like --profile-run, and also write sampled stacks of all threads to FILE "
+        "in flamegraph collapsed format. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--log", dest="logdir", help="Log directory. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--no-logfile",
+        action="store_true",
+        help="Do not log to a log file. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--loglevel",
+        default="INFO",
+        choices=("DEBUG", "INFO", "ERROR"),
+        help="Log level. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--file", help="Load profile from FILE, not by URL. Default: %(default)s."
+    )
+    parser.add_argument(
+        "--catalog",
+        metavar="DIR",
+        help="Look profiles up by identifier in the local profile catalog DIR. "
+        "PROFILE_URL may be omitted to use the profile named by the bag's "
+        "BagIt-Profile-Identifier. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Print validation report. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--skip",
+        action="append",
+        default=[],
+        help="Skip validation steps. Default: %(default)s",
+        choices=("serialization", "profile"),
+    )
+    parser.add_argument(
+        "--watch",
+        metavar="DIR",
+        help="Validate bags as they are completed in DIR, instead of BAGIT_PATH. "
+        "Runs until interrupted. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=2.0,
+        help="With --watch, seconds a bag must be unchanged before it is validated. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--bags-from",
+        metavar="FILE",
+        help="Validate the bags listed in FILE, one path per line ('-' for standard input), "
+        "instead of BAGIT_PATH. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--discover",
+        metavar="ROOT",
+        help="Validate every bag found under the directory ROOT instead of BAGIT_PATH. Bags' "
+        "directories are not searched further, so payloads are never walked. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--longest-first",
+        action="store_true",
+        help="Start the bags expected to take longest first: by their time in --history, or else by "
+        "the size of their tag directories. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--history",
+        metavar="FILE",
+        help="A --checkpoint journal of an earlier run, whose timings --longest-first uses. "
+        "Default: %(default)s",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        metavar="SECONDS",
+        help="Report bags not validated within SECONDS as failed, and move on. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="FILE",
+        help="With --bags-from, --discover or --watch, record each finished bag in the journal FILE. "
+        "Default: %(default)s",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the bags already recorded in the --checkpoint journal, reporting their "
+        "recorded results. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of bags validated concurrently with --watch, --bags-from or --work. "
+        "Default: %(default)s",
+    )
+    parser.add_argument(
+        "--queue",
+        metavar="DB",
+        help="SQLite work queue shared by --enqueue, --work and --collect. Default: %(default)s",
+    )
+    queue_role = parser.add_mutually_exclusive_group()
+    queue_role.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Put BAGIT_PATH or the bags from --bags-from on --queue in shards of --shard-size. "
+        "No profile is needed. Default: %(default)s",
+    )
+    queue_role.add_argument(
+        "--work",
+        action="store_true",
+        help="Validate shards from --queue until every shard is done or has failed. Default: %(default)s",
+    )
+    queue_role.add_argument(
+        "--collect",
+        action="store_true",
+        help="Print the merged results stored on --queue. No profile is needed. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=100,
+        help="Number of bags per shard with --enqueue. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--metadata-cache",
+        metavar="PATH",
+        help="SQLite file caching the listings of bags' tag directories between runs. "
+        "Default: metadata.sqlite under $XDG_CACHE_HOME/bagit-profile",
+    )
+    parser.add_argument(
+        "--no-metadata-cache",
+        action="store_true",
+        help="List bag directories directly instead of through the metadata cache. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--result-cache",
+        metavar="PATH",
+        help="SQLite file of validation results, shared with other runs and processes. A bag is "
+        "only validated again when its tag files or the profile change. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--s3-endpoint",
+        metavar="URL",
+        help="Read bags from the S3-compatible object store at URL; BAGIT_PATH and the paths given by "
+        "--bags-from are then key prefixes in --s3-bucket. Credentials are taken from AWS_ACCESS_KEY_ID and "
+        "AWS_SECRET_ACCESS_KEY.",
+    )
+    parser.add_argument("--s3-bucket", metavar="BUCKET", help="Bucket holding the bags, with --s3-endpoint.")
+    parser.add_argument(
+        "--revalidate",
+        metavar="OLD_PROFILE",
+        help="Check every bag in --result-cache that was validated against the profile in the JSON file "
+        "OLD_PROFILE against PROFILE_URL instead, re-running only the checks the changes affect. "
+        "Default: %(default)s",
+    )
+    parser.add_argument("profile_url", nargs="?")
+    parser.add_argument("bagit_path", nargs="?")
+
+    args = parser.parse_args()
+
+    profile_url, bagit_path = _positional_arguments(parser, args)
+
+    _configure_logging(args)
+
+    if args.profile_run or args.profile_pstats or args.profile_collapsed:
+        profiler = ValidationProfiler(pstats_path=args.profile_pstats, collapsed_path=args.profile_collapsed)
+        try:
+            with profiler:
+                _validate_cli(args, profile_url, bagit_path)
+        finally:
+            sys.stderr.write(profiler.summary())
+    else:
+        _validate_cli(args, profile_url, bagit_path)
 
 
 if __name__ == "__main__":
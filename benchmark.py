@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for bagit_profile.
+
+    python benchmark.py profiles [--count N] [--tags N]
+
+Loads N synthetic partner profiles, as plain and as compact Profiles, each
+in a fresh interpreter, and prints the memory taken per loaded profile.
+
+    python benchmark.py fingerprint [--payload-files N ...] [--repeat N]
+
+Builds bags of growing payloads and prints the time bag_fingerprint() takes
+on each, which should not grow with the payload.
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from argparse import ArgumentParser
+
+
+def synthetic_profiles(count, tags, seed=0):
+    # Profiles alike in shape, as partner profiles tend to be: tags and value
+    # vocabularies are drawn from common pools.
+    rng = random.Random(seed)
+    tag_names = ["Partner-Tag-%d" % i for i in range(tags * 2)]
+    vocabularies = [
+        ["Value %d.%d" % (v, i) for i in range(rng.randint(2, 30))] for v in range(40)
+    ]
+    for n in range(count):
+        bag_info = {}
+        for tag in rng.sample(tag_names, tags):
+            config = {"required": rng.random() < 0.5}
+            if rng.random() < 0.3:
+                config["repeatable"] = False
+            if rng.random() < 0.4:
+                config["values"] = list(rng.choice(vocabularies))
+            bag_info[tag] = config
+        yield json.dumps({
+            "BagIt-Profile-Info": {
+                "BagIt-Profile-Identifier": "http://example.com/partner-%d.json" % n,
+                "Source-Organization": "Partner %d" % n,
+                "External-Description": "BagIt profile for partner %d" % n,
+                "Version": "1.0",
+                "BagIt-Profile-Version": "1.3.0",
+            },
+            "Bag-Info": bag_info,
+            "Manifests-Required": ["sha256"],
+            "Manifests-Allowed": ["md5", "sha256", "sha512"],
+            "Allow-Fetch.txt": False,
+            "Serialization": "optional",
+            "Accept-Serialization": ["application/zip", "application/x-tar"],
+            "Accept-BagIt-Version": ["0.97", "1.0"],
+            "Tag-Files-Required": [],
+        })
+
+
+def resident_bytes():
+    # Resident set size, from /proc where available.
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_profiles(count, tags, compact):
+    import gc
+    import tracemalloc
+
+    import bagit_profile
+
+    documents = list(synthetic_profiles(count, tags))
+    gc.collect()
+    rss = resident_bytes()
+    tracemalloc.start()
+    profiles = [
+        bagit_profile.Profile("http://example.com/partner-%d.json" % n, profile=document, compact=compact)
+        for n, document in enumerate(documents)
+    ]
+    gc.collect()
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss = resident_bytes() - rss
+    assert len(profiles) == count
+    return {"traced": traced, "rss": rss}
+
+
+def benchmark_profiles(args):
+    results = {}
+    for mode in ("plain", "compact"):
+        output = subprocess.check_output([
+            sys.executable, __file__, "_measure_profiles", mode, str(args.count), str(args.tags),
+        ])
+        results[mode] = json.loads(output.decode("utf-8"))
+    print("%d profiles of %d Bag-Info tags" % (args.count, args.tags))
+    print("%-8s %14s %14s" % ("", "traced/profile", "RSS/profile"))
+    for mode in ("plain", "compact"):
+        print("%-8s %14d %14d" % (mode, results[mode]["traced"] // args.count, results[mode]["rss"] // args.count))
+    print("compact/plain: %.2f" % (float(results["compact"]["traced"]) / results["plain"]["traced"]))
+
+
+def synthetic_bag(path, payload_files):
+    # A bag with payload_files small payload files, 1000 to a directory, and
+    # a payload manifest listing them.
+    import hashlib
+
+    os.makedirs(os.path.join(path, "data"))
+    lines = []
+    for n in range(payload_files):
+        directory = os.path.join(path, "data", "%04d" % (n // 1000))
+        if n % 1000 == 0:
+            os.makedirs(directory)
+        content = ("payload %d\n" % n).encode("ascii")
+        with open(os.path.join(directory, "%d.txt" % n), "wb") as f:
+            f.write(content)
+        lines.append("%s  data/%04d/%d.txt\n" % (hashlib.sha256(content).hexdigest(), n // 1000, n))
+    with open(os.path.join(path, "manifest-sha256.txt"), "w") as f:
+        f.writelines(lines)
+    with open(os.path.join(path, "bagit.txt"), "w") as f:
+        f.write("BagIt-Version: 1.0\nTag-File-Character-Encoding: UTF-8\n")
+    with open(os.path.join(path, "bag-info.txt"), "w") as f:
+        f.write("Source-Organization: Example\nPayload-Oxum: 0.%d\n" % payload_files)
+
+
+def benchmark_fingerprint(args):
+    import bagit_profile
+
+    tmpdir = tempfile.mkdtemp(prefix="bagit-profile-benchmark-")
+    try:
+        print("%14s %14s" % ("payload files", "ms/fingerprint"))
+        for payload_files in args.payload_files:
+            path = os.path.join(tmpdir, "bag-%d" % payload_files)
+            synthetic_bag(path, payload_files)
+            seconds = min(timeit.repeat(lambda: bagit_profile.bag_fingerprint(path), number=1, repeat=args.repeat))
+            print("%14d %14.3f" % (payload_files, seconds * 1000))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "_measure_profiles":
+        # Child process of benchmark_profiles.
+        result = measure_profiles(int(sys.argv[3]), int(sys.argv[4]), sys.argv[2] == "compact")
+        print(json.dumps(result))
+        return
+
+    parser = ArgumentParser(description="Benchmarks for bagit_profile")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    profiles = subparsers.add_parser("profiles", help="Memory taken per loaded profile, plain and compact")
+    profiles.add_argument("--count", type=int, default=500)
+    profiles.add_argument("--tags", type=int, default=40)
+    profiles.set_defaults(run=benchmark_profiles)
+    fingerprint = subparsers.add_parser("fingerprint", help="Time taken by bag_fingerprint() as the payload grows")
+    fingerprint.add_argument("--payload-files", type=int, nargs="+", default=[0, 1000, 10000, 100000])
+    fingerprint.add_argument("--repeat", type=int, default=20)
+    fingerprint.set_defaults(run=benchmark_fingerprint)
+    args = parser.parse_args()
+    if not hasattr(args, "run"):
+        parser.error("choose a benchmark")
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ setup(
     name="bagit_profile",
     version="1.3.0",
     url="https://github.com/bagit-profiles/bagit-profiles-validator",
-    install_requires=["bagit", "requests"],
+    install_requires=["bagit", "requests", 'futures; python_version < "3"'],
     author="Mark Jordan, Nick Ruest",
     author_email="mjordan@sfu.ca, ruestn@gmail.com",
     license="CC0",
@@ -1,12 +1,26 @@
 import json
 import os
+import subprocess
 import sys
+import time
+import tarfile
+from collections import OrderedDict
 from os.path import isdir, join
-from shutil import copytree, rmtree
+from shutil import copyfile, copytree, rmtree
 from unittest import TestCase, main
 
 from bagit import Bag
-from bagit_profile import Profile, ProfileValidationError, find_tag_files
+from bagit_profile import (ArchiveStorage, BagFacts, BagWatcher, CheckpointJournal, MetadataCache,
+                           ObjectStorage, Profile, ResultCache, Rule,
+                           ProfileCatalog, ProfileValidationError,
+                           ProfileValidationReport, SQLiteWorkQueue,
+                           ValidationProfiler, bulk_validate_bag_info, compact_profile,
+                           discover_bags, estimate_cost, profile_diff, revalidate,
+                           bag_fingerprint, enqueue_bags, external_sort,
+                           file_digest, find_tag_files, iter_fetch, iter_sorted_payload,
+                           merge_profiles, parse_tag_file, register_fact, register_rule, run_worker,
+                           sniff_serialization, unregister_fact, unregister_rule, validate_bag_path, validate_bags,
+                           WorkQueue)
 
 PROFILE_URL = (
     "https://raw.github.com/bagit-profiles/bagit-profiles/master/bagProfileBar.json"
@@ -56,6 +70,843 @@ class TagFilesAllowedTest(TestCase):
         self.assertTrue("Existing tag file" in profile.report.errors[0].value)
 
 
+class MetadataCacheTest(TestCase):
+    def tearDown(self):
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-metadata-cache")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        self.bagdir = join(self.tmpdir, "bag")
+        copytree("./fixtures/test-tag-files-allowed/bag", self.bagdir)
+        os.mkdir(join(self.bagdir, "extra"))
+        with open(join(self.bagdir, "extra", "tag-bar"), "w"):
+            pass
+        self.age(self.bagdir)
+        self.age(join(self.bagdir, "extra"))
+        with open(join("./fixtures/test-tag-files-allowed/profile.json"), "r") as f:
+            self.profile_dict = json.loads(f.read())
+        self.profile_dict["Tag-Files-Allowed"] = ["extra/*"]
+        self.profile_dict["Tag-Files-Required"] = ["extra/tag-bar"]
+        self.cache = MetadataCache(join(self.tmpdir, "cache.sqlite"))
+
+    @staticmethod
+    def age(path):
+        # Date a directory back so that its listing may be cached.
+        os.utime(path, (os.stat(path).st_atime, os.stat(path).st_mtime - 60))
+
+    def validate(self):
+        profile = Profile("TEST", self.profile_dict, metadata_cache=self.cache)
+        uncached = Profile("TEST", self.profile_dict)
+        result = profile.validate(Bag(self.bagdir))
+        self.assertEqual(result, uncached.validate(Bag(self.bagdir)))
+        self.assertEqual([e.value for e in profile.report.errors], [e.value for e in uncached.report.errors])
+        return profile
+
+    def test_reuses_listings(self):
+        self.assertTrue(self.validate().report.is_valid)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        self.cache.close()
+        self.cache = MetadataCache(join(self.tmpdir, "cache.sqlite"))
+        self.assertTrue(self.validate().report.is_valid)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 0))
+
+    def test_sees_changes(self):
+        self.validate()
+        with open(join(self.bagdir, "tag-foo"), "w"):
+            pass
+        profile = self.validate()
+        self.assertEqual(len(profile.report.errors), 1)
+        self.assertTrue("Existing tag file 'tag-foo'" in profile.report.errors[0].value)
+        os.remove(join(self.bagdir, "extra", "tag-bar"))
+        profile = self.validate()
+        self.assertTrue("Required tag file" in str(profile.report.errors))
+
+    def test_recent_directories_are_not_cached(self):
+        os.utime(self.bagdir, None)
+        self.validate()
+        self.validate()
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.close()
+        self.cache = MetadataCache(join(self.tmpdir, "small.sqlite"), max_entries=2)
+        for name in ("a", "b", "c"):
+            os.mkdir(join(self.tmpdir, name))
+            self.age(join(self.tmpdir, name))
+        self.cache.listdir(join(self.tmpdir, "a"))
+        self.cache.listdir(join(self.tmpdir, "b"))
+        self.cache.listdir(join(self.tmpdir, "a"))
+        self.cache.listdir(join(self.tmpdir, "c"))
+        self.assertEqual(len(self.cache), 2)
+        self.cache.listdir(join(self.tmpdir, "a"))
+        self.assertEqual(self.cache.hits, 2)
+        self.cache.listdir(join(self.tmpdir, "b"))
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_entry_kinds(self):
+        os.symlink(join(self.bagdir, "extra"), join(self.tmpdir, "linked"))
+        os.symlink(join(self.tmpdir, "missing"), join(self.tmpdir, "broken"))
+        entries = self.cache.listdir(self.tmpdir)
+        self.assertEqual(entries["bag"], "d")
+        self.assertEqual(entries["linked"], "l")
+        self.assertEqual(entries["broken"], "x")
+        self.assertEqual(entries["cache.sqlite"], "f")
+
+
+class ResultCacheTest(TestCase):
+    def tearDown(self):
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-result-cache")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        self.bagdir = join(self.tmpdir, "bag")
+        copytree("./fixtures/test-tag-files-allowed/bag", self.bagdir)
+        with open(join("./fixtures/test-tag-files-allowed/profile.json"), "r") as f:
+            self.profile_dict = json.loads(f.read())
+        self.cache_path = join(self.tmpdir, "results.sqlite")
+        self.cache = ResultCache(self.cache_path)
+
+    def cached_profile(self, profile_dict=None):
+        # A profile that fails the test if it validates anything itself.
+        def not_cached(bag):
+            raise AssertionError("%s was validated again" % bag)
+
+        profile = Profile("TEST", profile_dict or self.profile_dict, result_cache=self.cache)
+        profile.validate_bag_info = not_cached
+        return profile
+
+    def test_shared_between_profiles(self):
+        profile = Profile("TEST", self.profile_dict, result_cache=self.cache)
+        self.assertTrue(profile.validate(Bag(self.bagdir)))
+        self.profile_dict["Tag-Files-Allowed"] = []
+        profile = Profile("TEST", self.profile_dict, result_cache=self.cache)
+        with open(join(self.bagdir, "tag-foo"), "w"):
+            pass
+        self.assertFalse(profile.validate(Bag(self.bagdir)))
+        cached = self.cached_profile()
+        self.assertFalse(cached.validate(Bag(self.bagdir)))
+        self.assertEqual([e.value for e in cached.report.errors], [e.value for e in profile.report.errors])
+
+    def test_changed_bag_is_validated_again(self):
+        Profile("TEST", self.profile_dict, result_cache=self.cache).validate(Bag(self.bagdir))
+        self.assertTrue(self.cached_profile().validate(Bag(self.bagdir)))
+        with open(join(self.bagdir, "bag-info.txt"), "a") as f:
+            f.write("Contact-Name: Someone\n")
+        with self.assertRaises(AssertionError):
+            self.cached_profile().validate(Bag(self.bagdir))
+
+    def test_changed_profile_is_not_cached(self):
+        Profile("TEST", self.profile_dict, result_cache=self.cache).validate(Bag(self.bagdir))
+        self.profile_dict["Allow-Fetch.txt"] = False
+        with self.assertRaises(AssertionError):
+            self.cached_profile().validate(Bag(self.bagdir))
+
+    def test_shared_between_processes(self):
+        script = (
+            "import json, bagit, bagit_profile\n"
+            "profile = bagit_profile.Profile('TEST', json.load(open(%r)),"
+            " result_cache=bagit_profile.ResultCache(%r))\n"
+            "profile.validate(bagit.Bag(%r))\n"
+        ) % ("./fixtures/test-tag-files-allowed/profile.json", self.cache_path, self.bagdir)
+        subprocess.check_call([sys.executable, "-c", script])
+        self.assertTrue(self.cached_profile().validate(Bag(self.bagdir)))
+
+
+class RevalidateTest(TestCase):
+    def tearDown(self):
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-revalidate")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.document = json.loads(f.read())
+        self.bags = []
+        for i, organization in enumerate(["York University", "Simon Fraser University", "Nowhere"]):
+            path = join(self.tmpdir, "bag%d" % i)
+            copytree("./fixtures/test-bar", path)
+            with open(join(path, "bag-info.txt"), "r") as f:
+                baginfo = f.read()
+            with open(join(path, "bag-info.txt"), "w") as f:
+                f.write(baginfo.replace("York University", organization))
+            self.bags.append(path)
+
+    def profile(self, change=None, **kwargs):
+        document = json.loads(json.dumps(self.document))
+        if change:
+            change(document)
+        return Profile(PROFILE_URL, document, **kwargs)
+
+    def errors(self, profile, bag):
+        profile.validate(bag)
+        return [e.value for e in profile.report.errors]
+
+    def test_facts_give_same_results(self):
+        def ignore_case(document):
+            document["Bag-Info"]["contact-name"] = document["Bag-Info"].pop("Contact-Name")
+
+        for bag in self.bags + ["./fixtures/test-foo", "./fixtures/test-tag-files-allowed/bag"]:
+            facts = BagFacts.from_bag(Bag(bag))
+            facts = BagFacts.from_dict(json.loads(json.dumps(facts.to_dict())))
+            for profile in (self.profile(), self.profile(ignore_case, ignore_baginfo_tag_case=True)):
+                self.assertEqual(self.errors(profile, facts), self.errors(profile, Bag(bag)))
+
+    def test_profile_diff(self):
+        old = self.profile()
+
+        def add_value(document):
+            document["Bag-Info"]["Source-Organization"]["values"].append("Nowhere")
+
+        def allow_fetch(document):
+            document["Allow-Fetch.txt"] = True
+            document["Tag-Files-Allowed"] = ["*"]
+
+        def new_version(document):
+            document["BagIt-Profile-Info"]["BagIt-Profile-Version"] = "1.3.0"
+
+        def reorder_values(document):
+            document["Bag-Info"]["Source-Organization"]["values"].reverse()
+
+        self.assertEqual(profile_diff(old, self.profile(add_value)), set(["validate_bag_info"]))
+        self.assertEqual(profile_diff(old, self.profile(allow_fetch)),
+                         set(["validate_allow_fetch", "validate_tag_files_allowed"]))
+        self.assertTrue("validate_payload_manifests_allowed" in profile_diff(old, self.profile(new_version)))
+        self.assertEqual(profile_diff(old, self.profile(reorder_values)), set())
+        self.assertEqual(profile_diff(old, self.profile(compact=True)), set())
+
+    def test_revalidate_from_facts(self):
+        def add_value(document):
+            document["Bag-Info"]["Source-Organization"]["values"].append("Nowhere")
+
+        def require_sha256(document):
+            document["Manifests-Required"] = ["sha256"]
+
+        cache = ResultCache(join(self.tmpdir, "results.sqlite"), facts=True)
+        old = self.profile(result_cache=cache)
+        for bag in self.bags:
+            old.validate(Bag(bag))
+        expected = {}
+        for change in (add_value, require_sha256):
+            expected[change] = dict((bag, self.errors(self.profile(change), Bag(bag))) for bag in self.bags)
+        self.assertNotEqual(expected[add_value], expected[require_sha256])
+        # The bags are not needed any more.
+        for bag in self.bags:
+            rmtree(bag)
+        for change in (add_value, require_sha256):
+            new = self.profile(change)
+            results = dict((path, [e.value for e in report.errors])
+                           for path, report in revalidate(old, new, cache))
+            self.assertEqual(results, expected[change])
+            # Stored for the new profile too.
+            self.assertEqual(len(list(cache.entries(new._profile_key()))), 3)  # pylint: disable=protected-access
+
+    def test_revalidate_changed_bag(self):
+        cache = ResultCache(join(self.tmpdir, "results.sqlite"), facts=True)
+        old = self.profile(result_cache=cache)
+        old.validate(Bag(self.bags[0]))
+        with open(join(self.bags[0], "bag-info.txt"), "a") as f:
+            f.write("Contact-Name: Someone\n")
+        new = self.profile(lambda document: document["Bag-Info"]["Contact-Name"].update(repeatable=False))
+        stale = dict(revalidate(old, new, cache))
+        fresh = dict(revalidate(old, new, cache, verify=True))
+        self.assertFalse("Someone" in str(stale[self.bags[0]]))
+        self.assertTrue("Someone" in str(fresh[self.bags[0]]))
+
+
+class RuleEngineTest(TestCase):
+    def setUp(self):
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.document = json.loads(f.read())
+        self.bag = Bag("./fixtures/test-bar")
+        self.fetches = []
+        self.ran = []
+
+        def fetch_organization(facts):
+            self.fetches.append(facts.path)
+            return facts.tags(["Source-Organization"])["Source-Organization"]
+
+        register_fact("test_organization", fetch_organization, cost=5.0)
+
+    def tearDown(self):
+        unregister_fact("test_organization")
+
+    def rule(self, name, cost=1.0, fails=False, needs=(), **kwargs):
+        def check(profile, facts):
+            self.ran.append(name)
+            if needs:
+                facts.fact(needs[0])
+            if fails:
+                raise ProfileValidationError("%s: %s failed" % (facts, name))
+
+        return Rule(name, check, needs=needs, cost=cost, **kwargs)
+
+    def test_fact_fetched_once(self):
+        rules = [self.rule("first", needs=["test_organization"]), self.rule("second", needs=["test_organization"])]
+        profile = Profile(PROFILE_URL, self.document, rules=rules)
+        self.assertTrue(profile.validate(self.bag))
+        self.assertEqual(self.fetches, [self.bag.path])
+        self.assertEqual(sorted(self.ran), ["first", "second"])
+
+    def test_cheapest_first(self):
+        rules = [
+            self.rule("slow", cost=10.0, fails=True),
+            self.rule("needs_fact", cost=0.1, needs=["test_organization"], fails=True),
+            self.rule("cheap", cost=1.0, fails=True),
+        ]
+        profile = Profile(PROFILE_URL, self.document, rules=rules)
+        self.assertFalse(profile.validate(self.bag))
+        # The fact's cost counts until it is fetched.
+        self.assertEqual(self.ran, ["cheap", "needs_fact", "slow"])
+        # Errors are reported in rule order.
+        self.assertEqual([e.value.split(": ")[1] for e in profile.report.errors],
+                         ["slow failed", "needs_fact failed", "cheap failed"])
+
+    def test_fail_fast(self):
+        rules = [self.rule("slow", cost=10.0, fails=True), self.rule("cheap", fails=True)]
+        profile = Profile(PROFILE_URL, self.document, rules=rules, fail_fast=True)
+        self.assertFalse(profile.validate(self.bag))
+        self.assertEqual(self.ran, ["cheap"])
+        self.assertEqual(len(profile.report.errors), 1)
+
+    def test_registered_rule(self):
+        def embargoed(document):
+            document["Bag-Info"]["Source-Organization"]["values"].append("Nowhere")
+
+        register_rule(self.rule("test_embargo", fails=True, profile_keys=["Bag-Info"]))
+        try:
+            profile = Profile(PROFILE_URL, self.document)
+            self.assertFalse(profile.validate(self.bag))
+            self.assertEqual(profile.report.errors[-1].value, "%s: test_embargo failed" % self.bag)
+            changed = json.loads(json.dumps(self.document))
+            embargoed(changed)
+            self.assertEqual(profile_diff(profile, Profile(PROFILE_URL, changed)),
+                             set(["validate_bag_info", "test_embargo"]))
+            # Built-in rules can be picked by name.
+            profile = Profile(PROFILE_URL, self.document, rules=["validate_bag_info"])
+            self.assertTrue(profile.validate(self.bag))
+        finally:
+            unregister_rule("test_embargo")
+        self.assertTrue(Profile(PROFILE_URL, self.document).validate(self.bag))
+        self.assertRaises(ValueError, register_rule, Rule("test_unknown", None, needs=["no_such_fact"]))
+        with self.assertRaises(ValueError) as context:
+            Profile(PROFILE_URL, self.document, rules=["no_such_rule"])
+        self.assertTrue("no_such_rule" in str(context.exception))
+
+    def test_overridden_check_gets_bag(self):
+        seen = []
+
+        class LocalProfile(Profile):
+            def validate_bag_info(self, bag):
+                seen.append(bag)
+                return super(LocalProfile, self).validate_bag_info(bag)
+
+        profile = LocalProfile(PROFILE_URL, self.document)
+        self.assertTrue(profile.validate(self.bag))
+        self.assertEqual(seen, [self.bag])
+
+
+class BagDescriptionTest(TestCase):
+    def setUp(self):
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.profile = Profile(PROFILE_URL, f.read())
+        self.bag_info = OrderedDict(BagFacts.from_bag(Bag("./fixtures/test-bar")).values["bag_info"]["pairs"])
+
+    def describe(self, path="./fixtures/test-bar", **kwargs):
+        description = {
+            "bag_info": self.bag_info,
+            "bagit_version": "0.96",
+            "manifests": ["md5"],
+            "tag_manifests": ["md5"],
+            "tag_files": ["DPN/dpnFirstNode.txt", "DPN/dpnRegistry"],
+        }
+        description.update(kwargs)
+        return BagFacts.describe(path, **description)
+
+    def test_same_facts_as_bag(self):
+        facts = BagFacts.from_bag(Bag("./fixtures/test-bar"))
+        self.assertEqual(self.describe().values, facts.values)
+
+    def test_validate_without_disk(self):
+        with ValidationProfiler() as profiler:
+            self.assertTrue(self.profile.validate(self.describe()))
+        for call in ("exists", "isfile", "isdir", "listdir", "walk_entries", "bytes_read"):
+            self.assertFalse(profiler.counters.get(call))
+        self.assertEqual(profiler.checks["validate_bag_info"][0], 1)
+
+    def test_rejected(self):
+        self.assertFalse(self.profile.validate(self.describe(fetch=True)))
+        self.assertTrue("Fetch.txt is present" in self.profile.report.errors[0].value)
+        self.assertFalse(self.profile.validate(self.describe(bag_info=None, manifests=["sha256"])))
+        self.assertEqual(len(self.profile.report.errors), 2)
+        bag_info = dict(self.bag_info, **{"Source-Organization": "Other"})
+        self.assertFalse(self.profile.validate(self.describe(bag_info=bag_info)))
+        self.assertTrue("does not have an allowed value" in self.profile.report.errors[0].value)
+
+    def test_required_tag_file_not_described(self):
+        # A file left where the bag will be written does not count.
+        path = join("/tmp", "bagit-profile-test-described")
+        if isdir(path):
+            rmtree(path)
+        os.makedirs(join(path, "extra"))
+        try:
+            with open(join(path, "extra", "x.txt"), "w"):
+                pass
+            with open("./fixtures/bagProfileBar.json", "r") as f:
+                document = json.loads(f.read())
+            document["Tag-Files-Required"] = ["extra/x.txt"]
+            document["Tag-Files-Allowed"] = document.get("Tag-Files-Allowed", []) + ["extra/*"]
+            profile = Profile(PROFILE_URL, profile=document)
+            self.assertFalse(profile.validate(self.describe(path)))
+            self.assertEqual(len(profile.report.errors), 1)
+            self.assertTrue("extra/x.txt' is not present" in profile.report.errors[0].value)
+            self.assertTrue(profile.validate(self.describe(path, tag_files=["extra/x.txt"])))
+        finally:
+            rmtree(path)
+
+    def test_file_checks_refused(self):
+        self.profile.tag_fixity = True
+        self.assertRaises(ValueError, self.profile.validate, self.describe())
+
+
+class S3StandIn(object):
+    """
+    A local stand-in for an S3-compatible object store, serving the files
+    under ``root`` (one directory per bucket) for ListObjectsV2, GET (with
+    Range) and HEAD, and recording every request.
+    """
+
+    def __init__(self, root):
+        import threading
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+        stand_in = self
+        self.root = root
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.handle(self, "GET")
+
+            def do_HEAD(self):
+                stand_in.handle(self, "HEAD")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.endpoint = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def keys(self, bucket):
+        keys = []
+        for directory, _, files in os.walk(join(self.root, bucket)):
+            for name in files:
+                key = os.path.relpath(join(directory, name), join(self.root, bucket)).replace(os.sep, "/")
+                keys.append(key.decode("utf-8") if isinstance(key, bytes) else key)
+        return sorted(keys, key=lambda k: k.encode("utf-8"))
+
+    def handle(self, handler, method):
+        try:
+            from urllib.parse import parse_qsl, unquote, urlsplit
+        except ImportError:
+            from urllib import unquote
+            from urlparse import parse_qsl, urlsplit
+
+        url = urlsplit(handler.path)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        query = dict((n, v.decode("utf-8") if isinstance(v, bytes) else v) for n, v in parse_qsl(url.query))
+        # Python 2 gives the header names in lower case.
+        self.requests.append((method, key, query, dict((n.title(), v) for n, v in handler.headers.items())))
+        if not key:
+            keys = [k for k in self.keys(bucket) if k.startswith(query.get("prefix", ""))]
+            after = query.get("continuation-token") or query.get("start-after")
+            if after:
+                keys = [k for k in keys if k.encode("utf-8") > after.encode("utf-8")]
+            page = keys[:int(query.get("max-keys", 1000))]
+            truncated = len(keys) > len(page)
+            body = "<ListBucketResult xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">%s" % "".join(
+                "<Contents><Key>%s</Key></Contents>" % k for k in page)
+            body += "<IsTruncated>%s</IsTruncated>" % ("true" if truncated else "false")
+            if truncated:
+                body += "<NextContinuationToken>%s</NextContinuationToken>" % page[-1]
+            return self.respond(handler, 200, (body + "</ListBucketResult>").encode("utf-8"))
+        path = join(self.root, bucket, key)
+        if not os.path.isfile(path):
+            return self.respond(handler, 404, b"")
+        with open(path, "rb") as f:
+            data = f.read()
+        headers = {}
+        status = 200
+        if method == "GET" and "Range" in handler.headers:
+            start, end = [int(n) for n in handler.headers["Range"].split("=")[1].split("-")]
+            if start >= len(data):
+                return self.respond(handler, 416, b"")
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, min(end, len(data) - 1), len(data))
+            data = data[start:end + 1]
+            status = 206
+        self.respond(handler, status, data if method == "GET" else b"", headers)
+
+    @staticmethod
+    def respond(handler, status, body, headers=None):
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class ObjectStorageTest(TestCase):
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-s3")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        self.bag = join(self.tmpdir, "bucket", "bags", "test-bar")
+        copytree("./fixtures/test-bar", self.bag)
+        for i in range(20):
+            with open(join(self.bag, "data", "file-%02d.txt" % i), "w") as f:
+                f.write("payload")
+        self.server = S3StandIn(self.tmpdir)
+        self.storage = ObjectStorage(self.server.endpoint, "bucket", page_size=3, read_size=256)
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.profile = Profile(PROFILE_URL, f.read())
+
+    def tearDown(self):
+        self.server.close()
+        rmtree(self.tmpdir)
+
+    def test_same_facts_as_local(self):
+        remote = BagFacts(path="bags/test-bar", storage=self.storage).to_dict()
+        self.assertEqual(remote["name"], "s3://bucket/bags/test-bar")
+        self.assertEqual(remote["values"], BagFacts.from_bag(Bag(self.bag)).to_dict()["values"])
+
+    def test_one_listing_and_ranged_reads(self):
+        self.assertTrue(self.profile.validate(BagFacts(path="bags/test-bar", storage=self.storage)))
+        listings = [r for r in self.server.requests if not r[1]]
+        reads = [r for r in self.server.requests if r[1]]
+        # The payload keys are skipped over, not paged through.
+        self.assertTrue(len(listings) <= 5)
+        self.assertTrue(all(query["prefix"] == "bags/test-bar/" for _, _, query, _ in listings))
+        self.assertEqual(sorted(key for _, key, _, _ in reads),
+                         ["bags/test-bar/bag-info.txt", "bags/test-bar/bag-info.txt", "bags/test-bar/bagit.txt"])
+        self.assertTrue(all(method == "GET" and "Range" in headers for method, _, _, headers in reads))
+
+    def test_errors_match_local(self):
+        with open(join(self.bag, "fetch.txt"), "w") as f:
+            f.write("http://example.com/file 1 data/file\n")
+        os.remove(join(self.bag, "bag-info.txt"))
+        self.profile.validate(BagFacts(path="bags/test-bar", storage=self.storage))
+        remote = [e.value.split(": ", 1)[1] for e in self.profile.report.errors]
+        self.profile.validate(Bag(self.bag))
+        local = [e.value.split(": ", 1)[1] for e in self.profile.report.errors]
+        self.assertEqual(remote, local)
+        self.assertEqual(len(remote), 2)
+
+    def test_validate_bags(self):
+        results = dict(validate_bags(self.profile, ["bags/test-bar", "bags/missing"], storage=self.storage))
+        self.assertTrue(results["bags/test-bar"].is_valid)
+        self.assertTrue("does not exist" in results["bags/missing"].errors[0].value)
+
+    def test_signed_requests(self):
+        storage = ObjectStorage(self.server.endpoint, "bucket", access_key="AKID", secret_key="secret")
+        self.assertTrue(storage.exists("bags/test-bar/bagit.txt"))
+        self.assertTrue(storage.exists("bags/test-bar/DPN"))
+        self.assertFalse(storage.exists("bags/test-bar/missing"))
+        authorization = self.server.requests[0][3]["Authorization"]
+        self.assertTrue(authorization.startswith("AWS4-HMAC-SHA256 Credential=AKID/"))
+        self.assertTrue("SignedHeaders=host;x-amz-content-sha256;x-amz-date" in authorization)
+
+    def test_file_checks_refused(self):
+        self.profile.tag_fixity = True
+        self.assertRaises(ValueError, self.profile.validate, BagFacts(path="bags/test-bar", storage=self.storage))
+
+
+class ArchiveStorageTest(TestCase):
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-archive")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.profile = Profile(PROFILE_URL, f.read())
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def tar_bytes(self, bag="./fixtures/test-bar"):
+        # The payload first, as the slowest case to read the tag files from.
+        import io
+
+        raw = io.BytesIO()
+        with tarfile.open(fileobj=raw, mode="w") as tar:
+            tar.add(join(bag, "data"), arcname="bag/data")
+            for name in sorted(os.listdir(bag)):
+                if name != "data":
+                    tar.add(join(bag, name), arcname="bag/" + name)
+        return raw.getvalue()
+
+    def write(self, name, data):
+        path = join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    @staticmethod
+    def gzip(data):
+        # gzip.compress() is not in Python 2.
+        import gzip
+        import io
+
+        raw = io.BytesIO()
+        with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            f.write(data)
+        return raw.getvalue()
+
+    def test_same_facts_as_directory(self):
+        local = BagFacts.from_bag(Bag("./fixtures/test-bar")).to_dict()["values"]
+        data = self.tar_bytes()
+        archives = [("bag.tar", data), ("bag.tgz", self.gzip(data))]
+        try:
+            import lzma
+
+            archives.append(("bag.txz", lzma.compress(data)))
+        except ImportError:  # Python 2
+            pass
+        for name, content in archives:
+            storage = ArchiveStorage(self.write(name, content))
+            self.assertEqual(storage.bag_path, "bag")
+            facts = BagFacts(path=storage.bag_path, storage=storage)
+            self.assertEqual(facts.to_dict()["values"], local)
+            self.assertTrue(os.path.isfile(storage.index_path))
+
+    def test_read_to_end(self):
+        import io
+
+        from bagit_profile import _ArchiveStream
+
+        data = b"".join(b"%d\n" % i for i in range(300000))
+        self.assertEqual(_ArchiveStream(io.BytesIO(b"abc"), None, [0, 0]).read(), b"abc")
+        stream = _ArchiveStream(io.BytesIO(self.gzip(data)), "gzip", [0, 0])
+        self.assertEqual(stream.read(10), data[:10])
+        self.assertEqual(stream.read(), data[10:])
+        self.assertEqual(stream.position, len(data))
+
+    def test_index_restarts(self):
+        data = self.tar_bytes()
+        path = self.write("bag.tar.gz", b"".join(self.gzip(data[i:i + 65536])
+                                                   for i in range(0, len(data), 65536)))
+        ArchiveStorage(path).index()
+        storage = ArchiveStorage(path)
+        with ValidationProfiler() as profiler:
+            self.assertTrue(self.profile.validate(BagFacts(path=storage.bag_path, storage=storage)))
+        self.assertTrue(len(storage.index()["restarts"]) > 1)
+        self.assertTrue(profiler.counters["bytes_decompressed"] < len(data) / 4)
+
+        # A changed archive is indexed again.
+        with open(path, "ab") as f:
+            f.write(self.gzip(b"\0" * 1024))
+        self.assertNotEqual(ArchiveStorage(path).index()["key"], storage.index()["key"])
+
+    def test_validate_bag_path(self):
+        bag = join(self.tmpdir, "bag")
+        copytree("./fixtures/test-bar", bag)
+        with open(join(bag, "fetch.txt"), "w") as f:
+            f.write("http://example.com/file 1 data/file\n")
+        path = self.write("bag.tar.gz", self.gzip(self.tar_bytes(bag)))
+        report = validate_bag_path(self.profile, path, skip=("serialization",))
+        self.assertEqual(len(report.errors), 1)
+        self.assertTrue("Fetch.txt is present" in report.errors[0].value)
+        self.assertTrue(validate_bag_path(self.profile, path, skip=("serialization", "profile")).is_valid)
+
+
+class FetchEntriesTest(TestCase):
+    def setUp(self):
+        import threading
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+
+        self.tmpdir = join("/tmp", "bagit-profile-test-fetch")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        self.bag = join(self.tmpdir, "bag")
+        copytree("./fixtures/test-bar", self.bag)
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            document = json.loads(f.read())
+        document["Allow-Fetch.txt"] = True
+        self.document = document
+
+        test = self
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+        self.clients = set()
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def answer(self):
+                with test.lock:
+                    test.active += 1
+                    test.most_active = max(test.most_active, test.active)
+                    test.clients.add(self.client_address)
+                    test.requests.append((self.command, self.path))
+                time.sleep(0.02)
+                if self.path.startswith("/missing"):
+                    status = 404
+                elif self.path.startswith("/no-head") and self.command == "HEAD":
+                    status = 405
+                else:
+                    status = 200
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                with test.lock:
+                    test.active -= 1
+
+            do_HEAD = do_GET = answer
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.base = "http://127.0.0.1:%d" % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.tmpdir)
+
+    def write_fetch(self, entries, listed=None):
+        with open(join(self.bag, "fetch.txt"), "w") as f:
+            for url, path in entries:
+                f.write("%s - %s\n" % (self.base + url if url.startswith("/") else url, path))
+        with open(join(self.bag, "manifest-md5.txt"), "a") as f:
+            for _, path in entries if listed is None else listed:
+                f.write("d41d8cd98f00b204e9800998ecf8427e  %s\n" % path)
+
+    def errors(self, **kwargs):
+        profile = Profile(PROFILE_URL, self.document, fetch_entries=True, **kwargs)
+        profile.validate(Bag(self.bag))
+        return [e.value for e in profile.report.errors]
+
+    def test_reachable(self):
+        self.write_fetch([("/file-%d" % i, "data/remote %d.txt" % i) for i in range(20)] +
+                         [("/no-head", "data/no-head.txt")])
+        self.assertEqual(self.errors(fetch_workers=3), [])
+        self.assertTrue(1 < self.most_active <= 3)
+        # Connections are kept open and reused.
+        self.assertTrue(len(self.clients) <= 4)
+        self.assertTrue(("GET", "/no-head") in self.requests)
+
+    def test_unreachable(self):
+        self.write_fetch([("/file", "data/file.txt"), ("/missing", "data/missing.txt"),
+                          ("http://127.0.0.1:1/closed", "data/closed.txt")])
+        errors = self.errors()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue("/missing' in fetch.txt cannot be reached: HTTP 404" in errors[0])
+        self.assertTrue("/closed' in fetch.txt cannot be reached" in errors[0])
+        self.assertFalse("/file'" in errors[0])
+
+    def test_not_in_manifest(self):
+        self.write_fetch([("/file", "data/file.txt"), ("/missing", "data/other.txt")],
+                         listed=[("/file", "data/file.txt")])
+        errors = self.errors()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue("'data/other.txt' in fetch.txt is not listed in any payload manifest" in errors[0])
+        # The URLs are checked all the same.
+        self.assertTrue("/missing' in fetch.txt cannot be reached: HTTP 404" in errors[0])
+
+    def test_malformed(self):
+        self.write_fetch([("/file", "data/file.txt"), ("/escape", "../outside.txt")],
+                         listed=[("/file", "data/file.txt")])
+        errors = self.errors()
+        self.assertTrue("fetch.txt, line 2: '../outside.txt' is not a path under data/" in errors[0])
+        with open(join(self.bag, "fetch.txt"), "a") as f:
+            f.write("not-a-url 12 data/file.txt\n")
+        self.assertRaises(ProfileValidationError, list, iter_fetch(join(self.bag, "fetch.txt")))
+        with open(join(self.bag, "fetch.txt"), "wb") as f:
+            f.write(b"http://example.com/file - data/file.txt\nhttp://example.com/caf\xe9 - data/caf\xe9.txt\n")
+        with self.assertRaises(ProfileValidationError) as context:
+            list(iter_fetch(join(self.bag, "fetch.txt")))
+        self.assertTrue("fetch.txt, line 2: not valid utf-8" in context.exception.value)
+
+    def test_opt_in(self):
+        self.write_fetch([("/missing", "data/missing.txt")])
+        profile = Profile(PROFILE_URL, self.document)
+        self.assertTrue(profile.validate(Bag(self.bag)))
+        self.assertEqual(self.requests, [])
+
+
+class BagFingerprintTest(TestCase):
+    def setUp(self):
+        self.bag = join("/tmp", "bagit-profile-test-fingerprint")
+        if isdir(self.bag):
+            rmtree(self.bag)
+        copytree("./fixtures/test-bar", self.bag)
+
+    def tearDown(self):
+        if isdir(self.bag):
+            rmtree(self.bag)
+
+    def test_payload_ignored(self):
+        fingerprint = bag_fingerprint(self.bag)
+        self.assertEqual(bag_fingerprint(self.bag), fingerprint)
+        with open(join(self.bag, "data", "8199237780_495a29796e_o.jpg"), "ab") as f:
+            f.write(b"more")
+        os.makedirs(join(self.bag, "data", "more"))
+        with open(join(self.bag, "data", "more", "file.txt"), "w") as f:
+            f.write("payload")
+        self.assertEqual(bag_fingerprint(self.bag), fingerprint)
+
+    def test_tag_files(self):
+        fingerprint = bag_fingerprint(self.bag)
+        with open(join(self.bag, "DPN", "extra.txt"), "w") as f:
+            f.write("extra")
+        with_extra = bag_fingerprint(self.bag)
+        self.assertNotEqual(with_extra, fingerprint)
+        # Same size and timestamps, different content.
+        path = join(self.bag, "bag-info.txt")
+        st = os.stat(path)
+        with open(path, "rb") as f:
+            content = f.read()
+        with open(path, "wb") as f:
+            f.write(content.replace(b"a", b"b", 1))
+        os.utime(path, (st.st_atime, st.st_mtime))
+        self.assertNotEqual(bag_fingerprint(self.bag), with_extra)
+
+
 class BagitProfileIgnoreBagInfoTagNameCapitalizationTests(TestCase):
 
     def tearDown(self):
@@ -193,6 +1044,502 @@ class BagitProfileV1_3_0_Tests(TestCase):
         self.assertEqual(len(profile.report.errors), 0)
 
 
+class WorkQueueTest(TestCase):
+    def tearDown(self):
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-queue")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        with open("./fixtures/test-tag-files-allowed/profile.json", "r") as f:
+            self.profile = Profile("TEST", json.loads(f.read()))
+        self.paths = [
+            "./fixtures/test-tag-files-allowed/bag",
+            "./fixtures/test-bar",
+            "./fixtures/test-tag-files-allowed/bag/../bag",
+            "./fixtures/test-bar/../test-bar",
+        ]
+        self.queue_path = join(self.tmpdir, "queue.db")
+
+    def test_workers_share_queue(self):
+        import threading
+
+        self.assertEqual(enqueue_bags(SQLiteWorkQueue(self.queue_path), self.paths, shard_size=1), 4)
+        completed = []
+
+        def work(worker_id):
+            completed.append(run_worker(SQLiteWorkQueue(self.queue_path), self.profile,
+                                        worker_id=worker_id, skip=["serialization"]))
+
+        threads = [threading.Thread(target=work, args=("worker-%d" % i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(completed), 4)
+        results = list(SQLiteWorkQueue(self.queue_path).results())
+        self.assertEqual(sorted(p for p, _ in results), sorted(self.paths))
+        self.assertEqual([r.is_valid for p, r in results if "test-bar" in p], [False, False])
+        self.assertEqual([r.is_valid for p, r in results if "test-bar" not in p], [True, True])
+
+    def test_expired_lease_is_retried(self):
+        queue = SQLiteWorkQueue(self.queue_path, max_attempts=2)
+        enqueue_bags(queue, self.paths, shard_size=4)
+        self.assertEqual(queue.claim("crashed", lease_seconds=-1)[0], 1)
+        self.assertEqual(run_worker(queue, self.profile, worker_id="live", skip=["serialization"]), 1)
+        self.assertEqual(queue.unfinished(), 0)
+        self.assertEqual(len(list(queue.results())), 4)
+
+    def test_complete_needs_lease(self):
+        queue = SQLiteWorkQueue(self.queue_path)
+        enqueue_bags(queue, self.paths[:1])
+        report = ProfileValidationReport()
+        shard_id, _ = queue.claim("slow", lease_seconds=-1)
+        self.assertEqual(queue.claim("live", lease_seconds=60)[0], shard_id)
+        self.assertFalse(queue.complete(shard_id, "slow", [(self.paths[0], report)]))
+        self.assertEqual(list(queue.results()), [])
+        self.assertTrue(queue.complete(shard_id, "live", [(self.paths[0], report)]))
+        self.assertEqual(len(list(queue.results())), 1)
+        self.assertRaises(TypeError, type("Incomplete", (WorkQueue,), {}))
+
+    def test_failed_after_max_attempts(self):
+        queue = SQLiteWorkQueue(self.queue_path, max_attempts=2)
+        enqueue_bags(queue, self.paths[:1])
+        queue.claim("crashed", lease_seconds=-1)
+        queue.claim("crashed", lease_seconds=-1)
+        self.assertIsNone(queue.claim("live", lease_seconds=60))
+        self.assertEqual(queue.unfinished(), 0)
+        [(path, report)] = list(queue.results())
+        self.assertFalse(report.is_valid)
+        self.assertTrue("Not validated after 2 attempts" in report.errors[0].value)
+
+
+class ParseTagFileTest(TestCase):
+    def tearDown(self):
+        if isdir(self.bagdir):
+            rmtree(self.bagdir)
+
+    def setUp(self):
+        self.bagdir = join("/tmp", "bagit-profile-test-bagdir")
+        if isdir(self.bagdir):
+            rmtree(self.bagdir)
+        copytree("./fixtures/test-tag-files-allowed/bag", self.bagdir)
+        with open(join("./fixtures/test-tag-files-allowed/profile.json"), "r") as f:
+            self.profile_dict = json.loads(f.read())
+        self.baginfo = join(self.bagdir, "bag-info.txt")
+        with open(self.baginfo, "ab") as f:
+            f.write(b"External-Description: first line\r\n  second line\r\n\r\n\tthird\n"
+                    b"Contact-Name: A\ncontact-name: B\nContact-Name: C\n"
+                    b"Blob: " + b"x" * 100000 + b"\n  more\nEmpty:\n")
+
+    def test_same_as_bagit(self):
+        self.assertEqual(parse_tag_file(self.baginfo), Bag(self.bagdir).info)
+        self.assertEqual(parse_tag_file(join(self.bagdir, "bagit.txt")), Bag(self.bagdir).tags)
+
+    def test_selected_tags(self):
+        self.assertEqual(
+            parse_tag_file(self.baginfo, tags=["Contact-Name", "Missing"]), {"Contact-Name": ["A", "C"]}
+        )
+        self.assertEqual(
+            parse_tag_file(self.baginfo, tags=["contact-name"], ignore_case=True), {"contact-name": ["A", "B", "C"]}
+        )
+
+    def test_repeated_tag(self):
+        self.profile_dict["Bag-Info"] = {"Contact-Name": {"repeatable": False}, "Blob": {"repeatable": False}}
+        profile = Profile("TEST", self.profile_dict)
+        self.assertFalse(profile.validate(Bag(self.bagdir)))
+        self.assertEqual(len(profile.report.errors), 1)
+        self.assertTrue("Nonrepeatable tag 'Contact-Name' occurs 2 times" in profile.report.errors[0].value)
+
+
+class BulkBagInfoTest(TestCase):
+    def tearDown(self):
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-bulk")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.profile = Profile(PROFILE_URL, json.loads(f.read()))
+        self.profile.profile["Bag-Info"]["Contact-Name"]["repeatable"] = False
+        with open("./fixtures/test-bar/bag-info.txt", "r") as f:
+            baginfo = f.read()
+        variants = [
+            baginfo,
+            baginfo.replace("York University", "Nowhere"),
+            baginfo.replace("Contact-Name: Nick Ruest\n", ""),
+            baginfo + "Contact-Name: Mark Jordan\n",
+            baginfo.replace(PROFILE_URL, "http://example.com/other.json"),
+            baginfo.replace("Source-Organization: York University", "Source-Organization: Simon Fraser University"),
+            baginfo + "Source-Organization: York University\n",
+            None,
+        ]
+        self.paths = []
+        for i, variant in enumerate(variants * 3):
+            path = join(self.tmpdir, "bag%02d" % i)
+            os.mkdir(path)
+            copyfile("./fixtures/test-bar/bagit.txt", join(path, "bagit.txt"))
+            if variant is not None:
+                with open(join(path, "bag-info.txt"), "w") as f:
+                    f.write(variant)
+            self.paths.append(path)
+
+    def expected(self):
+        result = []
+        for path in self.paths:
+            try:
+                result.append(self.profile.validate_bag_info(Bag(path)))
+            except ProfileValidationError:
+                result.append(False)
+        return result
+
+    def check(self, use_numpy):
+        table = bulk_validate_bag_info(self.profile, self.paths, use_numpy=use_numpy)
+        self.assertEqual(table.conforms(), self.expected())
+        self.assertEqual(table.failures[("Contact-Name", "repeatable")], [3, 11, 19])
+        self.assertEqual(table.failures[("Source-Organization", "values")], [1, 6, 9, 14, 17, 22])
+        rows = list(table.rows())
+        self.assertEqual(rows[0], (self.paths[0], True, []))
+        self.assertEqual(rows[2], (self.paths[2], False, [("Contact-Name", "required")]))
+        self.assertEqual(rows[4][2], [("BagIt-Profile-Identifier", "values")])
+        self.assertEqual(rows[7][2], [("bag-info.txt", "unreadable")])
+
+    def test_encodings(self):
+        with open("./fixtures/test-bar/bag-info.txt", "rb") as f:
+            baginfo = f.read().replace(b"Nick Ruest", b"Nick Ru\xebst")
+        self.profile.profile["Bag-Info"]["Contact-Name"]["values"] = [u"Nick Ru\xebst"]
+        paths = []
+        for name, encoding in (("declared", "ISO-8859-1"), ("undeclared", "UTF-8")):
+            path = join(self.tmpdir, name)
+            os.mkdir(path)
+            with open(join(path, "bagit.txt"), "w") as f:
+                f.write("BagIt-Version: 0.96\nTag-File-Character-Encoding: %s\n" % encoding)
+            with open(join(path, "bag-info.txt"), "wb") as f:
+                f.write(baginfo)
+            paths.append(path)
+        table = bulk_validate_bag_info(self.profile, paths, use_numpy=False)
+        self.assertEqual(list(table.rows()), [(paths[0], True, []), (paths[1], False, [("bag-info.txt", "unreadable")])])
+
+    def test_pure_python(self):
+        self.check(False)
+
+    def test_numpy(self):
+        try:
+            import numpy  # pylint: disable=unused-import
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        self.check(True)
+
+
+class TagFixityTest(TestCase):
+    def tearDown(self):
+        if isdir(self.bagdir):
+            rmtree(self.bagdir)
+
+    def setUp(self):
+        self.bagdir = join("/tmp", "bagit-profile-test-bagdir")
+        if isdir(self.bagdir):
+            rmtree(self.bagdir)
+        copytree("./fixtures/test-tag-files-allowed/bag", self.bagdir)
+        with open(join("./fixtures/test-tag-files-allowed/profile.json"), "r") as f:
+            self.profile = Profile("TEST", json.loads(f.read()), tag_fixity=True)
+        # The fixture's bag-info.txt was edited after its tag manifests were written.
+        for algorithm in ("sha256", "sha512"):
+            with open(join(self.bagdir, "tagmanifest-%s.txt" % algorithm), "w") as f:
+                for name in ("bagit.txt", "bag-info.txt", "manifest-sha256.txt", "manifest-sha512.txt"):
+                    f.write("%s %s\n" % (file_digest(join(self.bagdir, name), algorithm), name))
+
+    def test_valid(self):
+        self.assertTrue(self.profile.validate(Bag(self.bagdir)))
+
+    def test_stale_fixture(self):
+        with self.assertRaises(ProfileValidationError) as context:
+            self.profile.validate_tag_fixity(Bag("./fixtures/test-tag-files-allowed/bag"))
+        self.assertTrue("'bag-info.txt' does not match its digest" in context.exception.value)
+
+    def test_not_checked_by_default(self):
+        with open(join(self.bagdir, "bag-info.txt"), "a") as f:
+            f.write("Contact-Name: Jane Doe\n")
+        self.profile.tag_fixity = False
+        self.assertTrue(self.profile.validate(Bag(self.bagdir)))
+
+    def test_modified_tag_file(self):
+        with open(join(self.bagdir, "bag-info.txt"), "a") as f:
+            f.write("Contact-Name: Jane Doe\n")
+        self.assertFalse(self.profile.validate(Bag(self.bagdir)))
+        self.assertEqual(len(self.profile.report.errors), 1)
+        self.assertTrue("'bag-info.txt' does not match its digest" in self.profile.report.errors[0].value)
+
+    def test_unlisted_tag_file(self):
+        with open(join(self.bagdir, "tag-foo"), "w"):
+            pass
+        self.assertFalse(self.profile.validate(Bag(self.bagdir)))
+        self.assertTrue("tagmanifest-sha256.txt: 'tag-foo' is not listed" in self.profile.report.errors[0].value)
+
+    def test_outside_bag(self):
+        with open(join(self.bagdir, "tagmanifest-sha256.txt"), "a") as f:
+            f.write("%s DPN/../../outside.txt\n" % ("0" * 64))
+        # bagit refuses to load such a bag, so check the bag's facts.
+        with self.assertRaises(ProfileValidationError) as context:
+            self.profile.validate_tag_fixity(BagFacts(path=self.bagdir))
+        self.assertTrue("'DPN/../../outside.txt' is not a tag file" in context.exception.value)
+
+    def test_read_once(self):
+        size = sum(os.path.getsize(join(self.bagdir, name))
+                   for name in ("bagit.txt", "bag-info.txt", "manifest-sha256.txt", "manifest-sha512.txt"))
+        with ValidationProfiler() as profiler:
+            self.profile.validate_tag_fixity(Bag(self.bagdir))
+        manifests = sum(os.path.getsize(join(self.bagdir, "tagmanifest-%s.txt" % a)) for a in ("sha256", "sha512"))
+        self.assertEqual(profiler.counters["bytes_read"], size + manifests)
+
+    def test_directory_entry(self):
+        with self.assertRaises(ProfileValidationError) as context:
+            self.profile.validate_tag_fixity(Bag("./fixtures/test-bar"))
+        self.assertTrue("'DPN' is not present" in context.exception.value)
+        self.assertTrue("'DPN/dpnRegistry' is not listed" in context.exception.value)
+
+
+class PayloadCompletenessTest(TestCase):
+    def tearDown(self):
+        if isdir(self.bagdir):
+            rmtree(self.bagdir)
+
+    def setUp(self):
+        self.bagdir = join("/tmp", "bagit-profile-test-bagdir")
+        if isdir(self.bagdir):
+            rmtree(self.bagdir)
+        copytree("./fixtures/test-tag-files-allowed/bag", self.bagdir)
+        with open(join("./fixtures/test-tag-files-allowed/profile.json"), "r") as f:
+            self.profile = Profile("TEST", json.loads(f.read()), payload_completeness=True)
+
+    def test_external_sort(self):
+        items = ["b", "a\nz", "a/b", "a.txt", "c", "a", "b"]
+        self.assertEqual(list(external_sort(iter(items), chunk_size=2)), sorted(items))
+
+    def test_sorted_walk(self):
+        os.mkdir(join(self.bagdir, "data", "a"))
+        for name in ("a.txt", "a/b", "a-b"):
+            with open(join(self.bagdir, "data", name), "w"):
+                pass
+        paths = list(iter_sorted_payload(self.bagdir))
+        self.assertEqual(paths, sorted(paths))
+        self.assertEqual(len(paths), 6)
+
+    def test_complete(self):
+        self.assertTrue(self.profile.validate(Bag(self.bagdir)))
+
+    def test_missing_and_extra(self):
+        os.remove(join(self.bagdir, "data", "foo"))
+        with open(join(self.bagdir, "data", "new"), "w"):
+            pass
+        self.assertFalse(self.profile.validate(Bag(self.bagdir)))
+        self.assertEqual(len(self.profile.report.errors), 1)
+        error = self.profile.report.errors[0].value
+        self.assertTrue("'data/foo' is listed in manifest-sha256.txt but not present" in error)
+        self.assertTrue("'data/new' is not listed in any payload manifest" in error)
+
+    def test_manifest_encoding(self):
+        # A Latin-1 byte in a bag declared to be UTF-8.
+        with open(join(self.bagdir, "data", "extra"), "w"):
+            pass
+        for algorithm in ("sha256", "sha512"):
+            with open(join(self.bagdir, "manifest-%s.txt" % algorithm), "ab") as f:
+                f.write(b"\xe9  data/extra\n")
+        self.assertFalse(self.profile.validate(BagFacts(path=self.bagdir)))
+        self.assertEqual(len(self.profile.report.errors), 1)
+        self.assertTrue("manifest-sha256.txt, line 4: not valid utf-8" in self.profile.report.errors[0].value)
+        self.assertTrue(self.profile.validate(BagFacts(path=self.bagdir, encoding="iso-8859-1")))
+
+    def test_partially_listed(self):
+        with open(join(self.bagdir, "manifest-sha512.txt"), "r") as f:
+            lines = f.readlines()
+        with open(join(self.bagdir, "manifest-sha512.txt"), "w") as f:
+            f.writelines(lines[1:])
+        with self.assertRaises(ProfileValidationError) as context:
+            self.profile.validate_payload_completeness(Bag(self.bagdir))
+        self.assertEqual(
+            "'data/bar' is not listed in manifest-sha512.txt", context.exception.value.split(": ", 1)[1]
+        )
+
+
+class ValidationProfilerTest(TestCase):
+    def tearDown(self):
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-profiler")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        with open(join("./fixtures/test-tag-files-allowed/profile.json"), "r") as f:
+            self.profile = Profile("TEST", json.loads(f.read()), tag_fixity=True)
+
+    def test_records_checks_and_calls(self):
+        bag = Bag("./fixtures/test-bar")
+        with ValidationProfiler() as profiler:
+            self.profile.validate(bag)
+        self.assertEqual(profiler.checks["validate_bag_info"][0], 1)
+        self.assertEqual(profiler.checks["validate_tag_fixity"][0], 1)
+        self.assertTrue(profiler.counters["exists"] > 0)
+        self.assertTrue(profiler.counters["walk_entries"] > 0)
+        self.assertTrue(profiler.counters["bytes_read"] > 0)
+        self.assertTrue("validate_tag_fixity" in profiler.summary())
+
+    def test_per_thread(self):
+        import threading
+
+        counters = {}
+
+        def run():
+            with ValidationProfiler() as other:
+                self.profile.validate(Bag("./fixtures/test-bar"))
+            counters.update(other.counters)
+
+        with ValidationProfiler() as profiler:
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        self.assertTrue(counters["exists"] > 0)
+        self.assertEqual(profiler.counters.get("exists", 0), 0)
+        with ValidationProfiler() as profiler:
+            results = dict(validate_bags(self.profile, ["./fixtures/test-bar"], workers=2, skip=["serialization"]))
+        self.assertTrue(results["./fixtures/test-bar"])
+        self.assertEqual(profiler.checks["validate_bag_info"][0], 1)
+        self.assertTrue(profiler.counters["bytes_read"] > 0)
+
+    def test_dumps(self):
+        pstats_path = join(self.tmpdir, "run.pstats")
+        collapsed_path = join(self.tmpdir, "run.collapsed")
+        with ValidationProfiler(pstats_path=pstats_path, collapsed_path=collapsed_path, sample_interval=0.001):
+            for _ in range(20):
+                self.profile.validate(Bag("./fixtures/test-tag-files-allowed/bag"))
+        import pstats
+
+        self.assertTrue(pstats.Stats(pstats_path).total_calls > 0)
+        self.assertTrue(os.path.isfile(collapsed_path))
+
+
+class CompactProfileTest(TestCase):
+    def setUp(self):
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.document = f.read()
+        self.tmpdir = join("/tmp", "bagit-profile-test-compact")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_same_verdicts(self):
+        repeated = join(self.tmpdir, "repeated")
+        copytree("./fixtures/test-bar", repeated)
+        with open(join(repeated, "bag-info.txt"), "a") as f:
+            f.write("Source-Organization: York University\n")
+        for bag in ("./fixtures/test-bar", "./fixtures/test-foo", repeated):
+            plain = Profile(PROFILE_URL, self.document)
+            compact = Profile(PROFILE_URL, self.document, compact=True)
+            self.assertEqual(plain.validate(Bag(bag)), compact.validate(Bag(bag)))
+            self.assertEqual([str(e) for e in plain.report.errors], [str(e) for e in compact.report.errors])
+            self.assertEqual(plain.validate_serialization(bag), compact.validate_serialization(bag))
+        self.assertTrue("does not have an allowed value" in compact.report.errors[0].value)
+
+    def test_shares_equal_parts(self):
+        first = compact_profile(json.loads(self.document, object_pairs_hook=OrderedDict))
+        document = json.loads(self.document, object_pairs_hook=OrderedDict)
+        document["BagIt-Profile-Info"]["Version"] = "2.0"
+        second = compact_profile(document)
+        self.assertFalse(first is second)
+        self.assertTrue(first["Bag-Info"] is second["Bag-Info"])
+        self.assertEqual(first["Bag-Info"]["Contact-Name"]["values"], frozenset(["Nick Ruest", "Mark Jordan"]))
+        self.assertEqual(first["Manifests-Required"], ("md5",))
+        self.assertEqual(list(first["Bag-Info"])[:2], ["Source-Organization", "Organization-Address"])
+
+    def test_pool_released(self):
+        import gc
+
+        from bagit_profile import _compact_pool
+
+        gc.collect()
+        before = len(_compact_pool)
+        document = json.loads(self.document)
+        document["Bag-Info"]["Unique-Tag"] = {"values": ["Only here"]}
+        compact = compact_profile(document)
+        self.assertTrue(len(_compact_pool) > before)
+        del compact
+        gc.collect()
+        self.assertEqual(len(_compact_pool), before)
+
+    def test_read_only(self):
+        compact = compact_profile(json.loads(self.document))
+        with self.assertRaises(TypeError):
+            compact["Serialization"] = "required"  # pylint: disable=unsupported-assignment-operation
+
+    def test_types_kept_apart(self):
+        first = compact_profile({"a": [1], "b": {"required": 1}})
+        second = compact_profile({"a": [True], "b": {"required": True}})
+        self.assertTrue(second["a"][0] is True)
+        self.assertTrue(second["b"]["required"] is True)
+        self.assertTrue(first["b"]["required"] is not True)
+
+
+class MergeProfilesTest(TestCase):
+    def test_merge(self):
+        base = {
+            "Bag-Info": {"Source-Organization": {"required": True, "values": ["A"]}},
+            "Tag-Files-Required": ["a"],
+            "Tag-Files-Allowed": ["a", "b"],
+            "Allow-Fetch.txt": False,
+        }
+        derived = {
+            "Bag-Info": {"Source-Organization": {"values": ["B"]}, "Contact-Name": {}},
+            "Tag-Files-Required": ["b"],
+            "Tag-Files-Allowed": ["b"],
+        }
+        merged = merge_profiles(base, derived)
+        self.assertEqual(merged["Bag-Info"], {
+            "Source-Organization": {"required": True, "values": ["B"]},
+            "Contact-Name": {},
+        })
+        self.assertEqual(merged["Tag-Files-Required"], ["a", "b"])
+        self.assertEqual(merged["Tag-Files-Allowed"], ["b"])
+        self.assertFalse(merged["Allow-Fetch.txt"])
+        self.assertEqual(base["Bag-Info"]["Source-Organization"]["values"], ["A"])
+
+    def test_allowed_lists_of_parents(self):
+        info = {"Source-Organization": "Test", "Version": "1.0", "BagIt-Profile-Version": "1.3.0"}
+        parents = {
+            "A": {
+                "BagIt-Profile-Info": dict(info, **{"BagIt-Profile-Identifier": "A"}),
+                "Tag-Files-Required": ["a"],
+                "Tag-Files-Allowed": ["a"],
+                "Manifests-Allowed": ["md5"],
+            },
+            "B": {
+                "BagIt-Profile-Info": dict(info, **{"BagIt-Profile-Identifier": "B"}),
+                "Tag-Files-Allowed": ["b"],
+            },
+        }
+        child = {
+            "BagIt-Profile-Info": dict(info, **{"BagIt-Profile-Identifier": "C"}),
+            "BagIt-Profile-Extends": ["A", "B"],
+        }
+        profile = Profile("C", child, resolver=parents.__getitem__)
+        self.assertEqual(profile.profile["Tag-Files-Allowed"], ["a", "b"])
+        # B allows any manifest.
+        self.assertFalse("Manifests-Allowed" in profile.profile)
+        child["Tag-Files-Allowed"] = ["a", "c"]
+        profile = Profile("C", child, resolver=parents.__getitem__)
+        self.assertEqual(profile.profile["Tag-Files-Allowed"], ["a"])
+
+
 class BagitProfileConstructorTest(TestCase):
     def setUp(self):
         with open("./fixtures/bagProfileBar.json", "rb") as f:
@@ -226,6 +1573,337 @@ class BagitProfileConstructorTest(TestCase):
         )
 
 
+class ProfileCatalogTest(TestCase):
+    def tearDown(self):
+        if isdir(self.catalogdir):
+            rmtree(self.catalogdir)
+
+    def setUp(self):
+        self.catalogdir = join("/tmp", "bagit-profile-test-catalog")
+        if isdir(self.catalogdir):
+            rmtree(self.catalogdir)
+        os.mkdir(self.catalogdir)
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.bar = json.loads(f.read())
+        with open("./fixtures/test-tag-files-allowed/profile.json", "r") as f:
+            self.test = json.loads(f.read())
+        self.write_profile("bar.json", self.bar)
+        self.write_profile("test.json", self.test)
+
+    def write_profile(self, filename, profile):
+        with open(join(self.catalogdir, filename), "w") as f:
+            json.dump(profile, f)
+
+    def test_lookup_by_identifier(self):
+        catalog = ProfileCatalog(self.catalogdir)
+        self.assertEqual(len(catalog), 2)
+        profile = catalog.get("TEST")
+        self.assertEqual(profile.url, "TEST")
+        self.assertIs(catalog.get("TEST"), profile)
+        with self.assertRaises(ProfileValidationError):
+            catalog.get("http://example.com/unknown.json")
+
+    def test_shared_by_threads(self):
+        import threading
+
+        catalog = ProfileCatalog(self.catalogdir)
+        profiles = []
+        threads = [threading.Thread(target=lambda: profiles.append(catalog.get("TEST"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(profiles), 8)
+        self.assertTrue(all(profile is profiles[0] for profile in profiles))
+
+    def test_compact(self):
+        catalog = ProfileCatalog(self.catalogdir, compact=True)
+        profile = catalog.get("TEST")
+        self.assertEqual(profile.profile["BagIt-Profile-Info"]["BagIt-Profile-Identifier"], "TEST")
+        self.assertEqual(catalog._documents, {})  # pylint: disable=protected-access
+        self.assertTrue(profile.validate(Bag("./fixtures/test-tag-files-allowed/bag")))
+
+    def test_index_is_persisted_and_refreshed(self):
+        ProfileCatalog(self.catalogdir)
+        self.assertTrue(os.path.isfile(join(self.catalogdir, ProfileCatalog.index_name)))
+        self.bar["BagIt-Profile-Info"]["BagIt-Profile-Identifier"] = "BAR2"
+        self.write_profile("bar2.json", self.bar)
+        catalog = ProfileCatalog(self.catalogdir)
+        self.assertEqual(sorted(catalog.identifiers()),
+                         sorted(["BAR2", "TEST", "http://canadiana.org/standards/bagit/tdr_ingest.json"]))
+
+    def test_index_reused(self):
+        class CountingCatalog(ProfileCatalog):
+            rebuilds = 0
+
+            def rebuild(self, previous=None):
+                CountingCatalog.rebuilds += 1
+                return super(CountingCatalog, self).rebuild(previous)
+
+        CountingCatalog(self.catalogdir)
+        self.assertEqual(CountingCatalog.rebuilds, 1)
+        CountingCatalog(self.catalogdir)
+        self.assertEqual(CountingCatalog.rebuilds, 1)
+        # A recorded mtime from another index is not trusted.
+        with open(join(self.catalogdir, ProfileCatalog.index_name + ".mtime"), "r+") as f:
+            _, mtime = json.load(f)
+            f.seek(0)
+            json.dump(["other", mtime], f)
+            f.truncate()
+        CountingCatalog(self.catalogdir)
+        self.assertEqual(CountingCatalog.rebuilds, 2)
+
+    def test_edited_in_place(self):
+        catalog = ProfileCatalog(self.catalogdir)
+        self.assertEqual(catalog.get("TEST").url, "TEST")
+        self.test["BagIt-Profile-Info"]["BagIt-Profile-Identifier"] = "NEW"
+        self.write_profile("test.json", self.test)
+        path = join(self.catalogdir, "test.json")
+        os.utime(path, (os.path.getatime(path), os.path.getmtime(path) + 10))
+        self.assertEqual(catalog.get("NEW").url, "NEW")
+        catalog = ProfileCatalog(self.catalogdir)
+        self.assertTrue("NEW" in catalog)
+        self.assertFalse("TEST" in catalog)
+
+    def test_extends(self):
+        derived = {
+            "BagIt-Profile-Info": {"BagIt-Profile-Identifier": "DERIVED", "Version": "2.0"},
+            "BagIt-Profile-Extends": ["TEST"],
+            "Bag-Info": {"Contact-Name": {"required": True}},
+            "Manifests-Required": ["md5", "sha256"],
+        }
+        self.write_profile("derived.json", derived)
+        catalog = ProfileCatalog(self.catalogdir)
+        profile = catalog.get("DERIVED")
+        self.assertEqual(profile.profile["Manifests-Required"], ["sha256", "sha512", "md5"])
+        self.assertEqual(profile.profile["Accept-BagIt-Version"], ["0.97"])
+        self.assertEqual(profile.profile["BagIt-Profile-Info"]["Source-Organization"], "bagit-profiles.py")
+        self.assertEqual(profile.profile["BagIt-Profile-Info"]["Version"], "2.0")
+        self.assertFalse("BagIt-Profile-Extends" in profile.profile)
+        # The merged profile is shared by later loads of the same ancestry.
+        again = ProfileCatalog(self.catalogdir).get("DERIVED").profile
+        self.assertIs(again["Bag-Info"], profile.profile["Bag-Info"])
+        self.assertIsNot(again, profile.profile)
+
+    def test_extends_cycle(self):
+        self.test["BagIt-Profile-Extends"] = "LOOP"
+        self.write_profile("test.json", self.test)
+        self.write_profile("loop.json", {
+            "BagIt-Profile-Info": {"BagIt-Profile-Identifier": "LOOP"},
+            "BagIt-Profile-Extends": "TEST",
+        })
+        with self.assertRaises(ProfileValidationError) as context:
+            ProfileCatalog(self.catalogdir).get("TEST")
+        self.assertTrue("extends itself" in context.exception.value)
+
+    def test_profile_for_bag(self):
+        catalog = ProfileCatalog(self.catalogdir)
+        bag = Bag("./fixtures/test-tag-files-allowed/bag")
+        profile = catalog.profile_for_bag(bag)
+        self.assertEqual(profile.url, "TEST")
+        self.assertTrue(profile.validate(bag))
+        with self.assertRaises(ProfileValidationError):
+            catalog.profile_for_bag(Bag("./fixtures/test-bar"))
+
+
+class SerializationSniffingTest(TestCase):
+    def tearDown(self):
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-sniff")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        with open("./fixtures/bagProfileBar.json", "r") as f:
+            self.profile_dict = json.loads(f.read())
+
+    def make_tar(self, name, mode):
+        path = join(self.tmpdir, name)
+        with tarfile.open(path, mode) as tar:
+            tar.add("./fixtures/test-bar/bagit.txt", arcname="test-bar/bagit.txt")
+        return path
+
+    def test_sniff(self):
+        self.assertEqual(sniff_serialization("./fixtures/test-foo.zip")[0], "application/zip")
+        self.assertEqual(sniff_serialization(self.make_tar("bag", "w"))[0], "application/x-tar")
+        tgz = sniff_serialization(self.make_tar("bag.bin", "w:gz"))
+        self.assertEqual(tgz[0], "application/gzip")
+        self.assertTrue("application/x-tar" in tgz)
+        self.assertEqual(sniff_serialization("./fixtures/test-bar/bagit.txt"), ())
+
+    def test_cache_keeps_recently_used(self):
+        import bagit_profile
+
+        first, second, third = [self.make_tar(name, "w") for name in ("first", "second", "third")]
+        size = bagit_profile._SNIFF_CACHE_SIZE
+        bagit_profile._sniff_cache.clear()
+        bagit_profile._SNIFF_CACHE_SIZE = 2
+        try:
+            sniff_serialization(first)
+            sniff_serialization(second)
+            sniff_serialization(first)
+            sniff_serialization(third)
+            self.assertEqual(list(bagit_profile._sniff_cache), [first, third])
+        finally:
+            bagit_profile._SNIFF_CACHE_SIZE = size
+            bagit_profile._sniff_cache.clear()
+
+    def test_removed_while_sniffing(self):
+        path = self.make_tar("bag", "w")
+        real_open = os.open
+
+        def removing_open(name, *args):
+            os.remove(name)
+            return real_open(name, *args)
+
+        os.open = removing_open
+        try:
+            self.assertEqual(sniff_serialization(path), ())
+        finally:
+            os.open = real_open
+
+    def test_renamed_zip_validates(self):
+        path = join(self.tmpdir, "deposit")
+        copyfile("./fixtures/test-foo.zip", path)
+        profile = Profile(PROFILE_URL, profile=self.profile_dict)
+        self.assertTrue(profile.validate_serialization(path))
+
+    def test_misnamed_tar_does_not_validate(self):
+        path = self.make_tar("bag.zip", "w")
+        profile = Profile(PROFILE_URL, profile=self.profile_dict)
+        with self.assertRaises(ProfileValidationError) as context:
+            profile.validate_serialization(path)
+        self.assertTrue("application/x-tar" in context.exception.value)
+
+
+class BatchValidationTest(TestCase):
+    def tearDown(self):
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+
+    def setUp(self):
+        self.tmpdir = join("/tmp", "bagit-profile-test-batch")
+        if isdir(self.tmpdir):
+            rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        with open("./fixtures/test-tag-files-allowed/profile.json", "r") as f:
+            self.profile = Profile("TEST", json.loads(f.read()))
+
+    def test_validate_bags(self):
+        paths = ["./fixtures/test-tag-files-allowed/bag", "./fixtures/test-bar", join(self.tmpdir, "nobag")]
+        results = dict(validate_bags(self.profile, paths, workers=2, skip=["serialization"]))
+        self.assertEqual(sorted(results), sorted(paths))
+        self.assertTrue(results[paths[0]].is_valid)
+        self.assertFalse(results[paths[1]].is_valid)
+        self.assertFalse(results[paths[2]].is_valid)
+
+    def test_bag_not_loaded(self):
+        # Only the tag files the profile refers to are read: bagit, which
+        # would read the manifests in full, refuses this one.
+        bag = join(self.tmpdir, "bag")
+        copytree("./fixtures/test-tag-files-allowed/bag", bag)
+        with open(join(bag, "manifest-sha256.txt"), "a") as f:
+            f.write("%s  ../outside.txt\n" % ("0" * 64))
+        self.assertTrue(validate_bag_path(self.profile, bag, skip=["serialization"]).is_valid)
+        os.remove(join(bag, "bagit.txt"))
+        report = validate_bag_path(self.profile, bag, skip=["serialization"])
+        self.assertTrue("bagit.txt does not exist" in report.errors[0].value)
+
+    def test_checkpoint_resume(self):
+        journal_path = join(self.tmpdir, "journal")
+        first = ["./fixtures/test-tag-files-allowed/bag", join(self.tmpdir, "gone")]
+        checkpoint = CheckpointJournal(journal_path)
+        list(validate_bags(self.profile, first, workers=2, skip=["serialization"], checkpoint=checkpoint))
+        checkpoint.close()
+        with open(journal_path, "a") as f:
+            f.write('{"path": "./fixtures/test-ba')
+
+        # Recorded bags are not looked at again, even if they have changed since.
+        os.mkdir(join(self.tmpdir, "gone"))
+        checkpoint = CheckpointJournal(journal_path, resume=True)
+        self.assertEqual(len(checkpoint.completed), 2)
+        paths = first + ["./fixtures/test-bar"]
+        results = dict(validate_bags(self.profile, paths, skip=["serialization"], checkpoint=checkpoint))
+        checkpoint.close()
+        self.assertEqual([results[p].is_valid for p in paths], [True, False, False])
+        self.assertTrue("does not exist" in results[paths[1]].errors[0].value)
+        self.assertEqual(len(CheckpointJournal(journal_path, resume=True).completed), 3)
+
+    def test_estimate_cost(self):
+        small = estimate_cost("./fixtures/test-tag-files-allowed/bag")
+        self.assertTrue(estimate_cost("./fixtures/test-bar") > small)
+        self.assertTrue(estimate_cost("./fixtures/test-foo.zip") < small)
+        self.assertEqual(estimate_cost("./fixtures/test-bar", {"./fixtures/test-bar": 0.5}), 0.5)
+
+    def test_longest_first(self):
+        journal_path = join(self.tmpdir, "journal")
+        paths = [join(self.tmpdir, "bag%d" % i) for i in range(5)]
+        for path in paths:
+            copytree("./fixtures/test-tag-files-allowed/bag", path)
+        checkpoint = CheckpointJournal(journal_path)
+        list(validate_bags(self.profile, paths, workers=1, checkpoint=checkpoint))
+        checkpoint.close()
+        history = CheckpointJournal.timings(journal_path)
+        self.assertEqual(sorted(history), paths)
+        history.update((path, i) for i, path in enumerate(paths))
+        order = [path for path, _ in validate_bags(self.profile, paths, workers=1, longest_first=True,
+                                                   history=history)]
+        # The first bag may be started as soon as it is read, before the rest are.
+        self.assertEqual(sorted(order), paths)
+        self.assertEqual(order[1:], sorted(order[1:], reverse=True))
+
+    def test_deadline(self):
+        results = dict(validate_bags(self.profile, ["./fixtures/test-tag-files-allowed/bag"], deadline=1e-6))
+        self.assertTrue("did not finish within" in str(results["./fixtures/test-tag-files-allowed/bag"]))
+
+    def test_stuck_worker_is_replaced(self):
+        def hang(bag):
+            time.sleep(3)
+
+        self.profile.validate_bag_info = hang
+        paths = ["./fixtures/test-tag-files-allowed/bag", "./fixtures/test-foo.zip"]
+        started = time.time()
+        results = dict(validate_bags(self.profile, paths, workers=1, deadline=0.2))
+        self.assertTrue(time.time() - started < 2)
+        self.assertTrue("did not finish within 0.2 seconds" in str(results[paths[0]]))
+        self.assertFalse("did not finish" in str(results[paths[1]]))
+
+    def test_discover_bags(self):
+        os.makedirs(join(self.tmpdir, "a", "b"))
+        copytree("./fixtures/test-tag-files-allowed/bag", join(self.tmpdir, "a", "b", "bag1"))
+        copytree("./fixtures/test-tag-files-allowed/bag", join(self.tmpdir, "bag2"))
+        # Neither a bag inside a payload, nor a bagit.txt directory, nor a link is followed.
+        copytree("./fixtures/test-bar", join(self.tmpdir, "bag2", "data", "inner"))
+        os.makedirs(join(self.tmpdir, "c", "bagit.txt"))
+        os.symlink(join(self.tmpdir, "a"), join(self.tmpdir, "c", "link"))
+        expected = [join(self.tmpdir, "a", "b", "bag1"), join(self.tmpdir, "bag2")]
+        self.assertEqual(sorted(discover_bags(self.tmpdir, workers=3)), expected)
+        self.assertEqual(list(discover_bags(join(self.tmpdir, "bag2"))), [join(self.tmpdir, "bag2")])
+        self.assertEqual(list(discover_bags(join(self.tmpdir, "missing"))), [])
+        results = dict(validate_bags(self.profile, discover_bags(self.tmpdir), skip=["serialization"]))
+        self.assertEqual(sorted(results), expected)
+        self.assertTrue(all(report.is_valid for report in results.values()))
+
+    def check_watch(self, use_inotify):
+        watcher = BagWatcher(self.tmpdir, settle=0.2, poll_interval=0.1, use_inotify=use_inotify)
+        copytree("./fixtures/test-tag-files-allowed/bag", join(self.tmpdir, "early"))
+        bags = watcher.bags(timeout=5)
+        self.assertEqual(next(bags), join(self.tmpdir, "early"))
+        copytree("./fixtures/test-tag-files-allowed/bag", join(self.tmpdir, "late"))
+        self.assertEqual(next(bags), join(self.tmpdir, "late"))
+        bags.close()
+
+    def test_watch_polling(self):
+        self.check_watch(False)
+
+    def test_watch_inotify(self):
+        if not sys.platform.startswith("linux"):
+            self.skipTest("inotify is only available on Linux")
+        self.check_watch(True)
+
+
 class Test_bag_profile(TestCase):
     def setUp(self):
         self.bag = Bag("fixtures/test-bar")